@@ -0,0 +1,291 @@
+import logging
+import math
+import os
+import multiprocessing
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Index type for user indexes and DocumentSearch: flat, ivf_flat, ivf_pq, hnsw or auto
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto")
+# With INDEX_TYPE=auto, corpora of at least this many vectors use IVF-Flat ...
+ANN_IVF_THRESHOLD = int(os.getenv("ANN_IVF_THRESHOLD", "50000"))
+# ... and at least this many IVF-PQ, which keeps ~PQ_SUBQUANTIZERS bytes per vector
+ANN_PQ_THRESHOLD = int(os.getenv("ANN_PQ_THRESHOLD", "2000000"))
+# Number of IVF lists; 0 picks 4 * sqrt(vectors)
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0"))
+# Upper bound for the PQ code size in bytes; the largest divisor of the dimension below it is used
+ANN_PQ_SUBQUANTIZERS = int(os.getenv("ANN_PQ_SUBQUANTIZERS", "32"))
+ANN_HNSW_M = int(os.getenv("ANN_HNSW_M", "32"))
+ANN_HNSW_EF_CONSTRUCTION = int(os.getenv("ANN_HNSW_EF_CONSTRUCTION", "200"))
+# Default search breadth, can be overridden per query
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "16"))
+ANN_EF_SEARCH = int(os.getenv("ANN_EF_SEARCH", "64"))
+# Upper bounds for per-query overrides; nprobe is also capped at the index's number of lists
+ANN_MAX_NPROBE = int(os.getenv("ANN_MAX_NPROBE", "1024"))
+ANN_MAX_EF_SEARCH = int(os.getenv("ANN_MAX_EF_SEARCH", "1024"))
+# Retrain an IVF index once the corpus has grown by this factor since it was trained
+ANN_RETRAIN_GROWTH = float(os.getenv("ANN_RETRAIN_GROWTH", "4"))
+# Indexes trained and rebuilt at the same time in the background
+ANN_REBUILD_WORKERS = int(os.getenv("ANN_REBUILD_WORKERS", "1"))
+# Rebuild an index that can't remove vectors (HNSW) once this fraction of it is deleted
+ANN_REBUILD_DELETED_FRACTION = float(os.getenv("ANN_REBUILD_DELETED_FRACTION", "0.2"))
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# k-means wants ~40 points per centroid: at least 16 lists for IVF, 256 codewords for PQ
+_MIN_TRAINING_VECTORS = {"ivf_flat": 16 * 40, "ivf_pq": 256 * 40}
+# Vectors copied into the index per add call
+_ADD_BATCH_SIZE = 65536
+
+_executor: Optional[ThreadPoolExecutor] = None
+# Separate processes for rebuilds of persisted indexes, so training doesn't take CPU from the API
+_process_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+# faiss 1.7.4 ignores SearchParametersHNSW.efSearch, so it is set on the index itself (see search);
+# callers pass a lock per index, this one is for those that don't
+_hnsw_lock = threading.Lock()
+# IVF indexes get a direct map (id -> list entry) the first time a subset of them is searched
+_direct_map_lock = threading.Lock()
+
+
+def choose_index_type(ntotal: int, requested: str = INDEX_TYPE) -> str:
+    """
+    Index type to use for `ntotal` vectors. "auto" picks by corpus size; an
+    explicit IVF type falls back to a simpler one while there are too few
+    vectors to train it.
+    """
+    if requested == "auto":
+        requested = ("ivf_pq" if ntotal >= ANN_PQ_THRESHOLD else
+                     "ivf_flat" if ntotal >= ANN_IVF_THRESHOLD else "flat")
+    if requested not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {requested!r}, expected one of {INDEX_TYPES} or 'auto'")
+    if requested == "ivf_pq" and ntotal < _MIN_TRAINING_VECTORS["ivf_pq"]:
+        requested = "ivf_flat"
+    if requested == "ivf_flat" and ntotal < _MIN_TRAINING_VECTORS["ivf_flat"]:
+        requested = "flat"
+    return requested
+
+
+def _nlist(ntotal: int) -> int:
+    nlist = ANN_NLIST or int(4 * math.sqrt(ntotal))
+    return max(1, min(nlist, ntotal // 40))
+
+
+def _pq_subquantizers(dimension: int) -> int:
+    return max(m for m in range(1, min(ANN_PQ_SUBQUANTIZERS, dimension) + 1) if dimension % m == 0)
+
+
+def factory_string(index_type: str, dimension: int, ntotal: int) -> str:
+    """faiss.index_factory description of an `index_type` index for `ntotal` vectors."""
+    if index_type == "ivf_flat":
+        return f"IVF{_nlist(ntotal)},Flat"
+    if index_type == "ivf_pq":
+        return f"IVF{_nlist(ntotal)},PQ{_pq_subquantizers(dimension)}x8"
+    if index_type == "hnsw":
+        return f"HNSW{ANN_HNSW_M},Flat"
+    return "Flat"
+
+
+def index_type_of(index: faiss.Index) -> str:
+    index = faiss.downcast_index(index.index if isinstance(index, faiss.IndexIDMap) else index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return "ivf_pq" if isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ) else "ivf_flat"
+    return "flat"
+
+
+def build_ann_index(vectors: np.ndarray, ids: Optional[np.ndarray] = None,
+                    index_type: str = INDEX_TYPE) -> faiss.IndexIDMap2:
+    """
+    Build an id-mapped index of `vectors` (ids default to their positions),
+    training it first if the chosen index type needs it. `vectors` may be
+    memory-mapped; they are copied into the index in batches.
+    """
+    ntotal, dimension = vectors.shape
+    index_type = choose_index_type(ntotal, index_type)
+    index = faiss.index_factory(dimension, factory_string(index_type, dimension, ntotal), faiss.METRIC_L2)
+    if index_type == "hnsw":
+        faiss.downcast_index(index).hnsw.efConstruction = ANN_HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        # Train on a fixed-seed sample, enough for the k-means of the IVF lists and PQ codebooks
+        sample_size = min(ntotal, max(_nlist(ntotal), 256) * 256)
+        sample = np.sort(np.random.default_rng(0).choice(ntotal, sample_size, replace=False))
+        index.train(np.ascontiguousarray(vectors[sample], dtype="float32"))
+
+    index = faiss.IndexIDMap2(index)
+    if ids is None:
+        ids = np.arange(ntotal, dtype="int64")
+    for start in range(0, ntotal, _ADD_BATCH_SIZE):
+        index.add_with_ids(
+            np.ascontiguousarray(vectors[start:start + _ADD_BATCH_SIZE], dtype="float32"),
+            np.ascontiguousarray(ids[start:start + _ADD_BATCH_SIZE], dtype="int64"))
+    logger.info(f"Built {index_type} index of {ntotal} vectors")
+    return index
+
+
+def reconstruct_all(index: faiss.IndexIDMap2) -> np.ndarray:
+    """All vectors of an id-mapped index in id-map order (approximate for PQ indexes)."""
+    ivf = faiss.try_extract_index_ivf(index.index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.index.reconstruct_n(0, index.ntotal)
+
+
+def supports_removal(index_type: str) -> bool:
+    return index_type != "hnsw"
+
+
+def remove_ids(index: faiss.IndexIDMap2, ids: np.ndarray) -> int:
+    """
+    Remove vectors by id from an id-mapped flat or IVF index, returning how
+    many were removed. IVF lists keep the positions their vectors were added
+    at, which IndexIDMap.remove_ids leaves pointing at the wrong ids, so an
+    IVF index is refilled with its remaining vectors instead; it stays trained.
+    """
+    id_map = faiss.vector_to_array(index.id_map).astype("int64")
+    keep = ~np.isin(id_map, ids)
+    if keep.all():
+        return 0
+    if faiss.try_extract_index_ivf(index.index) is None:
+        return index.remove_ids(np.ascontiguousarray(id_map[~keep]))
+    vectors, id_map = reconstruct_all(index)[keep], id_map[keep]
+    index.reset()
+    for start in range(0, len(id_map), _ADD_BATCH_SIZE):
+        index.add_with_ids(vectors[start:start + _ADD_BATCH_SIZE],
+                           np.ascontiguousarray(id_map[start:start + _ADD_BATCH_SIZE]))
+    return int(keep.size - keep.sum())
+
+
+def needs_rebuild(index_type: str, trained_size: int, ntotal: int, requested: str = INDEX_TYPE,
+                  deleted: int = 0) -> bool:
+    """
+    Whether an `index_type` index trained on `trained_size` vectors should be
+    rebuilt at `ntotal`, `deleted` of which are deleted but still in the index.
+    """
+    if choose_index_type(ntotal, requested) != index_type:
+        return True
+    if not supports_removal(index_type) and deleted and deleted >= ntotal * ANN_REBUILD_DELETED_FRACTION:
+        return True
+    return index_type.startswith("ivf") and ntotal >= trained_size * ANN_RETRAIN_GROWTH
+
+
+def code_size(index: faiss.Index) -> int:
+    """Approximate bytes held per vector, for memory budgets."""
+    inner = faiss.downcast_index(index.index if isinstance(index, faiss.IndexIDMap) else index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return inner.d * 4 + inner.hnsw.nb_neighbors(0) * 4
+    ivf = faiss.try_extract_index_ivf(inner)
+    return ivf.code_size if ivf is not None else inner.d * 4
+
+
+def search(index: faiss.IndexIDMap2, id_map: np.ndarray, query_vectors: np.ndarray, k: int,
+           nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+           excluded_positions: Optional[np.ndarray] = None,
+           hnsw_lock: Optional[threading.Lock] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Search an id-mapped index with per-query parameters and return (distances, ids).
+    `id_map` is the index's id map (see faiss.vector_to_array) and
+    `excluded_positions` are positions in it to skip, e.g. deleted vectors.
+    The wrapped index is searched directly since IndexIDMap doesn't take
+    search parameters. `hnsw_lock` guards changes of an HNSW index's efSearch
+    and should be one lock per index.
+    """
+    inner = faiss.downcast_index(index.index)
+    selector = batch = None
+    if excluded_positions is not None and excluded_positions.size:
+        excluded_positions = np.ascontiguousarray(excluded_positions, dtype="int64")
+        batch = faiss.IDSelectorBatch(excluded_positions.size, faiss.swig_ptr(excluded_positions))
+        selector = faiss.IDSelectorNot(batch)
+
+    hnsw = isinstance(inner, faiss.IndexHNSW)
+    ivf = faiss.try_extract_index_ivf(inner)
+    if hnsw:
+        ef_search = min(ef_search or ANN_EF_SEARCH, ANN_MAX_EF_SEARCH)
+        params = faiss.SearchParametersHNSW(efSearch=max(ef_search, k))
+    elif ivf is not None:
+        params = faiss.SearchParametersIVF(nprobe=min(nprobe or ANN_NPROBE, ANN_MAX_NPROBE, ivf.nlist))
+    else:
+        params = faiss.SearchParameters()
+    if selector is not None:
+        params.sel = selector
+
+    if hnsw and inner.hnsw.efSearch != params.efSearch:
+        # Searches with the index's current efSearch run without the lock; one that
+        # overlaps a change may use the other value for some queries, which only
+        # affects recall
+        with hnsw_lock or _hnsw_lock:
+            inner.hnsw.efSearch = params.efSearch
+            distances, positions = inner.search(query_vectors, k, params=params)
+    else:
+        distances, positions = inner.search(query_vectors, k, params=params)
+    ids = np.where(positions >= 0, id_map[np.maximum(positions, 0)], -1)
+    return distances, ids
+
+
+def search_subset(index: faiss.IndexIDMap2, id_map: np.ndarray, positions: np.ndarray,
+                  query_vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact search restricted to the vectors at `positions` of an id-mapped index,
+    for small candidate sets such as lexical pre-filter matches. Returns (distances, ids).
+    """
+    if positions.size == 0:
+        return (np.full((len(query_vectors), k), np.inf, dtype="float32"),
+                np.full((len(query_vectors), k), -1, dtype="int64"))
+    inner = faiss.downcast_index(index.index)
+    ivf = faiss.try_extract_index_ivf(inner)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        with _direct_map_lock:
+            if ivf.direct_map.type == faiss.DirectMap.NoMap:
+                ivf.make_direct_map()
+    vectors = inner.reconstruct_batch(np.ascontiguousarray(positions, dtype="int64"))
+    distances, found = faiss.knn(query_vectors, vectors, k)
+    ids = np.where(found >= 0, id_map[positions[np.maximum(found, 0)]], -1)
+    distances[ids < 0] = np.inf
+    return distances, ids
+
+
+def _get_executor(in_process: bool = False) -> Executor:
+    global _executor, _process_executor
+    with _executor_lock:
+        # Daemonic processes (celery's prefork workers) can't start children,
+        # and already run off the request path
+        if in_process and not multiprocessing.current_process().daemon:
+            if _process_executor is None:
+                _process_executor = ProcessPoolExecutor(
+                    max_workers=ANN_REBUILD_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            return _process_executor
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=ANN_REBUILD_WORKERS, thread_name_prefix="ann-rebuild")
+        return _executor
+
+
+def submit_rebuild(func: Callable, *args, in_process: bool = False) -> Future:
+    """
+    Run an index (re)build off the request path; faiss releases the GIL while
+    training. With `in_process`, `func` runs in a separate process and must be
+    picklable and work on state shared through files.
+    """
+    future = _get_executor(in_process).submit(func, *args)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def _log_failure(future: Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Background index rebuild failed: {future.exception()}")
+
+
+def shutdown():
+    global _executor, _process_executor
+    with _executor_lock:
+        for executor in (_executor, _process_executor):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        _executor = _process_executor = None
@@ -1,17 +1,22 @@
-from .database import SessionLocal
+from .database import get_db
 from .models import Users
 from datetime import datetime, timedelta, timezone
-from typing import Annotated
+from typing import Annotated, Optional
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
-from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2AuthorizationCodeBearer
 from jose import jwt, JWTError
+import hashlib
 import os
+import time
 from dotenv import load_dotenv
 
+from .cache import TTLCache
+from .password_hashing import hash_password, verify_password
+
 # Load environment variables
 load_dotenv()
 
@@ -22,7 +27,9 @@ router = APIRouter(
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
-bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "60"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+_token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
 oauth2_bearer = OAuth2AuthorizationCodeBearer(
     tokenUrl='auth/token',
     authorizationUrl='auth/authorize'
@@ -39,15 +46,7 @@ class Token(BaseModel):
     token_type: str
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
 def create_access_token(username: str, user_id: int, expires_delta: timedelta = timedelta(hours=1)):
@@ -57,57 +56,88 @@ def create_access_token(username: str, user_id: int, expires_delta: timedelta =
     return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def decode_access_token(token: str) -> Optional[dict]:
+    """
+    Verify a JWT and return its {'username', 'id'} claims, or None if it is invalid.
+    Verified tokens are cached by hash until they expire or TOKEN_CACHE_TTL passes.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    claims = _token_cache.get(token_hash)
+    if claims is not None:
+        return claims
+
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username: str = payload.get('sub')
+    user_id: str = payload.get('id')
+    if username is None or user_id is None:
+        return None
+
+    claims = {'username': username, "id": user_id}
+    expires_in = payload.get('exp', time.time() + TOKEN_CACHE_TTL) - time.time()
+    _token_cache.set(token_hash, claims, ttl=expires_in)
+    return claims
+
+
 async def get_current_user(request: Request):
+    # Claims verified by TokenAuthMiddleware for this request
+    claims = getattr(request.state, "user", None)
+    if claims is not None:
+        return claims
+
     token = request.cookies.get("access_token")
     if not token:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not authenticated"
         )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get('sub')
-        user_id: str = payload.get('id')
-        if username is None or user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate user"
-            )
-        return {'username': username, "id": user_id}
-    except JWTError as e:
+    claims = decode_access_token(token)
+    if claims is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate user"
-        ) from e
+        )
+    return claims
 
 
-def authenticate_user(username: str, password: str, db: Annotated[Session, Depends(get_db)]):
-    user = db.query(Users).filter(Users.username == username).first()
-    if not user or not bcrypt_context.verify(password, user.hashed_password):
+async def get_user_by_username(db: AsyncSession, username: str) -> Optional[Users]:
+    result = await db.execute(select(Users).where(Users.username == username))
+    return result.scalars().first()
+
+
+async def authenticate_user(username: str, password: str, db: AsyncSession):
+    user = await get_user_by_username(db, username)
+    if not user:
+        return False
+    valid, new_hash = await verify_password(password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash:
+        # Hash parameters changed since this password was stored
+        user.hashed_password = new_hash
+        await db.commit()
     return user
 
 
 @router.post("/register", status_code=status.HTTP_201_CREATED)
 async def create_user(db: db_dependency, create_user_request: CreateUserRequest):
-    existing_user = db.query(Users).filter(
-        Users.username == create_user_request.username
-    ).first()
+    existing_user = await get_user_by_username(db, create_user_request.username)
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already exists")
     create_user_model = Users(
         username=create_user_request.username,
-        hashed_password=bcrypt_context.hash(create_user_request.password)
+        hashed_password=await hash_password(create_user_request.password)
     )
     db.add(create_user_model)
-    db.commit()
-    db.refresh(create_user_model)
+    await db.commit()
     return {"message": "User created successfully", "username": create_user_model.username}
 
 
 @router.post("/login", response_model=Token)
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: db_dependency, response: Response):
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
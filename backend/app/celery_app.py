@@ -0,0 +1,68 @@
+import os
+
+from celery import Celery
+from celery.signals import worker_process_init
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", CELERY_BROKER_URL)
+
+celery_app = Celery("ai_planet", broker=CELERY_BROKER_URL,
+                    backend=CELERY_RESULT_BACKEND)
+celery_app.conf.update(
+    task_track_started=True,
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+)
+
+
+@worker_process_init.connect
+def load_embedding_models(**kwargs):
+    from .model_registry import preload_models
+    preload_models()
+
+
+@celery_app.task(bind=True, name="ingest_document")
+def ingest_document(self, upload: dict):
+    from .content_refs import release_upload_sync
+    from .ingestion import UploadedFile, remove_spool, run_pipeline
+
+    upload = UploadedFile(**upload)
+    user_id, file_name = upload.user_id, upload.file_name
+
+    def report_stage(stage, timings):
+        self.update_state(state="PROGRESS", meta={
+            "user_id": user_id, "file_name": file_name, "stage": stage, "timings": dict(timings)})
+
+    try:
+        timings = run_pipeline(upload, on_stage=report_stage)
+    finally:
+        remove_spool(upload)
+        # Failed jobs leave no file referencing the content, which is then removed
+        release_upload_sync(upload.content_hash)
+    return {"user_id": user_id, "file_name": file_name, "timings": timings}
+
+
+_STATUSES = {"PENDING": "queued", "STARTED": "running", "PROGRESS": "running",
+             "SUCCESS": "completed", "FAILURE": "failed", "RETRY": "queued"}
+
+
+def get_task_status(task_id: str, file_name: str) -> dict:
+    """Status of an ingestion task; the caller checks that it belongs to the user."""
+    from .ingestion import STAGES
+
+    result = celery_app.AsyncResult(task_id)
+    info = result.info if isinstance(result.info, dict) else {}
+    timings = info.get("timings", {})
+    return {
+        "job_id": task_id,
+        "file_name": file_name,
+        "status": _STATUSES.get(result.state, result.state.lower()),
+        "stage": info.get("stage") if result.state == "PROGRESS" else None,
+        "progress": len([stage for stage in STAGES if stage in timings]) / len(STAGES),
+        "timings": timings,
+        "error": str(result.info) if result.state == "FAILURE" else None,
+    }
@@ -0,0 +1,104 @@
+import os
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import dialect_insert
+from .models import ChatSessions, ChatTurns
+
+# How many recent turns, and roughly how many tokens of them, go into a prompt
+CHAT_HISTORY_MAX_TURNS = int(os.getenv("CHAT_HISTORY_MAX_TURNS", "10"))
+CHAT_HISTORY_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", "1500"))
+# Once a session has this many stored turns, all but the newest
+# CHAT_HISTORY_KEEP_TURNS are folded into the session summary
+CHAT_HISTORY_COMPACT_AFTER = int(os.getenv("CHAT_HISTORY_COMPACT_AFTER", "50"))
+CHAT_HISTORY_KEEP_TURNS = int(os.getenv("CHAT_HISTORY_KEEP_TURNS", "20"))
+CHAT_SUMMARY_MAX_CHARS = int(os.getenv("CHAT_SUMMARY_MAX_CHARS", "2000"))
+# Characters of each question/answer kept in the summary
+SUMMARY_SNIPPET_CHARS = 200
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough estimate, about 4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+async def _get_session(db: AsyncSession, user_id: int, session_id: str) -> Optional[ChatSessions]:
+    result = await db.execute(select(ChatSessions).where(
+        ChatSessions.user_id == user_id, ChatSessions.session_id == session_id))
+    return result.scalars().first()
+
+
+async def _get_or_create_session(db: AsyncSession, user_id: int, session_id: str) -> ChatSessions:
+    chat_session = await _get_session(db, user_id, session_id)
+    if chat_session is None:
+        # Concurrent first turns of a session both get here; only one row is
+        # inserted and the other request reads it back
+        await db.execute(dialect_insert(db, ChatSessions).values(
+            user_id=user_id, session_id=session_id, summary="", turn_count=0,
+        ).on_conflict_do_nothing(index_elements=["user_id", "session_id"]))
+        chat_session = await _get_session(db, user_id, session_id)
+    return chat_session
+
+
+async def get_history(db: AsyncSession, user_id: int, session_id: str,
+                      max_turns: int = CHAT_HISTORY_MAX_TURNS,
+                      max_tokens: int = CHAT_HISTORY_MAX_TOKENS) -> Tuple[str, List[ChatTurns]]:
+    """
+    Return the session summary and the most recent turns, oldest first,
+    limited to `max_turns` and about `max_tokens` tokens.
+    """
+    chat_session = await _get_session(db, user_id, session_id)
+    if chat_session is None:
+        return "", []
+
+    result = await db.execute(select(ChatTurns).where(
+        ChatTurns.user_id == user_id, ChatTurns.session_id == session_id
+    ).order_by(ChatTurns.id.desc()).limit(max_turns))
+    recent_turns = result.scalars().all()
+
+    turns, used_tokens = [], 0
+    for turn in recent_turns:
+        used_tokens += turn.token_count
+        if turns and used_tokens > max_tokens:
+            break
+        turns.append(turn)
+    return chat_session.summary or "", list(reversed(turns))
+
+
+def format_history(summary: str, turns: List[ChatTurns]) -> str:
+    lines = []
+    if summary:
+        lines.append(f"Summary of earlier conversation:\n{summary}")
+    for turn in turns:
+        lines.append(f"UserQuery\n{turn.query}\nResponse\n{turn.response}")
+    return "\n".join(lines)
+
+
+async def append_turn(db: AsyncSession, user_id: int, session_id: str, query: str, response: str):
+    """Store a question/answer pair, compacting the session when it grows too long."""
+    chat_session = await _get_or_create_session(db, user_id, session_id)
+    db.add(ChatTurns(user_id=user_id, session_id=session_id, query=query, response=response,
+                     token_count=estimate_tokens(query) + estimate_tokens(response)))
+    chat_session.turn_count += 1
+    if chat_session.turn_count >= CHAT_HISTORY_COMPACT_AFTER:
+        await db.flush()
+        await _compact(db, chat_session)
+    await db.commit()
+
+
+async def _compact(db: AsyncSession, chat_session: ChatSessions):
+    result = await db.execute(select(ChatTurns).where(
+        ChatTurns.user_id == chat_session.user_id, ChatTurns.session_id == chat_session.session_id
+    ).order_by(ChatTurns.id.desc()).offset(CHAT_HISTORY_KEEP_TURNS))
+    old_turns = result.scalars().all()
+
+    snippets = [f"Q: {turn.query[:SUMMARY_SNIPPET_CHARS]} A: {turn.response[:SUMMARY_SNIPPET_CHARS]}"
+                for turn in reversed(old_turns)]
+    summary = "\n".join(filter(None, [chat_session.summary] + snippets))
+    # Keep the most recent part of the summary within its budget
+    chat_session.summary = summary[-CHAT_SUMMARY_MAX_CHARS:]
+    chat_session.turn_count -= len(old_turns)
+    for turn in old_turns:
+        await db.delete(turn)
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, List
+
+from sqlalchemy import exists, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from .content_store import content_s3_key, delete_artifacts
+from .database import AsyncSessionLocal, SessionLocal, dialect_insert
+from .models import Contents, Files
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# Contents.pending of a content whose object and artifacts are being deleted
+DELETING = -1
+# Values per IN (...) clause, within SQLite's bound parameter limit
+BATCH_SIZE = 500
+
+
+class ContentBeingDeleted(Exception):
+    pass
+
+
+def _batches(values: list, size: int = BATCH_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# Reference counting. A content is in use while a Files row points at it or an
+# upload of it is still being ingested (Contents.pending), so deletes never
+# remove the object or artifacts an in-flight upload relies on.
+
+
+def claim_content(db: Session, content_hash: str, s3_key: str, size: int, content_type: str) -> bool:
+    """
+    Count one more pending upload of a content, adding its row if it is new.
+    Returns True if the row was created, so the caller has to store the object.
+    Raises ContentBeingDeleted while a delete of the same content is running.
+    """
+    result = db.execute(dialect_insert(db, Contents).values(
+        sha256=content_hash, s3_key=s3_key, size=size, content_type=content_type, pending=1,
+    ).on_conflict_do_nothing(index_elements=["sha256"]))
+    if result.rowcount:
+        return True
+    result = db.execute(update(Contents).where(
+        Contents.sha256 == content_hash, Contents.pending >= 0).values(pending=Contents.pending + 1))
+    if not result.rowcount:
+        raise ContentBeingDeleted(content_hash)
+    return False
+
+
+def release_content(db: Session, content_hash: str):
+    """Drop the reference taken by claim_content, once the upload was ingested or failed."""
+    db.execute(update(Contents).where(
+        Contents.sha256 == content_hash, Contents.pending > 0).values(pending=Contents.pending - 1))
+
+
+def mark_unused_contents(db: Session, content_hashes: Iterable[str]) -> List[str]:
+    """Flag the contents nothing refers to any more as being deleted and return their hashes."""
+    unused = []
+    for batch in _batches(list(content_hashes)):
+        result = db.execute(update(Contents).where(
+            Contents.sha256.in_(batch), Contents.pending == 0,
+            ~exists(select(Files.id).where(Files.content_hash == Contents.sha256)),
+        ).values(pending=DELETING).returning(Contents.sha256))
+        unused += result.scalars().all()
+    return unused
+
+
+def forget_contents(db: Session, removed: List[str], kept: List[str]):
+    """Delete the rows of removed contents and make the ones whose object could not be deleted usable again."""
+    for batch in _batches(removed):
+        db.execute(Contents.__table__.delete().where(Contents.sha256.in_(batch)))
+    for batch in _batches(kept):
+        db.execute(update(Contents).where(Contents.sha256.in_(batch)).values(pending=0))
+
+
+def _removed(unused: List[str], storage_errors: Dict[str, str]) -> List[str]:
+    return [content_hash for content_hash in unused if content_s3_key(content_hash) not in storage_errors]
+
+
+async def remove_unused_contents(db: AsyncSession, content_hashes: Iterable[str]) -> Dict[str, str]:
+    """
+    Delete the object, artifacts and row of every given content that no file
+    and no pending upload refers to. Returns an error message per object key
+    that could not be deleted; those contents are kept.
+    """
+    unused = await db.run_sync(mark_unused_contents, content_hashes)
+    await db.commit()
+    if not unused:
+        return {}
+    storage_errors = await get_storage().delete_many([content_s3_key(content_hash) for content_hash in unused])
+    removed = _removed(unused, storage_errors)
+    for content_hash in removed:
+        await run_in_threadpool(delete_artifacts, content_hash)
+    await db.run_sync(forget_contents, removed, [h for h in unused if h not in removed])
+    await db.commit()
+    logger.info(f"Removed {len(removed)} unused contents")
+    return storage_errors
+
+
+async def release_upload(content_hash: str):
+    """Release an upload's reference and remove the content if it was the last one."""
+    async with AsyncSessionLocal() as db:
+        await db.run_sync(release_content, content_hash)
+        await db.commit()
+        storage_errors = await remove_unused_contents(db, [content_hash])
+    if storage_errors:
+        logger.warning(f"Failed to delete unused content {content_hash}: {storage_errors}")
+
+
+def release_upload_sync(content_hash: str):
+    """release_upload for workers that don't run an event loop (celery)."""
+    with SessionLocal() as db:
+        release_content(db, content_hash)
+        unused = mark_unused_contents(db, [content_hash])
+        db.commit()
+        if not unused:
+            return
+        storage_errors = asyncio.run(get_storage().delete_many([content_s3_key(content_hash)]))
+        removed = _removed(unused, storage_errors)
+        for removed_hash in removed:
+            delete_artifacts(removed_hash)
+        forget_contents(db, removed, [h for h in unused if h not in removed])
+        db.commit()
+    if storage_errors:
+        logger.warning(f"Failed to delete unused content {content_hash}: {storage_errors}")
@@ -0,0 +1,172 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+
+from .model_registry import DEFAULT_EMBEDDING_MODEL
+
+logger = logging.getLogger(__name__)
+
+# Parsed and embedded artifacts of every uploaded content, keyed by SHA-256
+CONTENT_STORE_ROOT = os.getenv("CONTENT_STORE_ROOT", "data/content")
+
+EMBEDDINGS_FILE = "embeddings.f32"
+CHUNKS_FILE = "chunks.jsonl"
+# Term counts of every chunk, for the lexical index
+TERMS_FILE = "terms.jsonl"
+# Page number each chunk starts on, null where the format has no pages
+PAGES_FILE = "pages.jsonl"
+METADATA_FILE = "metadata.json"
+
+
+class ChunkFile:
+    """Re-iterable view over a chunks.jsonl (or terms/pages) file that reads one line at a time."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __iter__(self) -> Iterator[str]:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+class ContentArtifacts(NamedTuple):
+    chunks: Iterable[str]
+    embeddings: np.ndarray
+    metadata: Dict[str, str]
+    # None for contents stored before term counts were kept
+    term_counts: Optional[Iterable[Dict[str, int]]] = None
+    # None for contents stored before page numbers were kept
+    page_numbers: Optional[Iterable[Optional[int]]] = None
+
+
+def content_s3_key(content_hash: str) -> str:
+    return f"content/{content_hash}"
+
+
+def artifact_dir(content_hash: str) -> str:
+    return os.path.join(CONTENT_STORE_ROOT, content_hash[:2], content_hash)
+
+
+@contextmanager
+def _locked(content_hash: str):
+    """Exclusive lock on a content's artifacts, so concurrent jobs for the same content swap them in one at a time."""
+    directory = os.path.dirname(artifact_dir(content_hash))
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f".{content_hash}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class ArtifactWriter:
+    """
+    Writes the artifacts of a content incrementally: each batch of chunks and
+    their embeddings is appended to disk as soon as it is computed, so nothing
+    proportional to the document size is kept in memory. The directory only
+    becomes visible to readers on commit().
+    """
+
+    def __init__(self, content_hash: str, model_name: str = DEFAULT_EMBEDDING_MODEL):
+        self.content_hash = content_hash
+        self.directory = artifact_dir(content_hash)
+        self.model_name = model_name
+        self.count = 0
+        self.dimension: Optional[int] = None
+        self._tmp_directory = f"{self.directory}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(self._tmp_directory)
+        self._embeddings = open(os.path.join(self._tmp_directory, EMBEDDINGS_FILE), "wb")
+        self._chunks = open(os.path.join(self._tmp_directory, CHUNKS_FILE), "w", encoding="utf-8")
+        self._terms = open(os.path.join(self._tmp_directory, TERMS_FILE), "w", encoding="utf-8")
+        self._pages = open(os.path.join(self._tmp_directory, PAGES_FILE), "w", encoding="utf-8")
+
+    def append(self, chunks: List[str], embeddings: np.ndarray, term_counts: List[Dict[str, int]],
+               page_numbers: Optional[List[Optional[int]]] = None):
+        embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+        if self.dimension is None:
+            self.dimension = int(embeddings.shape[1])
+        self._embeddings.write(embeddings.tobytes())
+        for chunk in chunks:
+            self._chunks.write(json.dumps(chunk) + "\n")
+        for counts in term_counts:
+            self._terms.write(json.dumps(counts, separators=(",", ":")) + "\n")
+        for page_number in page_numbers or [None] * len(chunks):
+            self._pages.write(json.dumps(page_number) + "\n")
+        self.count += len(chunks)
+
+    def commit(self, metadata: Dict[str, str]):
+        self._embeddings.close()
+        self._chunks.close()
+        self._terms.close()
+        self._pages.close()
+        with open(os.path.join(self._tmp_directory, METADATA_FILE), "w", encoding="utf-8") as f:
+            json.dump({"model": self.model_name, "dimension": self.dimension,
+                       "count": self.count, "metadata": metadata}, f)
+
+        # Swap the complete directory in so readers never see a partial set of files
+        with _locked(self.content_hash):
+            if os.path.exists(self.directory):
+                shutil.rmtree(self.directory, ignore_errors=True)
+            os.replace(self._tmp_directory, self.directory)
+
+    def abort(self):
+        self._embeddings.close()
+        self._chunks.close()
+        self._terms.close()
+        self._pages.close()
+        shutil.rmtree(self._tmp_directory, ignore_errors=True)
+
+
+def save_artifacts(content_hash: str, chunks: List[str], embeddings: np.ndarray,
+                   metadata: Dict[str, str], term_counts: List[Dict[str, int]],
+                   page_numbers: Optional[List[Optional[int]]] = None,
+                   model_name: str = DEFAULT_EMBEDDING_MODEL):
+    """Store the artifacts computed for a content, replacing any previous ones."""
+    writer = ArtifactWriter(content_hash, model_name)
+    try:
+        if len(chunks):
+            writer.append(chunks, embeddings, term_counts, page_numbers)
+        writer.commit(metadata)
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def load_artifacts(content_hash: str, model_name: str = DEFAULT_EMBEDDING_MODEL) -> Optional[ContentArtifacts]:
+    """
+    Return the stored artifacts of a content, or None if missing or embedded
+    with another model. Embeddings are memory-mapped and chunks read lazily.
+    """
+    directory = artifact_dir(content_hash)
+    try:
+        with open(os.path.join(directory, METADATA_FILE), encoding="utf-8") as f:
+            info = json.load(f)
+        if info.get("model") != model_name or "count" not in info:
+            return None
+        if info["count"]:
+            embeddings = np.memmap(os.path.join(directory, EMBEDDINGS_FILE), dtype="float32",
+                                   mode="r", shape=(info["count"], info["dimension"]))
+        else:
+            embeddings = np.zeros((0, info["dimension"] or 0), dtype="float32")
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    terms_path = os.path.join(directory, TERMS_FILE)
+    pages_path = os.path.join(directory, PAGES_FILE)
+    return ContentArtifacts(ChunkFile(os.path.join(directory, CHUNKS_FILE)), embeddings, info["metadata"],
+                            ChunkFile(terms_path) if os.path.exists(terms_path) else None,
+                            ChunkFile(pages_path) if os.path.exists(pages_path) else None)
+
+
+def delete_artifacts(content_hash: str):
+    with _locked(content_hash):
+        shutil.rmtree(artifact_dir(content_hash), ignore_errors=True)
+
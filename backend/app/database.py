@@ -1,9 +1,106 @@
-from sqlalchemy import create_engine
+import os
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-SQLALCHEMY_DATABASE_URL = "postgresql://postgres:yourpassword@ai_planet_db/ai_planet_db"
+from .metrics import instrument_engine
+
+SQLALCHEMY_DATABASE_URL = os.getenv(
+    "DATABASE_URL", "postgresql://postgres:yourpassword@ai_planet_db/ai_planet_db")
+
+# Connection pool tuning, per worker process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def _async_url(url: str):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    url = url.set(drivername=_ASYNC_DRIVERS.get(backend, url.drivername))
+    if url.drivername == "postgresql+asyncpg":
+        # Cache prepared statements per connection so repeated queries skip parsing/planning
+        url = url.update_query_dict(
+            {"prepared_statement_cache_size": str(DB_STATEMENT_CACHE_SIZE)})
+    return url
+
+
+def _sync_url(url: str):
+    url = make_url(url)
+    return url.set(drivername=url.get_backend_name())
+
+
+def _pool_options(pool_size: int, max_overflow: int) -> dict:
+    if make_url(SQLALCHEMY_DATABASE_URL).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+# Async engine used by all API routes
+async_engine = create_async_engine(
+    _async_url(SQLALCHEMY_DATABASE_URL),
+    **_pool_options(DB_POOL_SIZE, DB_MAX_OVERFLOW),
+)
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Sync engine for code that runs outside the event loop (ingestion workers)
+engine = create_engine(_sync_url(SQLALCHEMY_DATABASE_URL), **_pool_options(2, 2))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+instrument_engine(async_engine.sync_engine)
+instrument_engine(engine)
 Base = declarative_base()
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# INSERT constructs supporting ON CONFLICT, by dialect
+_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def dialect_insert(db, table):
+    """INSERT for the session's database, so on_conflict_do_nothing() can be used; sync or async sessions."""
+    return _INSERTS[db.get_bind().dialect.name](table)
+
+
+MIGRATIONS_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+# Revision matching the tables older versions created with create_all()
+BASELINE_REVISION = "0001"
+
+
+def _run_migrations(connection):
+    if connection.dialect.name == "postgresql":
+        # Workers starting together migrate one at a time
+        connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('alembic'))"))
+    config = Config(MIGRATIONS_CONFIG)
+    config.attributes["connection"] = connection
+    tables = set(inspect(connection).get_table_names())
+    if tables and "alembic_version" not in tables:
+        # Databases from before migrations were introduced
+        command.stamp(config, BASELINE_REVISION)
+    command.upgrade(config, "head")
+
+
+async def create_tables():
+    async with async_engine.begin() as connection:
+        await connection.run_sync(_run_migrations)
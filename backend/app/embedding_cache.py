@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from .metrics import EMBEDDING_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite")
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Fraction of entries dropped, least recently used first, when the cache is full
+EMBEDDING_CACHE_EVICT_FRACTION = 0.1
+# SQLite limits the number of bound parameters per statement
+_LOOKUP_BATCH = 500
+
+
+def chunk_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of chunk embeddings keyed by (model name, model version,
+    SHA-256 of the chunk text). Safe to share between processes; each thread
+    uses its own SQLite connection.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    chunk_hash BLOB NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    UNIQUE (model, version, chunk_hash)
+                )""")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used)")
+            self._local.connection = connection
+        return connection
+
+    def get_many(self, model: str, version: str, hashes: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        """Return the cached vectors among `hashes`, looked up in bulk."""
+        connection = self._connection()
+        found: Dict[bytes, np.ndarray] = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        for start in range(0, len(unique_hashes), _LOOKUP_BATCH):
+            batch = unique_hashes[start:start + _LOOKUP_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            rows = connection.execute(
+                f"SELECT chunk_hash, vector FROM embeddings "
+                f"WHERE model = ? AND version = ? AND chunk_hash IN ({placeholders})",
+                [model, version, *batch])
+            for key, vector in rows:
+                found[bytes(key)] = np.frombuffer(vector, dtype="float32")
+
+        if found:
+            with connection:
+                connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND version = ? AND chunk_hash = ?",
+                    [(time.time(), model, version, key) for key in found])
+
+        hits = sum(1 for key in hashes if key in found)
+        with self._stats_lock:
+            self.hits += hits
+            self.misses += len(hashes) - hits
+        EMBEDDING_CACHE_LOOKUPS.labels("hit").inc(hits)
+        EMBEDDING_CACHE_LOOKUPS.labels("miss").inc(len(hashes) - hits)
+        return found
+
+    def put_many(self, model: str, version: str, hashes: Sequence[bytes], vectors: np.ndarray):
+        connection = self._connection()
+        now = time.time()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, version, chunk_hash, vector, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(model, version, key, np.asarray(vector, dtype="float32").tobytes(), now)
+                 for key, vector in zip(hashes, vectors)])
+        self._evict_if_full(connection)
+
+    def _evict_if_full(self, connection: sqlite3.Connection):
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        if (page_count - free_pages) * page_size <= self.max_bytes:
+            return
+
+        total = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        evict = max(1, int(total * EMBEDDING_CACHE_EVICT_FRACTION))
+        with connection:
+            connection.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (evict,))
+        logger.info(f"Evicted {evict} entries from the embedding cache")
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+embedding_cache = EmbeddingCache()
+
+
+def embed_with_cache(texts: List[str], model: str, version: str, embed_fn) -> np.ndarray:
+    """
+    Embed `texts`, reading hits from the cache in bulk and calling
+    `embed_fn(missing_texts)` only for the misses.
+    """
+    hashes = [chunk_hash(text) for text in texts]
+    found = embedding_cache.get_many(model, version, hashes)
+
+    missing = {}
+    for key, text in zip(hashes, texts):
+        if key not in found and key not in missing:
+            missing[key] = text
+    if missing:
+        computed = embed_fn(list(missing.values()))
+        embedding_cache.put_many(model, version, list(missing), computed)
+        found.update(zip(missing, computed))
+
+    return np.vstack([found[key] for key in hashes]).astype("float32", copy=False)
@@ -1,37 +1,49 @@
 from fastapi import UploadFile
-from fastapi import APIRouter, UploadFile, HTTPException, status, Depends
-from typing import Annotated
-from sqlalchemy.orm import Session
-import boto3
+from fastapi import APIRouter, UploadFile, HTTPException, status, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from typing import Annotated, List, Optional, Tuple
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import base64
+import hashlib
+import json
+from email.utils import formatdate, parsedate_to_datetime
 from urllib.parse import unquote
 import os
 from dotenv import load_dotenv
 import logging
 import uuid
-
-from .unstructured_parser import create_embeddings_and_index, parse_document
+from datetime import datetime
+from starlette.concurrency import run_in_threadpool
+
+from .cache import TTLCache
+from .content_refs import ContentBeingDeleted, claim_content, release_upload, remove_unused_contents
+from .content_store import content_s3_key
+from .ingestion import UploadedFile, get_job, ingest_duplicate, submit_job
+from .metrics import LOG_PAYLOADS
+from .storage import ObjectInfo, ObjectNotFound, UploadTooLarge, content_disposition, get_storage, spool_upload
+from .lexical_index import delete_document_terms
+from .vector_store import delete_document_vectors
 from .models import Files, Documents, DocumentMetadata
-from .database import SessionLocal
+from .database import get_db
 from .auth import get_current_user
-from .unstructured_parser import parse_document
 
 # Load environment variables
 load_dotenv()
 
-# AWS S3 configuration
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-AWS_REGION = os.getenv("AWS_REGION")
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 OPEN_API_KEY = os.getenv("OPENAI_API_KEY")
-
-# Boto3 S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION
-)
+PRESIGNED_URL_TTL = int(os.getenv("PRESIGNED_URL_TTL", "3600"))
+# Cached URLs are handed out until this many seconds before they expire
+PRESIGNED_URL_REFRESH_MARGIN = int(os.getenv("PRESIGNED_URL_REFRESH_MARGIN", "300"))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", "10000"))
+MAX_BATCH_DOWNLOAD_FILES = int(os.getenv("MAX_BATCH_DOWNLOAD_FILES", "500"))
+MAX_BULK_DELETE_FILES = int(os.getenv("MAX_BULK_DELETE_FILES", "10000"))
+# Values per IN (...) clause, within SQLite's bound parameter limit
+DELETE_BATCH_SIZE = 500
+_presigned_urls = TTLCache(maxsize=PRESIGNED_URL_CACHE_SIZE,
+                           ttl=PRESIGNED_URL_TTL - PRESIGNED_URL_REFRESH_MARGIN)
 
 router = APIRouter(
     prefix="/files",
@@ -42,110 +54,133 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+user_dependency = Annotated[dict, Depends(get_current_user)]
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
-user_dependency = Annotated[dict, Depends(get_current_user)]
+def _s3_key(file_record, user_id: int) -> str:
+    # Files uploaded before content addressing have no stored key
+    return file_record.s3_key or f"{user_id}/{file_record.file_name}"
 
 
-@router.post("/upload", status_code=status.HTTP_200_OK)
-async def upload_file(file: UploadFile, db: db_dependency, user: user_dependency):
+@router.post("/upload", status_code=status.HTTP_202_ACCEPTED)
+async def upload_file(file: UploadFile, response: Response, db: db_dependency, user: user_dependency):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
 
+    # The spooled file and the content reference are released here unless an
+    # ingestion job takes them over
+    local_file_path, claimed, submitted = None, False, False
     try:
         logger.info("Starting file upload process...")
         logger.info(
             f"Received file: {file.filename}, content type: {file.content_type}")
 
-        # Read the file contents into bytes before uploading
-        file_contents = await file.read()
-        file_size = len(file_contents)
-
-        if file_size == 0:
-            logger.error("Uploaded file is empty.")
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST, detail="Uploaded file is empty")
-
-        logger.info(f"File contents size: {file_size} bytes")
-
         # Create a user-specific directory (e.g., based on user ID)
         # Temporary directory inside the app folder
         user_dir = f"app/tmp/{user['id']}/"
         os.makedirs(user_dir, exist_ok=True)
 
-        # Save the file locally in the user-specific folder
+        # Stream the file to the local spool in fixed-size chunks, hashing it as it goes
         local_file_path = os.path.join(
             user_dir, f"{uuid.uuid4()}_{file.filename}")
-        with open(local_file_path, "wb") as f:
-            f.write(file_contents)
-
-        # Upload the file to S3
-        file_key = f"{user['id']}/{uuid.uuid4()}_{file.filename}"
-        response = s3_client.put_object(
-            Bucket=S3_BUCKET_NAME, Key=file_key, Body=file_contents)
-        logger.info(f"Response from S3: {response}")
-
-        # Generate the file URL from S3
-        file_url = f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{file_key}"
-        logger.info(f"File URL: {file_url}")
-
-        # Save file metadata to DB
-        file_metadata = Files(file_name=file.filename,
-                              file_url=file_url, user_id=user["id"])
-        db.add(file_metadata)
-        db.commit()
-        logger.info("File metadata saved to database.")
-
-        # Parse the document using unstructured.io and generate embeddings
-        parsed_data = parse_document(local_file_path, file.content_type)
-        logger.info(f"Parsed document data: {parsed_data}")
-
-        # Save parsed metadata to DB
-        new_document = Documents(
-            owner_id=user["id"], document_name=file.filename, document_type=file.content_type, s3_url=file_url)
-        db.add(new_document)
-        db.commit()
-        db.refresh(new_document)
-
-        if parsed_data['metadata']:
-            for key, value in parsed_data['metadata'].items():
-                if key and value:  # Ensure metadata key-value pairs are valid
-                    new_metadata = DocumentMetadata(
-                        document_id=new_document.id,
-                        metadata_key=key,
-                        metadata_value=str(value)  # Ensure value is a string
-                    )
-                    db.add(new_metadata)
-            db.commit()
-
-        # Now, generate and index vector embeddings
-        vector_store = create_embeddings_and_index(
-            local_file_path, openai_api_key=OPEN_API_KEY)
-        logger.info("Vector embeddings generated and indexed successfully.")
+        try:
+            file_size, content_hash = await spool_upload(file, local_file_path)
+        except UploadTooLarge as e:
+            logger.error(f"Upload rejected: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
 
-        user_dir = f"app/tmp/{user['id']}/"
-        os.makedirs(user_dir, exist_ok=True)
-        vector_store_path = os.path.join(
-            user_dir, f"{uuid.uuid4()}_vector_store")
-        vector_store = create_embeddings_and_index(local_file_path)
+        if file_size == 0:
+            logger.error("Uploaded file is empty.")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Uploaded file is empty")
 
-        vector_store.save_to_disk(vector_store_path)
-        logger.info(f"Vector store saved at {vector_store_path}")
+        logger.info(f"Spooled {file_size} bytes (sha256 {content_hash})")
+
+        # Files are stored by content, so identical uploads share one S3 object
+        storage = get_storage()
+        file_key = content_s3_key(content_hash)
+        file_url = storage.object_url(file_key)
+        upload = UploadedFile(user_id=user["id"], file_name=file.filename, content_type=file.content_type,
+                              file_url=file_url, s3_key=file_key, content_hash=content_hash,
+                              local_file_path=local_file_path)
+
+        # Reference the content before using it, so a concurrent delete keeps it
+        try:
+            created = await db.run_sync(claim_content, content_hash, file_key, file_size, file.content_type)
+            await db.commit()
+        except ContentBeingDeleted:
+            await db.rollback()
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="The same content is being deleted, try again later")
+        claimed = True
+        # Whether this user uploaded the same content before; other users' uploads aren't disclosed
+        result = await db.execute(select(Files.id).where(
+            Files.user_id == user["id"], Files.content_hash == content_hash).limit(1))
+        deduplicated = result.first() is not None
+        # Release the connection while the file is transferred or processed
+        await db.rollback()
+        if not created:
+            # Reuse the parsed text, metadata and vectors of the earlier upload
+            document_id = await ingest_duplicate(upload)
+            if document_id is not None:
+                logger.info(f"Deduplicated upload of {file.filename} as document {document_id}")
+                response.status_code = status.HTTP_200_OK
+                return {"file_url": file_url, "job_id": None, "deduplicated": deduplicated,
+                        "message": "File uploaded and processed"}
+            # The content is in S3 but hasn't been processed yet, so only ingest it
+        else:
+            await storage.put_file(local_file_path, file_key)
+            logger.info(f"Uploaded {file_key} to storage")
+
+        # Parse, embed and index the document in the background; the file and
+        # document records are written together once that succeeds
+        job_id = await submit_job(upload)
+        submitted = True
+        logger.info(f"Queued ingestion job {job_id}")
 
-        return {"file_url": file_url, "message": "File uploaded, metadata saved, and embeddings indexed successfully"}
+        return {"file_url": file_url, "job_id": job_id, "deduplicated": deduplicated,
+                "message": "File uploaded, processing started"}
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         logger.exception(e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail="An unexpected error occurred")
+    finally:
+        if not submitted:
+            if local_file_path is not None and os.path.exists(local_file_path):
+                os.remove(local_file_path)
+            if claimed:
+                # Removes the object and row again if nothing else uses the content
+                await release_upload(content_hash)
+
+
+@router.get("/jobs/{job_id}", status_code=status.HTTP_200_OK)
+async def get_job_status(job_id: str, user: user_dependency):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+
+    job = await get_job(job_id, user["id"])
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+async def _presigned_url(user_id: int, file_key: str, file_name: str) -> str:
+    # URLs are reused until shortly before they expire instead of signing on every call
+    cache_key = (user_id, file_key, file_name)
+    file_url = _presigned_urls.get(cache_key)
+    if file_url is None:
+        file_url = await get_storage().presigned_url(
+            file_key, expires_in=PRESIGNED_URL_TTL, file_name=file_name)
+        _presigned_urls.set(cache_key, file_url)
+        if LOG_PAYLOADS:
+            logger.debug(f"Pre-signed URL generated: {file_url}")
+    return file_url
 
 
 @router.get("/download/{file_name}", status_code=status.HTTP_200_OK)
@@ -153,56 +188,216 @@ async def get_file_url(file_name: str, db: db_dependency, user: user_dependency)
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
 
-    logger.info(f"Generating pre-signed URL for file: {file_name}")
-
     # Verify the file exists in the database
-    file_record = db.query(Files).filter(
-        Files.file_name == file_name, Files.user_id == user["id"]).first()
+    result = await db.execute(select(Files.file_name, Files.s3_key).where(
+        Files.file_name == file_name, Files.user_id == user["id"]).limit(1))
+    file_record = result.first()
     if not file_record:
         logger.error(f"File not found in database: {file_name}")
         raise HTTPException(
             status_code=404, detail="File not found in database")
 
     try:
-        # Generate the full S3 key for the file
-        file_key = f"{user['id']}/{file_name}"
-
-        # Generate a pre-signed URL for downloading the file
-        file_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET_NAME, 'Key': file_key},
-            ExpiresIn=3600  # URL expires in 1 hour
-        )
-        logger.info(f"Pre-signed URL generated: {file_url}")
-
+        file_url = await _presigned_url(user["id"], _s3_key(file_record, user["id"]), file_record.file_name)
         return {"file_url": file_url}
 
-    except s3_client.exceptions.NoSuchKey:
-        logger.error(f"No such key: {file_key}")
-        raise HTTPException(status_code=404, detail="File not found in S3")
     except Exception as e:
         logger.error(f"Error generating pre-signed URL: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
 
-@router.get("/list", status_code=status.HTTP_200_OK)
-async def list_user_files(db: db_dependency, user: user_dependency):
+class DownloadUrlsRequest(BaseModel):
+    file_names: List[str]
+
+
+@router.post("/download-urls", status_code=status.HTTP_200_OK)
+async def get_file_urls(request: DownloadUrlsRequest, db: db_dependency, user: user_dependency):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+
+    file_names = list(dict.fromkeys(request.file_names))
+    if len(file_names) > MAX_BATCH_DOWNLOAD_FILES:
+        raise HTTPException(status_code=400,
+                            detail=f"At most {MAX_BATCH_DOWNLOAD_FILES} files can be requested at once")
+
+    # One query for all the files instead of one per file
+    result = await db.execute(select(Files.file_name, Files.s3_key).where(
+        Files.user_id == user["id"], Files.file_name.in_(file_names)))
+    file_keys = {}
+    for row in result.all():
+        file_keys.setdefault(row.file_name, _s3_key(row, user["id"]))
+
+    try:
+        file_urls = await asyncio.gather(*(
+            _presigned_url(user["id"], file_key, name) for name, file_key in file_keys.items()))
+    except Exception as e:
+        logger.error(f"Error generating pre-signed URLs: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    return {"files": [{"file_name": name, "file_url": file_url}
+                      for name, file_url in zip(file_keys, file_urls)],
+            "missing": [name for name in file_names if name not in file_keys]}
+
+
+def _opaque_tag(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # Weak comparison, as required for If-None-Match
+    tags = [_opaque_tag(tag.strip()) for tag in header.split(",")]
+    return "*" in tags or _opaque_tag(etag) in tags
+
+
+def _not_modified(request: Request, info: ObjectInfo) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, info.etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(info.last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _requested_range(request: Request, info: ObjectInfo) -> Optional[Tuple[int, int]]:
+    """
+    Return the (start, end) byte range to send, end inclusive, or None to send
+    the whole object. Malformed and multi-part ranges are ignored.
+    """
+    range_header = request.headers.get("range")
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+
+    # Only honour the range if the client's copy is still the current one
+    if_range = request.headers.get("if-range")
+    if if_range:
+        if if_range.startswith(('"', 'W/')):
+            if if_range != info.etag:
+                return None
+        else:
+            try:
+                if int(info.last_modified) > parsedate_to_datetime(if_range).timestamp():
+                    return None
+            except (TypeError, ValueError):
+                return None
+
+    first, _, last = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            start, end = max(0, info.size - int(last)), info.size - 1
+            if not int(last):
+                start = info.size
+        else:
+            start = int(first)
+            end = min(int(last), info.size - 1) if last else info.size - 1
+    except ValueError:
+        return None
+    if start >= info.size or start > end:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{info.size}"})
+    return start, end
+
+
+@router.get("/stream/{file_name}", status_code=status.HTTP_200_OK)
+async def stream_file(file_name: str, request: Request, db: db_dependency, user: user_dependency):
+    """
+    Stream a file through the API instead of redirecting to storage. Supports
+    single byte ranges (resumable downloads), If-Range and conditional GETs.
+    """
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
 
+    result = await db.execute(select(Files.file_name, Files.s3_key).where(
+        Files.file_name == file_name, Files.user_id == user["id"]).limit(1))
+    file_record = result.first()
+    # Release the connection before the possibly long transfer
+    await db.close()
+    if not file_record:
+        raise HTTPException(status_code=404, detail="File not found in database")
+
+    storage = get_storage()
+    file_key = _s3_key(file_record, user["id"])
+    try:
+        info = await storage.stat(file_key)
+    except ObjectNotFound:
+        raise HTTPException(status_code=404, detail="File not found in storage")
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": info.etag,
+        "Last-Modified": formatdate(info.last_modified, usegmt=True),
+        "Content-Disposition": content_disposition(file_record.file_name),
+    }
+    if _not_modified(request, info):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    byte_range = _requested_range(request, info)
+    if byte_range is None:
+        start, end, status_code = 0, info.size - 1, status.HTTP_200_OK
+    else:
+        (start, end), status_code = byte_range, status.HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {start}-{end}/{info.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if info.size == 0:
+        return Response(status_code=status_code, headers=headers, media_type="application/octet-stream")
+
+    return StreamingResponse(storage.iter_range(file_key, start, end), status_code=status_code,
+                             headers=headers, media_type="application/octet-stream")
+
+
+def _encode_cursor(file_name: str, file_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([file_name, file_id]).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, int]:
     try:
-        files = db.query(Files).filter(Files.user_id == user["id"]).all()
-        file_list = [{"file_name": file.file_name,
-                      "file_url": file.file_url,
-                      "s3_key": f"{user['id']}/{file.file_name}"} for file in files]
-        return {"files": file_list}
+        file_name, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(file_name), int(file_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/list", status_code=status.HTTP_200_OK)
+async def list_user_files(request: Request, response: Response, db: db_dependency, user: user_dependency,
+                          limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+
+    # Keyset pagination over (file_name, id), selecting only the listed columns
+    query = select(Files.id, Files.file_name, Files.file_url, Files.s3_key).where(
+        Files.user_id == user["id"])
+    if cursor:
+        last_name, last_id = _decode_cursor(cursor)
+        query = query.where(tuple_(Files.file_name, Files.id) > tuple_(last_name, last_id))
+    query = query.order_by(Files.file_name, Files.id).limit(limit + 1)
 
+    try:
+        rows = (await db.execute(query)).all()
     except Exception as e:
         logger.error(f"Error fetching files: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
+    page = rows[:limit]
+    file_list = [{"file_name": row.file_name,
+                  "file_url": row.file_url,
+                  "s3_key": _s3_key(row, user["id"])} for row in page]
+    next_cursor = _encode_cursor(page[-1].file_name, page[-1].id) if len(rows) > limit else None
+    body = {"files": file_list, "next_cursor": next_cursor}
+
+    etag = '"' + hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest() + '"'
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and _etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return body
+
 
 @router.delete("/delete/{file_name}", status_code=status.HTTP_200_OK)
 async def delete_file(file_name: str, db: db_dependency, user: user_dependency):
@@ -214,8 +409,9 @@ async def delete_file(file_name: str, db: db_dependency, user: user_dependency):
         f"User {user['id']} attempting to delete file: {decoded_file_name}")
 
     # Find the file record in the files table
-    file_record = db.query(Files).filter(
-        Files.file_name == decoded_file_name, Files.user_id == user["id"]).first()
+    result = await db.execute(select(Files).where(
+        Files.file_name == decoded_file_name, Files.user_id == user["id"]))
+    file_record = result.scalars().first()
     if not file_record:
         logger.error(
             f"File not found or does not belong to user: {decoded_file_name}")
@@ -224,42 +420,141 @@ async def delete_file(file_name: str, db: db_dependency, user: user_dependency):
 
     try:
         # Generate the full S3 key for the file
-        file_key = f"{user['id']}/{file_record.file_name}"
-        logger.info(f"Deleting key: {file_key}")
-
-        # Delete the file from S3
-        response = s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=file_key)
-        logger.info(f"Response from S3: {response}")
-
-        # Check if the S3 deletion was successful
-        if response['ResponseMetadata']['HTTPStatusCode'] == 204:
-            logger.info(f"File {file_key} successfully deleted from S3.")
+        file_key = _s3_key(file_record, user["id"])
+        content_hash = file_record.content_hash
+
+        # Delete the file and document records, with the document's metadata
+        result = await db.execute(select(Documents.id).where(
+            Documents.document_name == decoded_file_name, Documents.owner_id == user["id"]).limit(1))
+        document_id = result.scalar()
+        await db.delete(file_record)
+        if document_id is not None:
+            await db.execute(delete(DocumentMetadata).where(DocumentMetadata.document_id == document_id))
+            await db.execute(delete(Documents).where(Documents.id == document_id))
+        await db.commit()
+        _presigned_urls.pop((user["id"], file_key, decoded_file_name))
+        logger.info("File and document metadata deleted from database.")
+
+        if document_id is not None:
+            # Drop the document's vectors and terms from the user's indexes
+            await run_in_threadpool(delete_document_vectors, user["id"], [document_id])
+            await run_in_threadpool(delete_document_terms, user["id"], [document_id])
+
+        if content_hash is not None:
+            # Other files and uploads still being ingested keep using the content
+            storage_errors = await remove_unused_contents(db, [content_hash])
+            if storage_errors:
+                raise RuntimeError(storage_errors[content_s3_key(content_hash)])
         else:
-            logger.warning(
-                f"Failed to delete file {file_key} from S3. Response: {response}")
-            raise HTTPException(
-                status_code=500, detail="Failed to delete file from S3")
-
-        # Delete the file record from the files table
-        db.delete(file_record)
-        db.commit()
-        logger.info("File metadata deleted from files table.")
-
-        # Delete the document record from the documents table
-        document_record = db.query(Documents).filter(
-            Documents.document_name == decoded_file_name, Documents.owner_id == user["id"]).first()
-        if document_record:
-            db.delete(document_record)
-            db.commit()
-            logger.info("Document metadata deleted from documents table.")
+            # Files uploaded before content addressing own their object; failures raise
+            logger.info(f"Deleting key: {file_key}")
+            await get_storage().delete(file_key)
+            logger.info(f"File {file_key} successfully deleted from storage.")
 
         return {"message": "File and document metadata deleted successfully"}
 
-    except s3_client.exceptions.NoSuchKey:
-        logger.error(f"No such key: {file_key}")
-        raise HTTPException(status_code=404, detail="File not found in S3")
     except Exception as e:
         logger.error(f"Error deleting file: {e}")
         logger.exception(e)  # Add this to log the full stack trace
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+class BulkDeleteRequest(BaseModel):
+    file_names: Optional[List[str]] = None
+    # Filters used when no names are given; an empty prefix matches every file
+    name_prefix: Optional[str] = None
+    uploaded_before: Optional[datetime] = None
+
+
+def _batches(values: list, size: int = DELETE_BATCH_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+@router.post("/bulk-delete", status_code=status.HTTP_200_OK)
+async def bulk_delete_files(request: BulkDeleteRequest, db: db_dependency, user: user_dependency):
+    """
+    Delete many files at once, selected by name or by filter. All database rows
+    go in one transaction, the vectors in one index update, and the storage
+    objects through batched deletes. Returns one result per file name.
+    """
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    if request.file_names is None and request.name_prefix is None and request.uploaded_before is None:
+        raise HTTPException(status_code=400, detail="Give file_names, name_prefix or uploaded_before")
+
+    user_id = user["id"]
+    query = select(Files.id, Files.file_name, Files.s3_key, Files.content_hash).where(
+        Files.user_id == user_id)
+    if request.file_names is not None:
+        file_names = list(dict.fromkeys(request.file_names))
+        if len(file_names) > MAX_BULK_DELETE_FILES:
+            raise HTTPException(status_code=400,
+                                detail=f"At most {MAX_BULK_DELETE_FILES} files can be deleted at once")
+        rows = []
+        for batch in _batches(file_names):
+            rows += (await db.execute(query.where(Files.file_name.in_(batch)))).all()
+    else:
+        if request.name_prefix:
+            query = query.where(Files.file_name.startswith(request.name_prefix, autoescape=True))
+        if request.uploaded_before is not None:
+            query = query.where(Files.upload_date < request.uploaded_before)
+        rows = (await db.execute(query.limit(MAX_BULK_DELETE_FILES + 1))).all()
+        if len(rows) > MAX_BULK_DELETE_FILES:
+            raise HTTPException(status_code=400,
+                                detail=f"The filter matches more than {MAX_BULK_DELETE_FILES} files")
+        file_names = list(dict.fromkeys(row.file_name for row in rows))
+
+    found_names = list(dict.fromkeys(row.file_name for row in rows))
+    logger.info(f"User {user_id} bulk deleting {len(rows)} files")
+
+    try:
+        # Documents are linked to their file by name
+        document_ids = []
+        for batch in _batches(found_names):
+            result = await db.execute(select(Documents.id).where(
+                Documents.owner_id == user_id, Documents.document_name.in_(batch)))
+            document_ids += result.scalars().all()
+
+        for batch in _batches(document_ids):
+            await db.execute(delete(DocumentMetadata).where(DocumentMetadata.document_id.in_(batch)))
+            await db.execute(delete(Documents).where(Documents.id.in_(batch)))
+        for batch in _batches([row.id for row in rows]):
+            await db.execute(delete(Files).where(Files.id.in_(batch)))
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Error deleting files: {e}")
+        logger.exception(e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    for row in rows:
+        _presigned_urls.pop((user_id, _s3_key(row, user_id), row.file_name))
+    if document_ids:
+        await run_in_threadpool(delete_document_vectors, user_id, document_ids)
+        await run_in_threadpool(delete_document_terms, user_id, document_ids)
+
+    # Content still used by other files or pending uploads keeps its object
+    content_hashes = list({row.content_hash for row in rows if row.content_hash})
+    storage_errors = await remove_unused_contents(db, content_hashes) if content_hashes else {}
+    # Files uploaded before content addressing own their object
+    keys = sorted({_s3_key(row, user_id) for row in rows if row.content_hash is None})
+    if keys:
+        storage_errors.update(await get_storage().delete_many(keys))
+    if storage_errors:
+        logger.warning(f"Failed to delete {len(storage_errors)} objects from storage")
+
+    found = set(found_names)
+    errors_by_name = {}
+    for row in rows:
+        error = storage_errors.get(_s3_key(row, user_id))
+        if error:
+            errors_by_name[row.file_name] = error
+    results = [
+        {"file_name": name, "status": "deleted", "storage_error": errors_by_name.get(name)}
+        if name in found else {"file_name": name, "status": "not_found"}
+        for name in file_names
+    ]
+    return {"deleted": len(found_names), "results": results}
@@ -0,0 +1,93 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from .ann_index import code_size
+from .lexical_index import UserLexicalIndex
+from .vector_store import UserVectorIndex, load_chunk_pages, load_chunk_texts, manifest_version
+
+logger = logging.getLogger(__name__)
+
+# Memory budget for loaded user indexes and chunk texts, across all users
+INDEX_CACHE_MAX_BYTES = int(os.getenv("INDEX_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+@dataclass
+class CachedUserIndex:
+    index: UserVectorIndex
+    chunks: Dict[int, str]
+    version: int
+    nbytes: int
+    # Page number each chunk starts on, where known
+    pages: Dict[int, int] = field(default_factory=dict)
+    # Kept with the index so its read connection and statistics are reused across searches
+    lexical: Optional[UserLexicalIndex] = None
+
+
+def _estimate_nbytes(index: UserVectorIndex, chunks: Dict[int, str], pages: Dict[int, int]) -> int:
+    vector_bytes = sum(part.ntotal * (code_size(part) + 8) for part in index.indexes)
+    # ~100 bytes per dict entry of two ints
+    return vector_bytes + sum(len(text) for text in chunks.values()) + 100 * len(pages)
+
+
+class UserIndexCache:
+    """
+    Process-level LRU cache of loaded user indexes and their chunk texts.
+    Entries are reloaded when the user's manifest changes and the least
+    recently used users are evicted once the memory budget is exceeded.
+    """
+
+    def __init__(self, max_bytes: int = INDEX_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries: "OrderedDict[int, CachedUserIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[CachedUserIndex]:
+        version = manifest_version(user_id)
+        if version is None:
+            self.invalidate(user_id)
+            return None
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(user_id)
+                return entry
+
+        index = UserVectorIndex.load(user_id)
+        if index is None:
+            return None
+        chunks, pages = load_chunk_texts(user_id), load_chunk_pages(user_id)
+        entry = CachedUserIndex(index, chunks, version, _estimate_nbytes(index, chunks, pages), pages,
+                                UserLexicalIndex(user_id))
+        self._put(user_id, entry)
+        return entry
+
+    def _put(self, user_id: int, entry: CachedUserIndex):
+        with self._lock:
+            previous = self._entries.pop(user_id, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            if entry.nbytes > self.max_bytes:
+                logger.warning(
+                    f"Index of user {user_id} ({entry.nbytes} bytes) exceeds the cache budget, not caching it")
+                return
+            self._entries[user_id] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes:
+                evicted_id, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                logger.info(f"Evicted index of user {evicted_id} from cache")
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self.nbytes -= entry.nbytes
+
+
+index_cache = UserIndexCache()
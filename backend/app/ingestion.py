@@ -0,0 +1,406 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Optional, Set
+
+from fastapi import HTTPException, status
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from .content_refs import release_upload
+from .content_store import ArtifactWriter, ContentArtifacts, load_artifacts
+from .database import AsyncSessionLocal, SessionLocal
+from .embedding_cache import embedding_cache
+from .metrics import CHUNKS_EMBEDDED, INGESTION_JOBS, STAGE_LATENCY
+from . import pdf_parser
+from .model_registry import preload_models
+from .models import Files, Documents, DocumentMetadata, IngestionTasks
+from .lexical_index import add_document_terms, delete_document_terms
+from .unstructured_parser import chunk_term_counts, iter_document_chunks, iter_embedding_batches
+from .vector_store import add_document_vectors, check_chunk_count, delete_document_vectors
+
+logger = logging.getLogger(__name__)
+
+# "process" runs jobs on a local process pool, "celery" hands them to celery workers
+INGESTION_BACKEND = os.getenv("INGESTION_BACKEND", "process")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(min(2, os.cpu_count() or 1))))
+MAX_CONCURRENT_INGEST_JOBS = int(
+    os.getenv("MAX_CONCURRENT_INGEST_JOBS", str(INGEST_WORKERS)))
+MAX_QUEUED_INGEST_JOBS = int(os.getenv("MAX_QUEUED_INGEST_JOBS", "100"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+
+# "index" writes the file/document/metadata rows and the vectors in one transaction
+STAGES = ("parse", "embed", "index")
+
+
+@dataclass
+class IngestionJob:
+    id: str
+    user_id: int
+    file_name: str
+    status: str = "queued"
+    stage: Optional[str] = None
+    timings: Dict[str, float] = field(default_factory=dict)
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        completed = [stage for stage in STAGES if stage in self.timings]
+        return {
+            "job_id": self.id,
+            "file_name": self.file_name,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": len(completed) / len(STAGES),
+            "timings": self.timings,
+            "error": self.error,
+        }
+
+
+_jobs: Dict[str, IngestionJob] = {}
+# Running job tasks; the event loop only keeps weak references to them
+_tasks: Set[asyncio.Task] = set()
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+_job_slots: Optional[asyncio.Semaphore] = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn so workers don't inherit the parent's DB connections and threads;
+            # each worker loads the embedding model once and keeps it warm
+            _executor = ProcessPoolExecutor(
+                max_workers=INGEST_WORKERS,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+            )
+    return _executor
+
+
+def _init_worker():
+    # Every worker parses PDFs on its own pool, so they split the CPUs between them
+    if not pdf_parser.PDF_PARSE_WORKERS:
+        pdf_parser.PDF_PARSE_WORKERS = max(1, (os.cpu_count() or 1) // INGEST_WORKERS)
+    preload_models()
+
+
+def _get_job_slots() -> asyncio.Semaphore:
+    global _job_slots
+    if _job_slots is None:
+        _job_slots = asyncio.Semaphore(MAX_CONCURRENT_INGEST_JOBS)
+    return _job_slots
+
+
+def shutdown():
+    global _executor
+    for task in list(_tasks):
+        task.cancel()
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+@dataclass
+class UploadedFile:
+    user_id: int
+    file_name: str
+    content_type: str
+    file_url: str
+    s3_key: str
+    content_hash: str
+    local_file_path: str
+
+
+def remove_spool(upload: UploadedFile):
+    """Delete an upload's spooled copy once it has been ingested, or failed to."""
+    try:
+        os.remove(upload.local_file_path)
+    except FileNotFoundError:
+        pass
+
+
+# Pipeline stages, shared by the process pool and the celery worker
+
+
+def parse_and_embed(file_path: str, content_type: str, content_hash: str) -> Dict[str, float]:
+    """
+    Stream a document through parse -> chunk -> embed, appending each embedded
+    batch and its term counts to the content's artifacts as soon as it is
+    ready, so peak memory depends on the batch size rather than the document
+    size. Returns the time spent in the parse and embed stages.
+    """
+    metadata: Dict[str, str] = {}
+    parse_seconds = 0.0
+    # Page numbers of the chunks handed out but not written yet
+    page_numbers: List[Optional[int]] = []
+
+    def timed_chunks():
+        nonlocal parse_seconds
+        chunks = iter_document_chunks(file_path, content_type, metadata)
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            parse_seconds += time.perf_counter() - start
+            if chunk is None:
+                return
+            page_numbers.append(chunk[1])
+            yield chunk[0]
+
+    start = time.perf_counter()
+    writer = ArtifactWriter(content_hash)
+    try:
+        for chunks, embeddings in iter_embedding_batches(timed_chunks()):
+            # A batch holds exactly the chunks handed out since the previous one
+            writer.append(chunks, embeddings, chunk_term_counts(chunks), page_numbers[:len(chunks)])
+            del page_numbers[:len(chunks)]
+            # Fail before embedding the rest of a document too large to index
+            check_chunk_count(writer.count)
+        writer.commit(metadata)
+    except BaseException:
+        writer.abort()
+        raise
+    total_seconds = time.perf_counter() - start
+    logger.info(f"Embedded {writer.count} chunks, embedding cache {embedding_cache.stats()}")
+    return {"parse": round(parse_seconds, 4),
+            "embed": round(total_seconds - parse_seconds, 4)}
+
+
+def load_content(content_hash: str) -> ContentArtifacts:
+    artifacts = load_artifacts(content_hash)
+    if artifacts is None:
+        raise RuntimeError(f"Artifacts of content {content_hash} are missing")
+    return artifacts
+
+
+def add_document_records(db: Session, upload: UploadedFile, metadata: Dict[str, str]) -> int:
+    """
+    Add the Files, Documents and DocumentMetadata rows for an upload to the
+    session's transaction and return the new document id.
+    """
+    db.add(Files(file_name=upload.file_name, file_url=upload.file_url, s3_key=upload.s3_key,
+                 content_hash=upload.content_hash, user_id=upload.user_id))
+    new_document = Documents(
+        owner_id=upload.user_id, document_name=upload.file_name,
+        document_type=upload.content_type, s3_url=upload.file_url)
+    db.add(new_document)
+    db.flush()
+
+    metadata_rows = [
+        {"document_id": new_document.id, "metadata_key": key,
+         "metadata_value": str(value)}  # Ensure value is a string
+        for key, value in (metadata or {}).items()
+        if key and value  # Ensure metadata key-value pairs are valid
+    ]
+    if metadata_rows:
+        # A single executemany instead of one INSERT per row
+        db.execute(insert(DocumentMetadata), metadata_rows)
+    return new_document.id
+
+
+def index_document(user_id: int, document_id: int, artifacts: ContentArtifacts):
+    """
+    Add a document's vectors and terms to the user's indexes, or drop whatever
+    was written if that fails.
+    """
+    try:
+        add_document_vectors(user_id, document_id, artifacts.embeddings, artifacts.chunks,
+                             artifacts.page_numbers)
+        # Contents stored before term counts were kept are tokenized now
+        add_document_terms(user_id, document_id,
+                           artifacts.term_counts or chunk_term_counts(artifacts.chunks))
+    except BaseException:
+        unindex_document(user_id, document_id)
+        raise
+
+
+def unindex_document(user_id: int, document_id: int):
+    delete_document_vectors(user_id, [document_id])
+    delete_document_terms(user_id, [document_id])
+
+
+def store_document(upload: UploadedFile, artifacts: ContentArtifacts) -> int:
+    """
+    Write the document records and index it in one transaction. If indexing
+    or the commit fails the records are rolled back and any written vectors
+    and terms are dropped.
+    """
+    document_id = None
+    try:
+        with SessionLocal() as db, db.begin():
+            document_id = add_document_records(db, upload, artifacts.metadata)
+            index_document(upload.user_id, document_id, artifacts)
+    except BaseException:
+        if document_id is not None:
+            # The indexes aren't part of the transaction, so undo them by hand
+            unindex_document(upload.user_id, document_id)
+        raise
+    return document_id
+
+
+async def store_document_async(upload: UploadedFile, artifacts: ContentArtifacts) -> int:
+    """Async twin of store_document for code running on the API's event loop."""
+    document_id = None
+    try:
+        async with AsyncSessionLocal() as db:
+            async with db.begin():
+                document_id = await db.run_sync(add_document_records, upload, artifacts.metadata)
+                await run_in_threadpool(index_document, upload.user_id, document_id, artifacts)
+    except BaseException:
+        if document_id is not None:
+            await run_in_threadpool(unindex_document, upload.user_id, document_id)
+        raise
+    return document_id
+
+
+def record_metrics(timings: Dict[str, float], chunk_count: int, job_status: str):
+    for stage in STAGES:
+        if stage in timings:
+            STAGE_LATENCY.labels(stage).observe(timings[stage])
+    CHUNKS_EMBEDDED.inc(chunk_count)
+    INGESTION_JOBS.labels(job_status).inc()
+
+
+def run_pipeline(upload: UploadedFile,
+                 on_stage: Optional[Callable[[str, Dict[str, float]], None]] = None) -> Dict[str, float]:
+    """
+    Run every stage in the current process and return the per-stage timings.
+    `on_stage` is called before each stage starts.
+    """
+    timings: Dict[str, float] = {}
+    if on_stage:
+        on_stage("parse", timings)
+    timings.update(parse_and_embed(upload.local_file_path, upload.content_type, upload.content_hash))
+
+    if on_stage:
+        on_stage("index", timings)
+    start = time.perf_counter()
+    artifacts = load_content(upload.content_hash)
+    store_document(upload, artifacts)
+    timings["index"] = round(time.perf_counter() - start, 4)
+    record_metrics(timings, len(artifacts.embeddings), "completed")
+    return timings
+
+
+async def ingest_duplicate(upload: UploadedFile) -> Optional[int]:
+    """
+    Add an upload whose content was already ingested by reusing the stored
+    chunks, embeddings and metadata. Returns None when no artifacts exist yet.
+    """
+    artifacts = await run_in_threadpool(load_artifacts, upload.content_hash)
+    if artifacts is None:
+        return None
+    return await store_document_async(upload, artifacts)
+
+
+# Job submission and status
+
+
+def _prune_finished_jobs():
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    for job_id in [job_id for job_id, job in _jobs.items()
+                   if job.finished_at and job.finished_at < cutoff]:
+        del _jobs[job_id]
+
+
+async def _run_stage(job: IngestionJob, stage: str, awaitable):
+    job.stage = stage
+    start = time.perf_counter()
+    result = await awaitable
+    job.timings[stage] = round(time.perf_counter() - start, 4)
+    return result
+
+
+async def _run_job(job: IngestionJob, upload: UploadedFile):
+    async with _get_job_slots():
+        job.status = "running"
+        loop = asyncio.get_running_loop()
+        executor = _get_executor()
+        chunk_count = 0
+        try:
+            # Parsing and embedding are interleaved in the worker, which reports both timings
+            job.stage = "parse"
+            job.timings.update(await loop.run_in_executor(
+                executor, parse_and_embed, upload.local_file_path, upload.content_type,
+                upload.content_hash))
+            artifacts = await run_in_threadpool(load_content, upload.content_hash)
+            chunk_count = len(artifacts.embeddings)
+            await _run_stage(job, "index", store_document_async(upload, artifacts))
+            job.status = "completed"
+            logger.info(f"Ingestion job {job.id} completed: {job.timings}")
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            logger.warning(f"Ingestion job {job.id} cancelled in stage {job.stage}")
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.error(f"Ingestion job {job.id} failed in stage {job.stage}: {e}")
+            logger.exception(e)
+        finally:
+            record_metrics(job.timings, chunk_count, job.status)
+            job.stage = None
+            job.finished_at = time.time()
+            remove_spool(upload)
+            # Failed jobs leave no file referencing the content, which is then removed
+            await _release_upload(upload)
+
+
+async def _release_upload(upload: UploadedFile):
+    try:
+        await asyncio.shield(release_upload(upload.content_hash))
+    except Exception as e:
+        logger.error(f"Failed to release content {upload.content_hash}: {e}")
+
+
+async def submit_job(upload: UploadedFile) -> str:
+    """
+    Queue the parse -> embed -> index pipeline for an uploaded file and return the job id.
+    """
+    if INGESTION_BACKEND == "celery":
+        from .celery_app import ingest_document
+        task_id = str(uuid.uuid4())
+        # The owner is stored before the task exists, so every status lookup can be checked
+        async with AsyncSessionLocal() as db:
+            async with db.begin():
+                db.add(IngestionTasks(id=task_id, user_id=upload.user_id, file_name=upload.file_name))
+        ingest_document.apply_async((asdict(upload),), task_id=task_id)
+        return task_id
+
+    _prune_finished_jobs()
+    pending = sum(1 for job in _jobs.values() if job.status in ("queued", "running"))
+    if pending >= MAX_QUEUED_INGEST_JOBS:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many documents are being processed, try again later")
+
+    job = IngestionJob(id=str(uuid.uuid4()), user_id=upload.user_id, file_name=upload.file_name)
+    _jobs[job.id] = job
+    task = asyncio.get_running_loop().create_task(_run_job(job, upload))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return job.id
+
+
+async def get_job(job_id: str, user_id: int) -> Optional[dict]:
+    if INGESTION_BACKEND == "celery":
+        from .celery_app import get_task_status
+        async with AsyncSessionLocal() as db:
+            task = await db.get(IngestionTasks, job_id)
+        if task is None or task.user_id != user_id:
+            return None
+        return await run_in_threadpool(get_task_status, job_id, task.file_name)
+
+    job = _jobs.get(job_id)
+    if job is None or job.user_id != user_id:
+        return None
+    return job.to_dict()
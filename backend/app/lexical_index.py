@@ -0,0 +1,371 @@
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+from contextlib import closing
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .vector_store import CHUNK_ID_BITS, check_chunk_count, user_index_dir
+
+logger = logging.getLogger(__name__)
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# A query term is selective if it occurs in at most this fraction of the chunks ...
+LEXICAL_PREFILTER_MAX_FRACTION = float(os.getenv("LEXICAL_PREFILTER_MAX_FRACTION", "0.01"))
+# ... and the dense search is restricted to the chunks of the selective terms if there are at most this many
+LEXICAL_PREFILTER_MAX_CANDIDATES = int(os.getenv("LEXICAL_PREFILTER_MAX_CANDIDATES", "2000"))
+# Results taken from each ranking before reciprocal rank fusion, and the RRF constant
+HYBRID_DEPTH = int(os.getenv("HYBRID_DEPTH", "50"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+LEXICAL_STORE = "lexical.sqlite"
+
+# Words, numbers and identifiers such as "AB-1234", "v1.2" or "user_id" are kept whole
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-/][a-z0-9]+)*")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i if in into is it its of on or "
+    "that the their there these this to was what when where which who why will with".split())
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN_PATTERN.findall(text.lower()) if token not in _STOPWORDS]
+
+
+def count_terms(text: str) -> Dict[str, int]:
+    return dict(Counter(tokenize(text)))
+
+
+def encode_varints(values: Iterable[int]) -> bytes:
+    """LEB128 encoding: 7 bits per byte, high bit set on all but the last byte of a value."""
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append(value & 0x7F | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varints(data: bytes) -> np.ndarray:
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if raw.size == 0:
+        return np.empty(0, dtype="int64")
+    ends = np.flatnonzero(raw < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = np.arange(raw.size) - np.repeat(starts, ends - starts + 1)
+    return np.add.reduceat((raw & 0x7F).astype("int64") << (7 * shifts), starts)
+
+
+def encode_postings(chunk_numbers: List[int], counts: List[int]) -> bytes:
+    """Chunk numbers (ascending) as deltas, interleaved with their term counts."""
+    deltas = np.diff(np.asarray(chunk_numbers, dtype="int64"), prepend=0)
+    return encode_varints(value for pair in zip(deltas.tolist(), counts) for value in pair)
+
+
+def decode_postings(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    values = decode_varints(data)
+    return np.cumsum(values[0::2]), values[1::2]
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], k: int, rrf_k: int = RRF_K
+                           ) -> Tuple[np.ndarray, np.ndarray]:
+    """Fuse id rankings (best first, -1 for no result) and return the top k (ids, scores)."""
+    scores: Dict[int, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, item in enumerate(ranking.tolist()):
+            if item >= 0:
+                scores[item] += 1.0 / (rrf_k + rank + 1)
+    best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+    return (np.array([item for item, _ in best], dtype="int64"),
+            np.array([score for _, score in best], dtype="float32"))
+
+
+# (query vectors, k, candidate ids or None) -> (distances, ids), e.g. UserVectorIndex.search
+DenseSearch = Callable[[np.ndarray, int, Optional[np.ndarray]], Tuple[np.ndarray, np.ndarray]]
+
+
+def hybrid_search(lexical: "LexicalIndex", dense_search: DenseSearch, queries: List[str],
+                  query_vectors: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Rank chunks for every query by fusing its BM25 and vector rankings with
+    reciprocal rank fusion, returning (ids, scores) per query. Queries with
+    selective terms only search the vectors of the chunks containing them;
+    the others share one batched dense search.
+    """
+    depth = max(k, HYBRID_DEPTH)
+    # Each query's postings are read once, for both the pre-filter and BM25
+    postings = [lexical.query_postings(query) for query in queries]
+    candidates = [lexical.candidates(query, postings[i]) for i, query in enumerate(queries)]
+    dense_ids: List[Optional[np.ndarray]] = [None] * len(queries)
+    broad = [i for i, candidate_ids in enumerate(candidates) if candidate_ids is None]
+    if broad:
+        _, ids = dense_search(query_vectors[broad], depth, None)
+        for i, row in zip(broad, ids):
+            dense_ids[i] = row
+    for i, candidate_ids in enumerate(candidates):
+        if candidate_ids is not None:
+            dense_ids[i] = dense_search(query_vectors[i:i + 1], depth, candidate_ids)[1][0]
+
+    return [reciprocal_rank_fusion([lexical.search(query, depth, postings[i])[1], dense_ids[i]], k)
+            for i, query in enumerate(queries)]
+
+
+class LexicalIndex(ABC):
+    """
+    BM25 ranking over chunks. Subclasses provide the postings (chunk ids and
+    term counts) of a term, the token count of chunks and corpus statistics.
+    """
+
+    @abstractmethod
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        ...
+
+    def query_postings(self, query: str) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Postings of every distinct term of the query."""
+        return {term: self.postings(term) for term in set(tokenize(query))}
+
+    def document_frequencies(self, terms: List[str]) -> Dict[str, int]:
+        return {term: len(self.postings(term)[0]) for term in terms}
+
+    @abstractmethod
+    def chunk_lengths(self, ids: np.ndarray) -> np.ndarray:
+        ...
+
+    @abstractmethod
+    def stats(self) -> Tuple[int, float]:
+        """Number of chunks and their average length in tokens."""
+
+    def search(self, query: str, k: int,
+               postings: Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]] = None
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The top k chunk ids for the query by BM25 score, as (scores, ids).
+        `postings` are the query's postings if already read (see query_postings).
+        """
+        chunk_count, average_length = self.stats()
+        if postings is None:
+            postings = self.query_postings(query)
+        matches = [(ids, counts) for ids, counts in postings.values() if ids.size]
+        if not matches or not chunk_count:
+            return np.empty(0, dtype="float32"), np.empty(0, dtype="int64")
+
+        ids = np.concatenate([ids for ids, _ in matches])
+        counts = np.concatenate([counts for _, counts in matches]).astype("float64")
+        idf = np.concatenate([
+            np.full(len(term_ids), math.log(1 + (chunk_count - len(term_ids) + 0.5) / (len(term_ids) + 0.5)))
+            for term_ids, _ in matches])
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        lengths = self.chunk_lengths(unique_ids)[inverse]
+        partial = idf * counts * (BM25_K1 + 1) / (
+            counts + BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(average_length, 1e-9)))
+        scores = np.bincount(inverse, weights=partial)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return scores[top].astype("float32"), unique_ids[top]
+
+    def candidates(self, query: str,
+                   postings: Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]] = None) -> Optional[np.ndarray]:
+        """
+        Ids of the chunks containing a selective query term (one found in at
+        most LEXICAL_PREFILTER_MAX_FRACTION of the chunks), or None if the query
+        has no such term or they match more than LEXICAL_PREFILTER_MAX_CANDIDATES chunks.
+        Without the query's `postings` only the frequent terms' counts are read.
+        """
+        chunk_count, _ = self.stats()
+        if postings is not None:
+            frequencies = {term: len(ids) for term, (ids, _) in postings.items()}
+        else:
+            postings = {}
+            frequencies = self.document_frequencies(list(set(tokenize(query))))
+        selective = [term for term, frequency in frequencies.items()
+                     if 0 < frequency <= chunk_count * LEXICAL_PREFILTER_MAX_FRACTION]
+        if not selective or sum(frequencies[term] for term in selective) > LEXICAL_PREFILTER_MAX_CANDIDATES:
+            return None
+        return np.unique(np.concatenate([
+            (postings[term] if term in postings else self.postings(term))[0] for term in selective]))
+
+
+class MemoryLexicalIndex(LexicalIndex):
+    """Append-only in-memory index, for DocumentSearch; chunk ids are insertion positions."""
+
+    def __init__(self):
+        self._postings: Dict[str, Tuple[List[int], List[int]]] = defaultdict(lambda: ([], []))
+        self._lengths: List[int] = []
+
+    def add(self, texts: Iterable[str]):
+        for text in texts:
+            chunk_id = len(self._lengths)
+            term_counts = count_terms(text)
+            for term, count in term_counts.items():
+                ids, counts = self._postings[term]
+                ids.append(chunk_id)
+                counts.append(count)
+            self._lengths.append(sum(term_counts.values()))
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        ids, counts = self._postings.get(term, ([], []))
+        return np.array(ids, dtype="int64"), np.array(counts, dtype="int64")
+
+    def chunk_lengths(self, ids: np.ndarray) -> np.ndarray:
+        return np.asarray(self._lengths, dtype="float64")[ids]
+
+    def stats(self) -> Tuple[int, float]:
+        return len(self._lengths), (sum(self._lengths) / len(self._lengths) if self._lengths else 0.0)
+
+
+def _connect(directory: str) -> sqlite3.Connection:
+    """Open a user's lexical store for writing, creating it and its tables if needed."""
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(directory, LEXICAL_STORE))
+    # One row per (term, document) holding the encoded postings of the document's chunks
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, document_id INTEGER NOT NULL, "
+        "chunks INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (term, document_id)) WITHOUT ROWID")
+    connection.execute("CREATE INDEX IF NOT EXISTS postings_document ON postings (document_id)")
+    # Per document: chunk count, total tokens and the encoded token count of every chunk
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS documents (document_id INTEGER PRIMARY KEY, "
+        "chunks INTEGER NOT NULL, tokens INTEGER NOT NULL, lengths BLOB NOT NULL)")
+    return connection
+
+
+class UserLexicalIndex(LexicalIndex):
+    """
+    A user's on-disk BM25 index next to their vector index, in SQLite.
+    Postings are stored per (term, document) as delta + varint encoded chunk
+    numbers and term counts, so adding or deleting a document only touches
+    that document's rows. Chunk ids are the vector ids (see vector_store).
+    Reads share one connection, so an instance is meant to be kept (see
+    index_cache); its cached statistics are dropped when the store changes.
+    """
+
+    def __init__(self, user_id: int):
+        self.directory = user_index_dir(user_id)
+        self._stats: Optional[Tuple[int, float]] = None
+        self._lengths: Dict[int, np.ndarray] = {}
+        self._connection: Optional[sqlite3.Connection] = None
+        self._data_version: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.directory, LEXICAL_STORE))
+
+    def _query(self, sql: str, parameters: Iterable = ()) -> list:
+        with self._lock:
+            if self._connection is None:
+                # Read-only, the tables are created by the first add_document_terms
+                uri = Path(self.directory, LEXICAL_STORE).absolute().as_uri()
+                self._connection = sqlite3.connect(f"{uri}?mode=ro", uri=True, check_same_thread=False)
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def _refresh(self):
+        data_version = self._query("PRAGMA data_version")[0][0]
+        if data_version != self._data_version:
+            # Documents were added or deleted through another connection since the last search
+            self._stats, self._lengths = None, {}
+            self._data_version = data_version
+
+    def _decode(self, rows) -> Tuple[np.ndarray, np.ndarray]:
+        if not rows:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="int64")
+        ids, counts = [], []
+        for document_id, data in rows:
+            chunk_numbers, chunk_counts = decode_postings(data)
+            ids.append((np.int64(document_id) << CHUNK_ID_BITS) + chunk_numbers)
+            counts.append(chunk_counts)
+        return np.concatenate(ids), np.concatenate(counts)
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        return self._decode(self._query("SELECT document_id, data FROM postings WHERE term = ?", (term,)))
+
+    def query_postings(self, query: str) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        terms = list(set(tokenize(query)))
+        if not terms:
+            return {}
+        rows: Dict[str, list] = defaultdict(list)
+        for term, document_id, data in self._query(
+                f"SELECT term, document_id, data FROM postings WHERE term IN ({','.join('?' * len(terms))})",
+                terms):
+            rows[term].append((document_id, data))
+        return {term: self._decode(rows.get(term)) for term in terms}
+
+    def document_frequencies(self, terms: List[str]) -> Dict[str, int]:
+        if not terms:
+            return {}
+        rows = self._query(
+            f"SELECT term, SUM(chunks) FROM postings WHERE term IN ({','.join('?' * len(terms))}) "
+            "GROUP BY term", terms)
+        frequencies = dict.fromkeys(terms, 0)
+        frequencies.update(rows)
+        return frequencies
+
+    def chunk_lengths(self, ids: np.ndarray) -> np.ndarray:
+        document_ids = ids >> CHUNK_ID_BITS
+        missing = [document_id for document_id in np.unique(document_ids).tolist()
+                   if document_id not in self._lengths]
+        for batch_start in range(0, len(missing), 500):
+            batch = missing[batch_start:batch_start + 500]
+            rows = self._query(
+                f"SELECT document_id, lengths FROM documents WHERE document_id IN "
+                f"({','.join('?' * len(batch))})", batch)
+            self._lengths.update((document_id, decode_varints(data)) for document_id, data in rows)
+        chunk_numbers = ids & ((1 << CHUNK_ID_BITS) - 1)
+        lengths = np.zeros(ids.size, dtype="float64")
+        unique_documents, inverse = np.unique(document_ids, return_inverse=True)
+        groups = np.split(np.argsort(inverse, kind="stable"), np.cumsum(np.bincount(inverse))[:-1])
+        for document_id, positions in zip(unique_documents.tolist(), groups):
+            if document_id in self._lengths:
+                lengths[positions] = self._lengths[document_id][chunk_numbers[positions]]
+        return lengths
+
+    def stats(self) -> Tuple[int, float]:
+        self._refresh()
+        if self._stats is None:
+            chunks, tokens = self._query(
+                "SELECT COALESCE(SUM(chunks), 0), COALESCE(SUM(tokens), 0) FROM documents")[0]
+            self._stats = (chunks, tokens / chunks if chunks else 0.0)
+        return self._stats
+
+
+def add_document_terms(user_id: int, document_id: int, chunk_term_counts: Iterable[Dict[str, int]]):
+    """Index the term counts of a document's chunks, in chunk order, for BM25 search."""
+    postings: Dict[str, Tuple[List[int], List[int]]] = defaultdict(lambda: ([], []))
+    lengths = []
+    for chunk_number, term_counts in enumerate(chunk_term_counts):
+        for term, count in term_counts.items():
+            chunk_numbers, counts = postings[term]
+            chunk_numbers.append(chunk_number)
+            counts.append(count)
+        lengths.append(sum(term_counts.values()))
+    check_chunk_count(len(lengths))
+
+    with closing(_connect(user_index_dir(user_id))) as connection, connection:
+        connection.execute("DELETE FROM postings WHERE document_id = ?", (document_id,))
+        connection.executemany(
+            "INSERT INTO postings (term, document_id, chunks, data) VALUES (?, ?, ?, ?)",
+            ((term, document_id, len(chunk_numbers), encode_postings(chunk_numbers, counts))
+             for term, (chunk_numbers, counts) in postings.items()))
+        connection.execute(
+            "INSERT OR REPLACE INTO documents (document_id, chunks, tokens, lengths) VALUES (?, ?, ?, ?)",
+            (document_id, len(lengths), sum(lengths), encode_varints(lengths)))
+    logger.info(f"Indexed {len(postings)} terms of document {document_id} for user {user_id}")
+
+
+def delete_document_terms(user_id: int, document_ids: Iterable[int]):
+    document_ids = [int(document_id) for document_id in document_ids]
+    directory = user_index_dir(user_id)
+    if not document_ids or not os.path.exists(os.path.join(directory, LEXICAL_STORE)):
+        return
+    with closing(_connect(directory)) as connection, connection:
+        for batch_start in range(0, len(document_ids), 500):
+            batch = document_ids[batch_start:batch_start + 500]
+            placeholders = ",".join("?" * len(batch))
+            connection.execute(f"DELETE FROM postings WHERE document_id IN ({placeholders})", batch)
+            connection.execute(f"DELETE FROM documents WHERE document_id IN ({placeholders})", batch)
@@ -1,14 +1,14 @@
 from fastapi import FastAPI, Depends
 from fastapi import FastAPI, status, Depends, HTTPException
 from typing import Annotated
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from .database import SessionLocal, engine
 from . import auth, models, file_upload
 from .auth import get_current_user
-from .database import engine, SessionLocal, Base
+from .database import create_tables, get_db
 from .middleware import TokenAuthMiddleware
-from . import rag_integration
+from . import rag_integration, ingestion, metrics, ann_index, pdf_parser
+from .model_registry import preload_models
 
 app = FastAPI()
 
@@ -16,26 +16,38 @@ app = FastAPI()
 app.include_router(auth.router)
 app.include_router(file_upload.router)
 app.include_router(rag_integration.router)
+app.include_router(metrics.router)
 
-# Add middleware
+# Add middleware; the last one added runs first, so request timing covers authentication
 app.add_middleware(TokenAuthMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
 
-# Dependency to get a database session
+@app.on_event("startup")
+def configure_logging():
+    metrics.configure_logging()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+@app.on_event("startup")
+async def create_database_tables():
+    await create_tables()
+
+
+@app.on_event("startup")
+def load_embedding_models():
+    # Load the embedding models once per worker instead of once per upload
+    preload_models()
+
+
+@app.on_event("shutdown")
+def stop_ingestion_workers():
+    ingestion.shutdown()
+    ann_index.shutdown()
+    pdf_parser.shutdown()
 
 
 # Annotated dependencies
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
 
@@ -0,0 +1,157 @@
+import hmac
+import logging
+import os
+import random
+import re
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess, REGISTRY)
+from sqlalchemy import event
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+# Fraction of requests whose trace id is written to the logs
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+# Log full payloads (S3 responses, presigned URLs, ...) at debug level
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "false").lower() == "true"
+# Bearer token Prometheus sends to scrape /metrics; without one the endpoint
+# needs a logged-in user like any other route
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Set to aggregate metrics of several gunicorn workers (see prometheus_client docs)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route",
+    ["method", "route", "status"])
+S3_LATENCY = Histogram(
+    "s3_operation_duration_seconds", "S3 call latency by operation", ["operation"])
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "Database statement latency by statement type", ["statement"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+STAGE_LATENCY = Histogram(
+    "ingestion_stage_duration_seconds", "Ingestion stage latency", ["stage"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+CHUNKS_EMBEDDED = Counter("ingestion_chunks_embedded_total", "Chunks embedded by ingestion jobs")
+INGESTION_JOBS = Counter("ingestion_jobs_total", "Finished ingestion jobs", ["status"])
+EMBEDDING_CACHE_LOOKUPS = Counter(
+    "embedding_cache_lookups_total", "Chunk embedding cache lookups", ["result"])
+INDEX_LATENCY = Histogram(
+    "vector_index_duration_seconds", "Vector index latency by operation", ["operation"])
+LLM_LATENCY = Histogram(
+    "llm_request_duration_seconds", "LLM call latency", ["outcome"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+_STATEMENT_TYPES = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+# X-Request-ID values accepted as trace ids, since they end up in headers and logs
+_REQUEST_ID = re.compile(r"[A-Za-z0-9._-]{1,128}")
+_trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", include_in_schema=False)
+def metrics(request: Request):
+    if METRICS_TOKEN and not hmac.compare_digest(
+            request.headers.get("authorization", "").encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+def current_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+class TraceIdFilter(logging.Filter):
+    """Prefix records logged while handling a sampled request with its trace id."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace_id = _trace_id.get()
+        if trace_id and not getattr(record, "trace_id", None):
+            record.trace_id = trace_id
+            record.msg = f"[trace {trace_id}] {record.msg}"
+        return True
+
+
+def configure_logging():
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, TraceIdFilter) for f in handler.filters):
+            handler.addFilter(TraceIdFilter())
+
+
+def _route_template(app, scope) -> str:
+    # Label by the route's path template so ids in URLs don't explode cardinality
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", scope["path"])
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request by route and attaches a trace id to it. The id is
+    taken from an incoming X-Request-ID header if it is a short token, or
+    generated, returned in X-Trace-Id, and added to log lines for a
+    TRACE_SAMPLE_RATE sample of requests.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        trace_id = headers.get(b"x-request-id", b"").decode("latin-1")
+        if not _REQUEST_ID.fullmatch(trace_id):
+            trace_id = uuid.uuid4().hex[:16]
+        sampled = random.random() < TRACE_SAMPLE_RATE
+        token = _trace_id.set(trace_id if sampled else None)
+        status_code = 500
+
+        async def send_with_trace(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-trace-id", trace_id.encode("latin-1"))]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = _route_template(scope["app"], scope) if "app" in scope else "unmatched"
+            REQUEST_LATENCY.labels(scope["method"], route, str(status_code)).observe(elapsed)
+            if sampled:
+                logger.info(f"{scope['method']} {scope['path']} {status_code} in {elapsed * 1000:.1f}ms")
+            _trace_id.reset(token)
+
+
+def instrument_engine(engine):
+    """Time every statement run on a (sync) SQLAlchemy engine."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None) if context is not None else None
+        if start is not None:
+            verb = statement.lstrip()[:6].upper()
+            DB_QUERY_LATENCY.labels(verb if verb in _STATEMENT_TYPES else "OTHER").observe(
+                time.perf_counter() - start)
@@ -1,44 +1,85 @@
-from fastapi import HTTPException, Request
-from starlette.middleware.base import BaseHTTPMiddleware
-from jose import jwt, JWTError
 import logging
 import os
+import re
+from typing import Iterable, Optional
+
+from starlette.requests import cookie_parser
+from starlette.responses import JSONResponse
+
+from .auth import decode_access_token
+from .metrics import METRICS_TOKEN
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
+# Paths reachable without a token, matched exactly (a trailing slash is ignored)
+PUBLIC_PATHS = ["/auth/login", "/auth/register", "/auth/logout"]
+if METRICS_TOKEN:
+    # Scrapers authenticate with the metrics token instead
+    PUBLIC_PATHS.append("/metrics")
+# Comma separated path prefixes reachable without a token, e.g. "/docs,/openapi.json"
+PUBLIC_PATH_PREFIXES = [prefix.strip() for prefix in os.getenv("PUBLIC_PATH_PREFIXES", "").split(",")
+                        if prefix.strip()]
+
+
+class PublicRouteMatcher:
+    """
+    Precompiled check for public paths: a set lookup for exact paths and one
+    regex for prefixes. A prefix only matches whole path segments, so "/docs"
+    matches "/docs" and "/docs/oauth2-redirect" but not "/docsecret".
+    """
+
+    def __init__(self, paths: Iterable[str], prefixes: Iterable[str] = ()):
+        self.paths = frozenset(path.rstrip("/") or "/" for path in paths)
+        prefixes = [prefix.rstrip("/") for prefix in prefixes if prefix.rstrip("/")]
+        self.prefix_pattern: Optional[re.Pattern] = re.compile(
+            "(?:" + "|".join(re.escape(prefix) for prefix in prefixes) + ")(?:/|$)") if prefixes else None
+
+    def __call__(self, path: str) -> bool:
+        if (path.rstrip("/") or "/") in self.paths:
+            return True
+        return self.prefix_pattern is not None and self.prefix_pattern.match(path) is not None
 
 
-class TokenAuthMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        public_routes = ["/auth/login", "/auth/register", "/auth"]
-        if any(request.url.path.startswith(route) for route in public_routes):
-            return await call_next(request)
+def _get_cookie(scope, name: str) -> Optional[str]:
+    for key, value in scope["headers"]:
+        if key == b"cookie":
+            return cookie_parser(value.decode("latin-1")).get(name)
+    return None
 
-        token = request.cookies.get("access_token")
+
+class TokenAuthMiddleware:
+    """
+    Raw ASGI middleware that rejects requests to non-public paths without a
+    valid access_token cookie with a 401 response. The verified claims are
+    stored in the request state for get_current_user; the request and response
+    streams are passed through untouched.
+    """
+
+    def __init__(self, app, public_paths: Iterable[str] = PUBLIC_PATHS,
+                 public_prefixes: Iterable[str] = PUBLIC_PATH_PREFIXES):
+        self.app = app
+        self.is_public = PublicRouteMatcher(public_paths, public_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.is_public(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        token = _get_cookie(scope, "access_token")
         if not token:
             logger.warning("Authorization token is missing.")
-            raise HTTPException(
-                status_code=401, detail="Authorization token is missing")
+            await JSONResponse({"detail": "Authorization token is missing"}, status_code=401)(
+                scope, receive, send)
+            return
 
-        if not self.validate_token(token):
+        claims = decode_access_token(token)
+        if claims is None:
             logger.warning("Invalid or expired token.")
-            raise HTTPException(
-                status_code=401, detail="Invalid or expired token")
-
-        try:
-            response = await call_next(request)
-            return response
-        except Exception as e:
-            logger.error(f"Error processing request: {e}")
-            raise e
-
-    def validate_token(self, token: str) -> bool:
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            return True
-        except JWTError as e:
-            logger.error(f"JWT error: {e}")
-            return False
+            await JSONResponse({"detail": "Invalid or expired token"}, status_code=401)(
+                scope, receive, send)
+            return
+
+        # Dependencies read the verified claims instead of decoding the token again
+        scope.setdefault("state", {})["user"] = claims
+        await self.app(scope, receive, send)
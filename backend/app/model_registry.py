@@ -0,0 +1,87 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import spacy
+
+from .embedding_cache import EMBEDDING_CACHE_ENABLED, embed_with_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "en_core_web_md")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Comma separated list of models to load at startup, empty to load lazily
+PRELOAD_EMBEDDING_MODELS = [
+    name.strip() for name in os.getenv(
+        "PRELOAD_EMBEDDING_MODELS", DEFAULT_EMBEDDING_MODEL).split(",")
+    if name.strip()
+]
+
+# doc.vector only needs the tokenizer and the static word vectors, so none of
+# the trained pipeline components have to be loaded or run.
+UNUSED_PIPES = ["tok2vec", "tagger", "parser", "attribute_ruler",
+                "lemmatizer", "ner", "senter"]
+
+_models: Dict[str, "spacy.language.Language"] = {}
+_models_lock = threading.Lock()
+
+
+def get_model(model_name: str = DEFAULT_EMBEDDING_MODEL):
+    """
+    Return the spaCy model for `model_name`, loading it once per process.
+    """
+    model = _models.get(model_name)
+    if model is not None:
+        return model
+
+    with _models_lock:
+        model = _models.get(model_name)
+        if model is None:
+            start = time.perf_counter()
+            model = spacy.load(model_name, exclude=UNUSED_PIPES)
+            _models[model_name] = model
+            logger.info(
+                f"Loaded embedding model {model_name} in {time.perf_counter() - start:.2f}s")
+    return model
+
+
+def preload_models(model_names: Optional[Iterable[str]] = None):
+    """Load the configured models up front so the first request doesn't pay for it."""
+    for model_name in (model_names if model_names is not None else PRELOAD_EMBEDDING_MODELS):
+        get_model(model_name)
+
+
+def embedding_dimension(model_name: str = DEFAULT_EMBEDDING_MODEL) -> int:
+    return get_model(model_name).vocab.vectors_length
+
+
+def model_version(model_name: str = DEFAULT_EMBEDDING_MODEL) -> str:
+    return get_model(model_name).meta.get("version", "unknown")
+
+
+def embed_texts(texts: List[str], model_name: str = DEFAULT_EMBEDDING_MODEL,
+                batch_size: int = EMBEDDING_BATCH_SIZE, use_cache: bool = True) -> np.ndarray:
+    """
+    Embed `texts` and return a float32 matrix with one row per text. Cached
+    embeddings are reused and only the misses go through the model.
+    """
+    if use_cache and EMBEDDING_CACHE_ENABLED and texts:
+        return embed_with_cache(
+            texts, model_name, model_version(model_name),
+            lambda missing: _embed_batches(missing, model_name, batch_size))
+    return _embed_batches(texts, model_name, batch_size)
+
+
+def _embed_batches(texts: List[str], model_name: str, batch_size: int) -> np.ndarray:
+    """Embed `texts` in batches through `nlp.pipe`."""
+    nlp = get_model(model_name)
+    vectors = np.zeros((len(texts), nlp.vocab.vectors_length), dtype="float32")
+    if not texts:
+        return vectors
+
+    for i, doc in enumerate(nlp.pipe(texts, batch_size=batch_size, disable=nlp.pipe_names)):
+        vectors[i] = doc.vector
+    return vectors
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import BigInteger, Column, Integer, String, Text, DateTime, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .database import Base
@@ -6,14 +6,34 @@ from .database import Base
 
 class Files(Base):
     __tablename__ = 'files'
+    __table_args__ = (
+        # Serves lookups by name and the keyset-paginated listing ordered by (file_name, id)
+        Index('ix_files_user_id_file_name', 'user_id', 'file_name', 'id'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     file_name = Column(String)
-    file_url = Column(String, unique=True)
+    # Uploads of the same content share one S3 object, and so one URL
+    file_url = Column(String)
+    s3_key = Column(String)
+    content_hash = Column(String(64), ForeignKey('contents.sha256'), index=True)
     upload_date = Column(DateTime, default=datetime.utcnow)
     user_id = Column(Integer, ForeignKey('users.id'))
 
     owner = relationship("Users", back_populates="files")
+    content = relationship("Contents")
+
+
+class Contents(Base):
+    __tablename__ = 'contents'
+
+    sha256 = Column(String(64), primary_key=True)
+    s3_key = Column(String)
+    size = Column(BigInteger)
+    content_type = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Uploads of this content still being ingested, -1 while it is being deleted
+    pending = Column(Integer, nullable=False, default=0, server_default="0")
 
 
 class Users(Base):
@@ -29,6 +49,9 @@ class Users(Base):
 
 class Documents(Base):
     __tablename__ = 'documents'
+    __table_args__ = (
+        Index('ix_documents_owner_id_document_name', 'owner_id', 'document_name'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
@@ -51,3 +74,39 @@ class DocumentMetadata(Base):
     metadata_value = Column(String)
 
     document = relationship("Documents", back_populates="document_metadata")
+
+
+# Owner of every ingestion job handed to celery, recorded when it is submitted
+class IngestionTasks(Base):
+    __tablename__ = 'ingestion_tasks'
+
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    file_name = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ChatSessions(Base):
+    __tablename__ = 'chat_sessions'
+    __table_args__ = (UniqueConstraint('user_id', 'session_id'),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    session_id = Column(String)
+    summary = Column(Text, default="")
+    turn_count = Column(Integer, default=0)
+
+
+class ChatTurns(Base):
+    __tablename__ = 'chat_turns'
+    __table_args__ = (
+        Index('ix_chat_turns_user_session_id', 'user_id', 'session_id', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    session_id = Column(String)
+    query = Column(Text)
+    response = Column(Text)
+    token_count = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,124 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+# Processes per PDF pool; 0 uses every CPU, or an even share of them in an ingest worker
+PDF_PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", "0"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+# Pages whose text layer has fewer characters than this are OCRed
+OCR_MIN_TEXT_CHARS = int(os.getenv("OCR_MIN_TEXT_CHARS", "20"))
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+OCR_LANGUAGE = os.getenv("OCR_LANGUAGE", "eng")
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+class PdfPage(NamedTuple):
+    page_number: int  # 1-based
+    text: str
+    ocr: bool
+
+
+def _pool_size() -> int:
+    return PDF_PARSE_WORKERS or os.cpu_count() or 1
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=_pool_size(),
+                                            mp_context=get_context("spawn"))
+    return _executor
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _ocr_page(page: "fitz.Page") -> str:
+    # Imported lazily, most PDFs never need it
+    import pytesseract
+    from PIL import Image
+
+    pixmap = page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csRGB, alpha=False)
+    image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+    return pytesseract.image_to_string(image, lang=OCR_LANGUAGE)
+
+
+def extract_pages(file_path: str, start: int, end: int) -> List[PdfPage]:
+    """Extract the text of pages [start, end), falling back to OCR for pages without a text layer."""
+    pages = []
+    with fitz.open(file_path) as document:
+        for number in range(start, end):
+            page = document.load_page(number)
+            text = page.get_text("text")
+            ocr = len(text.strip()) < OCR_MIN_TEXT_CHARS
+            if ocr:
+                text = _ocr_page(page)
+            pages.append(PdfPage(number + 1, text, ocr))
+    return pages
+
+
+def iter_pdf_pages(file_path: str, metadata: Dict[str, str]) -> Iterator[PdfPage]:
+    """
+    Yield the pages of a PDF in order. Page ranges are extracted on a process
+    pool with a bounded number of ranges in flight; small documents, and
+    processes that can't start children (daemonic workers), parse inline.
+    """
+    with fitz.open(file_path) as document:
+        page_count = document.page_count
+        for key, value in (document.metadata or {}).items():
+            if value:
+                metadata[key] = str(value)
+    metadata["filetype"] = "application/pdf"
+    metadata["page_count"] = str(page_count)
+
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, page_count))
+              for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+    ocr_pages = []
+
+    if len(ranges) <= 1 or _pool_size() <= 1 or multiprocessing.current_process().daemon:
+        results = (extract_pages(file_path, start, end) for start, end in ranges)
+    else:
+        results = _extract_in_pool(file_path, ranges)
+
+    for pages in results:
+        for page in pages:
+            if page.ocr:
+                ocr_pages.append(page.page_number)
+            yield page
+
+    if ocr_pages:
+        metadata["ocr_pages"] = ", ".join(str(number) for number in ocr_pages)
+        logger.info(f"OCRed {len(ocr_pages)} of {page_count} pages of {file_path}")
+
+
+def _extract_in_pool(file_path: str, ranges) -> Iterator[List[PdfPage]]:
+    executor = _get_executor()
+    pending = deque()
+    try:
+        # Keep every worker busy while holding at most two ranges per worker
+        for start, end in ranges:
+            pending.append(executor.submit(extract_pages, file_path, start, end))
+            if len(pending) >= 2 * _pool_size():
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
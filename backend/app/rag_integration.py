@@ -1,45 +1,87 @@
 import os
+import time
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 import openai  # Replace Gemini with OpenAI or another compatible model
-from pydantic import BaseModel
+from pydantic import BaseModel, conint, conlist
 from fastapi import APIRouter, Depends
-import httpx
+from starlette.concurrency import run_in_threadpool
+from typing import Annotated, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .auth import get_current_user
+from .database import get_db
+from .chat_history import append_turn, format_history, get_history
+from .ann_index import ANN_MAX_EF_SEARCH, ANN_MAX_NPROBE
+from .index_cache import index_cache
+from .metrics import LLM_LATENCY
+from .lexical_index import hybrid_search
+from .model_registry import embed_texts
+from .vector_store import document_ids_of
 
 # Load environment variables
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+# "hybrid" fuses BM25 and vector rankings, "dense" only uses the vector index
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "hybrid")
+SEARCH_MODES = ("dense", "hybrid")
+# Most queries accepted by one /rag/search request
+MAX_SEARCH_QUERIES = int(os.getenv("MAX_SEARCH_QUERIES", "64"))
+# Most chunks returned per query by /rag/search
+MAX_TOP_K = int(os.getenv("MAX_TOP_K", "100"))
 
 router = APIRouter(
     prefix='/rag',
     tags=['rag']
 )
 
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+user_dependency = Annotated[dict, Depends(get_current_user)]
+
 # Set up OpenAI API client instead of Google Gemini
 openai.api_key = OPENAI_API_KEY
 
 
-async def get_user_info_from_api():
+def search_user_index(user_id: int, queries: List[str], top_k: int = RAG_TOP_K,
+                      nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                      mode: str = RAG_SEARCH_MODE) -> List[List[dict]]:
     """
-    Fetch the current user data by calling the /auth/me endpoint.
+    Embed all queries in one batch, search the user's index once for all of
+    them and return the top_k closest chunks of every query with their
+    document id, page number (None if unknown) and L2 distance. In hybrid
+    mode the vector ranking is fused with the user's BM25 ranking and every
+    chunk gets its fused score instead.
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.get("http://localhost:8000/auth/me")
-        if response.status_code == 200:
-            return response.json()  # {'username': username, 'id': user_id}
-        else:
-            raise HTTPException(
-                status_code=401, detail="User not authenticated")
-
+    cached = index_cache.get(user_id)
+    if cached is None or cached.index.ntotal == 0:
+        raise HTTPException(
+            status_code=404, detail="Vector store not found. Ensure the file has been processed and indexed.")
 
-def write_to_file_safe(filename, data):
+    query_embeddings = embed_texts(queries, use_cache=False)
+    if mode == "hybrid" and cached.lexical.exists():
+        rankings = hybrid_search(
+            cached.lexical, lambda vectors, k, candidate_ids: cached.index.search(
+                vectors, k, nprobe, ef_search, candidate_ids),
+            queries, query_embeddings, top_k)
+        score_key = "score"
+    else:
+        distances, ids = cached.index.search(query_embeddings, top_k, nprobe, ef_search)
+        rankings = list(zip(ids, distances))
+        score_key = "distance"
+    return [[{"document_id": int(document_ids_of(vector_id)), "text": cached.chunks[vector_id],
+              "page_number": cached.pages.get(vector_id), score_key: float(score)}
+             for vector_id, score in zip(row_ids.tolist(), row_scores.tolist())
+             if vector_id in cached.chunks]
+            for row_ids, row_scores in rankings]
+
+
+def retrieve_context(user_id: int, query: str, top_k: int = RAG_TOP_K) -> List[str]:
     """
-    Write data to a file without locking. 
-    If you need thread-safe writing, use other methods like queue or multiprocessing.
+    Embed the query and return the texts of the top_k closest chunks in the user's index.
     """
-    with open(filename, "a", encoding="utf-8") as f:
-        f.write(data)
+    return [match["text"] for match in search_user_index(user_id, [query], top_k)[0]]
 
 
 # Function to initialize the chat engine for each request
@@ -48,23 +90,6 @@ async def create_chat_engine(user_id: int):
     Create and return a chat engine for the user.
     In this case, we replace Gemini model with OpenAI API or another compatible solution.
     """
-    # Define the user's data folder path dynamically
-    user_folder = f"data/{user_id}"
-
-    # Check if the folder exists, raise error if not
-    if not os.path.exists(user_folder):
-        raise HTTPException(
-            status_code=404, detail=f"User folder {user_folder} not found.")
-
-    # Check for the vector store file in the user folder
-    vector_store_path = os.path.join(user_folder, "vector_store")
-
-    if not os.path.exists(vector_store_path):
-        raise HTTPException(
-            status_code=404, detail="Vector store not found. Ensure the file has been processed and indexed.")
-
-    # Normally, load the vector store from disk or other methods
-
     # Here we are simulating the chat engine initialization with OpenAI API
     # OpenAI API setup can vary, here's an example for completion-based chat
     def chat_engine(input_data: str):
@@ -80,38 +105,69 @@ async def create_chat_engine(user_id: int):
 
 class QueryRequest(BaseModel):
     input_data: str
+    session_id: str = "default"
+
+
+class SearchRequest(BaseModel):
+    queries: conlist(str, min_items=1, max_items=MAX_SEARCH_QUERIES)
+    top_k: conint(ge=1, le=MAX_TOP_K) = RAG_TOP_K
+    # Search breadth for IVF (nprobe) and HNSW (ef_search) indexes, None for the defaults
+    nprobe: Optional[conint(ge=1, le=ANN_MAX_NPROBE)] = None
+    ef_search: Optional[conint(ge=1, le=ANN_MAX_EF_SEARCH)] = None
+    mode: str = RAG_SEARCH_MODE
+
+
+# POST endpoint to retrieve the closest chunks for several questions at once
+@router.post("/search")
+async def search_documents(request: SearchRequest, user: user_dependency):
+    if request.mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(SEARCH_MODES)}")
+
+    matches = await run_in_threadpool(search_user_index, user["id"], request.queries, request.top_k,
+                                      request.nprobe, request.ef_search, request.mode)
+    return {"results": [{"query": query, "matches": query_matches}
+                        for query, query_matches in zip(request.queries, matches)]}
 
 
 # POST endpoint for the chat query
 @router.post("/chat")
-async def get_chat_response(request: QueryRequest):
-    user_info = await get_user_info_from_api()
-    user_id = user_info.get("id")
+async def get_chat_response(request: QueryRequest, db: db_dependency, user: user_dependency):
+    user_id = user["id"]
 
     # Create the chat engine for the user
     chat_engine = await create_chat_engine(user_id)
 
     input_data = request.input_data
+
+    # Find the chunks of the user's documents that are closest to the query
+    context_chunks = await run_in_threadpool(retrieve_context, user_id, input_data)
+    context = "\n---\n".join(context_chunks)
+
     try:
-        # Read the previous chat history (optional)
-        previous_history = ""
-        with open("res.txt", "r", encoding="utf-8") as f:
-            previous_history = f.read()
+        # Read the recent chat history of this session
+        summary, turns = await get_history(db, user_id, request.session_id)
+        previous_history = format_history(summary, turns)
 
         # Define the system prompt based on the input data and previous chat history
         system_prompt = f"""
-        Hey you are a RAG bot that answers questions only from the given context. This is the previous history:
+        Hey you are a RAG bot that answers questions only from the given context. This is the context:
+        {context}
+        This is the previous history:
         {previous_history}.
         Now answer this query: {input_data}
         """
 
         # Get the response from the chat engine based on the system prompt
-        response = chat_engine(system_prompt)
-
-        # Save the chat history to file for future context
-        with open("res.txt", "a", encoding="utf-8") as f:
-            f.write(f"UserQuery \n{input_data}\n")
-            f.write(f"Response\n{response}\n")
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            response = await run_in_threadpool(chat_engine, system_prompt)
+            outcome = "ok"
+        finally:
+            LLM_LATENCY.labels(outcome).observe(time.perf_counter() - start)
+
+        # Save the turn to the session history for future context
+        await append_turn(db, user_id, request.session_id, input_data, response)
 
         return JSONResponse(content={"message": response}, status_code=200)
 
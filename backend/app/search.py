@@ -1,23 +1,129 @@
 # ai-planet-backend-developer-task/Backend/app/search.py
-import faiss
+import threading
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+
 import numpy as np
-from .rag_integration import generate_gemini_embeddings
+from .ann_index import (INDEX_TYPE, build_ann_index, index_type_of, needs_rebuild, search, search_subset,
+                        submit_rebuild)
+from .lexical_index import MemoryLexicalIndex, hybrid_search
+from .model_registry import DEFAULT_EMBEDDING_MODEL, EMBEDDING_BATCH_SIZE, embed_texts, embedding_dimension
 
 
 class DocumentSearch:
-    def __init__(self, dimension: int = 768):
-        self.index = faiss.IndexFlatL2(dimension)
-
-    def add_documents(self, documents: list):
-        """Adds document embeddings to the FAISS index."""
-        embeddings = [generate_gemini_embeddings(
-            doc['content']) for doc in documents]
-        embeddings = np.array(embeddings).astype("float32")
-        self.index.add(embeddings)
-
-    def search(self, query: str, top_k: int = 5):
-        """Search for the most relevant documents based on the query."""
-        query_embedding = np.array(
-            generate_gemini_embeddings(query)).astype("float32")
-        distances, indices = self.index.search(query_embedding, top_k)
-        return indices, distances
+    """
+    In-memory search over document embeddings from the shared embedding
+    model (see model_registry). The index starts flat and is rebuilt in the
+    background as `index_type` (flat, ivf_flat, ivf_pq, hnsw, or "auto" to
+    choose by corpus size) once there are enough vectors to train it;
+    searches keep using the previous index until the new one is swapped in.
+    Documents are also indexed for BM25, for the "hybrid" search mode.
+    """
+
+    def __init__(self, dimension: Optional[int] = None, index_type: str = INDEX_TYPE,
+                 model_name: str = DEFAULT_EMBEDDING_MODEL):
+        self.model_name = model_name
+        self.dimension = dimension or embedding_dimension(model_name)
+        self.index_type = index_type
+        self.index = build_ann_index(np.empty((0, self.dimension), dtype="float32"), index_type="flat")
+        self._ids = np.empty(0, dtype="int64")
+        # Raw vectors, kept to train rebuilt indexes on exact values
+        self._vectors = []
+        self._trained_size = 0
+        self._rebuild: Optional[Future] = None
+        self._lexical = MemoryLexicalIndex()
+        self._lock = threading.Lock()
+        self._hnsw_lock = threading.Lock()
+
+    @property
+    def ntotal(self) -> int:
+        return len(self._ids)
+
+    def add_documents(self, documents: list, batch_size: int = EMBEDDING_BATCH_SIZE):
+        """
+        Adds document embeddings to the FAISS index; documents are embedded and
+        added `batch_size` at a time. Ids are the documents' insertion order.
+        """
+        for start in range(0, len(documents), batch_size):
+            texts = [doc['content'] for doc in documents[start:start + batch_size]]
+            self.add_embeddings(embed_texts(texts, self.model_name), texts)
+
+    def add_embeddings(self, embeddings: np.ndarray, texts: Optional[List[str]] = None):
+        """Adds precomputed embeddings, one row per document, and their texts for BM25."""
+        embeddings = np.ascontiguousarray(embeddings, dtype="float32").reshape(-1, self.dimension)
+        with self._lock:
+            ids = np.arange(self.ntotal, self.ntotal + len(embeddings), dtype="int64")
+            self.index.add_with_ids(embeddings, ids)
+            # Documents without text still take an id so lexical and vector ids line up
+            self._lexical.add(texts if texts is not None else [""] * len(embeddings))
+            self._ids = np.concatenate([self._ids, ids])
+            self._vectors.append(embeddings)
+            self._schedule_rebuild()
+
+    def _schedule_rebuild(self):
+        if self._rebuild is not None or not needs_rebuild(
+                index_type_of(self.index), self._trained_size, self.ntotal, self.index_type):
+            return
+        self._vectors = [np.vstack(self._vectors)]
+        self._rebuild = submit_rebuild(self._rebuild_index, self._vectors[0])
+
+    def _rebuild_index(self, vectors: np.ndarray):
+        try:
+            rebuilt = build_ann_index(vectors, index_type=self.index_type)
+            with self._lock:
+                # Catch up with the documents added while training
+                added = np.vstack(self._vectors)[len(vectors):]
+                if len(added):
+                    rebuilt.add_with_ids(added, self._ids[len(vectors):])
+                self.index = rebuilt
+                self._trained_size = len(vectors)
+        finally:
+            with self._lock:
+                self._rebuild = None
+
+    def wait_for_rebuild(self):
+        """Block until a background rebuild, if any, has been swapped in."""
+        rebuild = self._rebuild
+        if rebuild is not None:
+            rebuild.result()
+
+    def search(self, query: str, top_k: int = 5, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None, mode: str = "dense"):
+        """
+        Search for the most relevant documents based on the query. `nprobe`
+        and `ef_search` trade recall for speed on IVF and HNSW indexes.
+        """
+        return self.search_many([query], top_k, nprobe, ef_search, mode)
+
+    def search_many(self, queries: List[str], top_k: int = 5, nprobe: Optional[int] = None,
+                    ef_search: Optional[int] = None, mode: str = "dense") -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Embed all queries in one batch and run one FAISS search over them.
+        Returns (indices, distances) with one row of top_k results per query;
+        missing results have index -1. With mode="hybrid" the vector and BM25
+        rankings are fused (see lexical_index.hybrid_search) and the second
+        array holds the fused scores, higher being better.
+        """
+        if not queries:
+            return np.empty((0, top_k), dtype="int64"), np.empty((0, top_k), dtype="float32")
+        query_embeddings = embed_texts(queries, self.model_name, use_cache=False)
+        with self._lock:
+            index, ids = self.index, self._ids
+        if mode != "hybrid":
+            distances, indices = search(index, ids, query_embeddings, top_k, nprobe, ef_search,
+                                        hnsw_lock=self._hnsw_lock)
+            return indices, distances
+
+        def dense_search(vectors: np.ndarray, k: int, candidate_ids: Optional[np.ndarray]):
+            if candidate_ids is not None:
+                # Ids are positions in this index
+                return search_subset(index, ids, candidate_ids[candidate_ids < len(ids)], vectors, k)
+            return search(index, ids, vectors, k, nprobe, ef_search, hnsw_lock=self._hnsw_lock)
+
+        indices = np.full((len(queries), top_k), -1, dtype="int64")
+        scores = np.zeros((len(queries), top_k), dtype="float32")
+        for row, (fused_ids, fused_scores) in enumerate(
+                hybrid_search(self._lexical, dense_search, queries, query_embeddings, top_k)):
+            indices[row, :len(fused_ids)] = fused_ids
+            scores[row, :len(fused_scores)] = fused_scores
+        return indices, scores
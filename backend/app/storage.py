@@ -0,0 +1,425 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import quote
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from .metrics import LOG_PAYLOADS, S3_LATENCY
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "s3" stores uploads in S3_BUCKET_NAME, "local" in LOCAL_STORAGE_ROOT (dev, tests, benchmarks)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")
+LOCAL_STORAGE_ROOT = os.getenv("LOCAL_STORAGE_ROOT", "data/objects")
+
+# AWS S3 configuration
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+AWS_REGION = os.getenv("AWS_REGION")
+S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+# Also the number of threads S3 calls run on, so every thread has a connection
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", "5"))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", "30"))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", "5"))
+
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(512 * 1024 * 1024)))
+# S3 requires every part except the last one to be at least 5 MB
+S3_MULTIPART_PART_SIZE = max(
+    int(os.getenv("S3_MULTIPART_PART_SIZE", str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+S3_MULTIPART_CONCURRENCY = int(os.getenv("S3_MULTIPART_CONCURRENCY", "4"))
+# S3 DeleteObjects accepts at most 1000 keys per call
+S3_DELETE_BATCH_SIZE = 1000
+# Size of the reads when streaming an object back to a client
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class ObjectInfo(NamedTuple):
+    size: int
+    etag: str  # quoted, as sent in an ETag header
+    last_modified: float  # unix timestamp
+
+
+def content_disposition(file_name: str) -> str:
+    """
+    Attachment header for `file_name` (RFC 6266): an ASCII fallback for old
+    clients and the exact UTF-8 name in filename*.
+    """
+    fallback = "".join(
+        char if " " <= char <= "~" and char not in '"\\' else "_" for char in file_name)
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{quote(file_name, safe="")}'
+
+
+def timed_s3_call(method, **kwargs):
+    """Call an S3 client method, recording its latency under the method's name."""
+    with S3_LATENCY.labels(method.__name__).time():
+        return method(**kwargs)
+
+
+class MultipartUploader:
+    """
+    Uploads a stream of chunks to S3 as a multipart upload, sending up to
+    `concurrency` parts in parallel. At most `concurrency + 1` parts are held in
+    memory at any time. Streams smaller than one part are sent with a single
+    put_object call instead.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str,
+                 part_size: int = S3_MULTIPART_PART_SIZE,
+                 concurrency: int = S3_MULTIPART_CONCURRENCY,
+                 executor: Optional[Executor] = None):
+        self.s3_client = s3_client
+        self.executor = executor
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self._buffer = bytearray()
+        self._upload_id: Optional[str] = None
+        self._next_part_number = 1
+        self._in_flight: List[asyncio.Future] = []
+        self._parts: List[dict] = []
+
+    async def write(self, data: bytes):
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            await self._send_part(part)
+
+    async def _send_part(self, body: bytes):
+        loop = asyncio.get_running_loop()
+        if self._upload_id is None:
+            response = await loop.run_in_executor(self.executor, lambda: timed_s3_call(
+                self.s3_client.create_multipart_upload, Bucket=self.bucket, Key=self.key))
+            self._upload_id = response["UploadId"]
+
+        # Wait for a free slot so buffered parts stay bounded
+        while len(self._in_flight) >= self.concurrency:
+            done, _ = await asyncio.wait(self._in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                self._in_flight.remove(future)
+                self._parts.append(future.result())
+
+        part_number = self._next_part_number
+        self._next_part_number += 1
+        self._in_flight.append(loop.run_in_executor(
+            self.executor, self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number: int, body: bytes) -> dict:
+        response = timed_s3_call(
+            self.s3_client.upload_part, Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=body)
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    async def complete(self):
+        loop = asyncio.get_running_loop()
+        if self._upload_id is None:
+            body = bytes(self._buffer)
+            self._buffer.clear()
+            await loop.run_in_executor(self.executor, lambda: timed_s3_call(
+                self.s3_client.put_object, Bucket=self.bucket, Key=self.key, Body=body))
+            return
+
+        if self._buffer:
+            body = bytes(self._buffer)
+            self._buffer.clear()
+            await self._send_part(body)
+        for result in await asyncio.gather(*self._in_flight):
+            self._parts.append(result)
+        self._in_flight = []
+
+        parts = sorted(self._parts, key=lambda part: part["PartNumber"])
+        await loop.run_in_executor(self.executor, lambda: timed_s3_call(
+            self.s3_client.complete_multipart_upload, Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            MultipartUpload={"Parts": parts}))
+        logger.info(f"Completed multipart upload of {self.key} in {len(parts)} parts")
+
+    async def abort(self):
+        self._buffer.clear()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+            self._in_flight = []
+        if self._upload_id is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, lambda: timed_s3_call(
+                self.s3_client.abort_multipart_upload, Bucket=self.bucket, Key=self.key, UploadId=self._upload_id))
+            self._upload_id = None
+
+
+async def spool_upload(file: UploadFile, local_file_path: str,
+                       max_size: int = MAX_UPLOAD_SIZE) -> Tuple[int, str]:
+    """
+    Copy an uploaded file to the local spool in fixed-size chunks. Returns the
+    size in bytes and the SHA-256 hex digest. Raises UploadTooLarge once more
+    than `max_size` bytes have been read; the spool file is removed on failure.
+    """
+    checksum = hashlib.sha256()
+    file_size = 0
+    try:
+        with open(local_file_path, "wb") as spool:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_size += len(chunk)
+                if file_size > max_size:
+                    raise UploadTooLarge(
+                        f"File exceeds the maximum upload size of {max_size} bytes")
+                checksum.update(chunk)
+                await run_in_threadpool(spool.write, chunk)
+    except BaseException:
+        if os.path.exists(local_file_path):
+            os.remove(local_file_path)
+        raise
+    return file_size, checksum.hexdigest()
+
+
+async def upload_spooled_file(local_file_path: str, s3_client, bucket: str, key: str,
+                              executor: Optional[Executor] = None):
+    """Upload a spooled file to S3 with a parallel multipart upload, one part in memory per slot."""
+    uploader = MultipartUploader(s3_client, bucket, key, executor=executor)
+    try:
+        with open(local_file_path, "rb") as spool:
+            while True:
+                chunk = await run_in_threadpool(spool.read, uploader.part_size)
+                if not chunk:
+                    break
+                await uploader.write(chunk)
+        await uploader.complete()
+    except BaseException:
+        await uploader.abort()
+        raise
+
+
+class ObjectStorage(ABC):
+    """
+    Where uploaded files are kept. Every method that does I/O is a coroutine
+    that runs the blocking work off the event loop.
+    """
+
+    @abstractmethod
+    def object_url(self, key: str) -> str:
+        ...
+
+    @abstractmethod
+    async def put_file(self, local_file_path: str, key: str):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def delete_many(self, keys: Sequence[str]) -> Dict[str, str]:
+        """Delete several objects and return an error message for each key that could not be deleted."""
+
+    @abstractmethod
+    async def presigned_url(self, key: str, expires_in: int, file_name: Optional[str] = None) -> str:
+        ...
+
+    @abstractmethod
+    async def stat(self, key: str) -> ObjectInfo:
+        """Return the size, ETag and modification time of an object; raises ObjectNotFound."""
+
+    @abstractmethod
+    def iter_range(self, key: str, start: int, end: int) -> AsyncIterator[bytes]:
+        """Stream bytes start..end (inclusive) of an object in DOWNLOAD_CHUNK_SIZE pieces."""
+
+
+class S3Storage(ObjectStorage):
+    """S3 storage with a tuned connection pool, retries and timeouts, called from its own thread pool."""
+
+    def __init__(self, bucket: Optional[str] = S3_BUCKET_NAME, region: Optional[str] = AWS_REGION,
+                 s3_client=None):
+        self.bucket = bucket
+        self.region = region
+        self.s3_client = s3_client or boto3.client(
+            's3',
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+            region_name=region,
+            config=Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                connect_timeout=S3_CONNECT_TIMEOUT,
+                read_timeout=S3_READ_TIMEOUT,
+                retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "adaptive"},
+            ),
+        )
+        # A dedicated pool, so slow S3 calls don't starve the default threadpool
+        self.executor = ThreadPoolExecutor(max_workers=S3_MAX_POOL_CONNECTIONS, thread_name_prefix="s3")
+
+    async def _call(self, method, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(timed_s3_call, method, **kwargs))
+
+    def object_url(self, key: str) -> str:
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{key}"
+
+    async def put_file(self, local_file_path: str, key: str):
+        await upload_spooled_file(local_file_path, self.s3_client, self.bucket, key, executor=self.executor)
+
+    async def delete(self, key: str):
+        # S3 answers 204 whether or not the key existed; failures raise ClientError
+        response = await self._call(self.s3_client.delete_object, Bucket=self.bucket, Key=key)
+        if LOG_PAYLOADS:
+            logger.debug(f"Response from S3: {response}")
+
+    async def _delete_batch(self, keys: Sequence[str]) -> Dict[str, str]:
+        try:
+            response = await self._call(
+                self.s3_client.delete_objects, Bucket=self.bucket,
+                Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+        except Exception as e:
+            return {key: str(e) for key in keys}
+        return {error["Key"]: f"{error.get('Code')}: {error.get('Message')}"
+                for error in response.get("Errors", [])}
+
+    async def delete_many(self, keys: Sequence[str]) -> Dict[str, str]:
+        batches = [keys[start:start + S3_DELETE_BATCH_SIZE]
+                   for start in range(0, len(keys), S3_DELETE_BATCH_SIZE)]
+        errors: Dict[str, str] = {}
+        for batch_errors in await asyncio.gather(*(self._delete_batch(batch) for batch in batches)):
+            errors.update(batch_errors)
+        return errors
+
+    async def presigned_url(self, key: str, expires_in: int, file_name: Optional[str] = None) -> str:
+        params = {'Bucket': self.bucket, 'Key': key}
+        if file_name:
+            params['ResponseContentDisposition'] = content_disposition(file_name)
+        # Signing is local CPU work, only a credential refresh would touch the network
+        return timed_s3_call(self.s3_client.generate_presigned_url,
+                             ClientMethod='get_object', Params=params, ExpiresIn=expires_in)
+
+    async def stat(self, key: str) -> ObjectInfo:
+        try:
+            response = await self._call(self.s3_client.head_object, Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                raise ObjectNotFound(key)
+            raise
+        return ObjectInfo(response["ContentLength"], response["ETag"],
+                          response["LastModified"].timestamp())
+
+    async def iter_range(self, key: str, start: int, end: int) -> AsyncIterator[bytes]:
+        response = await self._call(self.s3_client.get_object, Bucket=self.bucket, Key=key,
+                                    Range=f"bytes={start}-{end}")
+        body = response["Body"]
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, body.read, DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+
+class LocalStorage(ObjectStorage):
+    """Keeps objects as files under `root`; for development, tests and benchmarks."""
+
+    def __init__(self, root: str = LOCAL_STORAGE_ROOT):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid object key: {key}")
+        return path
+
+    def object_url(self, key: str) -> str:
+        return f"file://{quote(self._path(key))}"
+
+    def _copy(self, local_file_path: str, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(local_file_path, tmp_path)
+        os.replace(tmp_path, path)
+
+    async def put_file(self, local_file_path: str, key: str):
+        await run_in_threadpool(self._copy, local_file_path, self._path(key))
+
+    def _remove(self, path: str):
+        if os.path.exists(path):
+            os.remove(path)
+
+    async def delete(self, key: str):
+        await run_in_threadpool(self._remove, self._path(key))
+
+    def _remove_many(self, keys: Sequence[str]) -> Dict[str, str]:
+        errors = {}
+        for key in keys:
+            try:
+                self._remove(self._path(key))
+            except (OSError, ValueError) as e:
+                errors[key] = str(e)
+        return errors
+
+    async def delete_many(self, keys: Sequence[str]) -> Dict[str, str]:
+        return await run_in_threadpool(self._remove_many, keys)
+
+    async def presigned_url(self, key: str, expires_in: int, file_name: Optional[str] = None) -> str:
+        return self.object_url(key)
+
+    async def stat(self, key: str) -> ObjectInfo:
+        try:
+            info = await run_in_threadpool(os.stat, self._path(key))
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+        return ObjectInfo(info.st_size, f'"{info.st_mtime_ns:x}-{info.st_size:x}"', info.st_mtime)
+
+    async def iter_range(self, key: str, start: int, end: int) -> AsyncIterator[bytes]:
+        f = await run_in_threadpool(open, self._path(key), "rb")
+        try:
+            await run_in_threadpool(f.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await run_in_threadpool(f.read, min(DOWNLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+
+_storage: Optional[ObjectStorage] = None
+
+
+def get_storage() -> ObjectStorage:
+    """Return the configured storage backend, created on first use."""
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == "local":
+            _storage = LocalStorage()
+        elif STORAGE_BACKEND == "s3":
+            _storage = S3Storage()
+        else:
+            raise ValueError(f"Unsupported storage backend: {STORAGE_BACKEND}")
+    return _storage
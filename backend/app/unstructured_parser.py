@@ -1,72 +1,204 @@
-import spacy
-import numpy as np
+import os
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
 import faiss
+import numpy as np
 from unstructured.partition.auto import partition
 from unstructured.partition.text import partition_text
 from unstructured.partition.docx import partition_docx
 from unstructured.partition.pptx import partition_pptx
 import pandas as pd
-from typing import Dict
 
-# Function to parse documents based on their file type
+from .ann_index import INDEX_TYPE, build_ann_index
+from .lexical_index import count_terms
+from .model_registry import EMBEDDING_BATCH_SIZE, embed_texts
+from .pdf_parser import iter_pdf_pages
 
+# Chunk sizes are counted in whitespace separated tokens
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "400"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "50"))
+# "pymupdf" extracts PDF pages in parallel with OCR only where needed,
+# "unstructured" runs unstructured's partition on the whole file
+PDF_PARSER = os.getenv("PDF_PARSER", "pymupdf")
+# Rows read from a CSV file at a time
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "10000"))
+
+
+# Function to stream the elements of a document based on its file type
+def iter_elements(file_path: str, file_type: str) -> Iterator:
+    if file_type == "application/pdf":
+        elements = partition(filename=file_path)
+    elif file_type == "text/plain":
+        elements = partition_text(filename=file_path)
+    elif file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+        elements = partition_docx(filename=file_path)
+    elif file_type == "application/vnd.openxmlformats-officedocument.presentationml.presentation":
+        elements = partition_pptx(filename=file_path)
+    else:
+        raise ValueError(f"Unsupported file type: {file_type}")
+
+    # Hand the elements out one at a time and drop our reference to the list,
+    # so consumed elements can be freed while the rest are still processed
+    elements.reverse()
+    while elements:
+        yield elements.pop()
 
-def parse_document(file_path: str, file_type: str) -> Dict[str, str]:
-    try:
-        if file_type == "application/pdf":
-            elements = partition(filename=file_path)
-        elif file_type == "text/plain":
-            elements = partition_text(filename=file_path)
-        elif file_type == "text/csv":
-            df = pd.read_csv(file_path)
-            text = df.to_string()
-            elements = [{'text': text}]
-        elif file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            elements = partition_docx(filename=file_path)
-        elif file_type == "application/vnd.openxmlformats-officedocument.presentationml.presentation":
-            elements = partition_pptx(filename=file_path)
-        else:
-            raise ValueError(f"Unsupported file type: {file_type}")
-
-        text = "\n".join([str(element) for element in elements])
-
-        # Safely extract metadata if present
-        metadata = {}
-        for element in elements:
-            if hasattr(element, 'metadata') and element.metadata:
-                for key, value in vars(element.metadata).items():
-                    if key and not key.startswith('__') and value is not None:
-                        metadata[key] = str(value)
-
-        return {"text": text, "metadata": metadata}
 
+def collect_metadata(element, metadata: Dict[str, str]):
+    """Merge an element's metadata into `metadata`, later elements overriding earlier ones."""
+    if hasattr(element, 'metadata') and element.metadata:
+        for key, value in vars(element.metadata).items():
+            if key and not key.startswith('__') and value is not None:
+                metadata[key] = str(value)
+
+
+# Function to stream a CSV file as "column: value; ..." records, one list per row group
+def iter_csv_records(file_path: str, metadata: Dict[str, str]) -> Iterator[List[str]]:
+    rows = 0
+    # Read everything as text so values are rendered exactly as in the file
+    reader = pd.read_csv(file_path, chunksize=CSV_CHUNK_ROWS, dtype=str,
+                         keep_default_na=False, na_filter=False)
+    with reader:
+        for frame in reader:
+            if not rows:
+                metadata["columns"] = ", ".join(str(name) for name in frame.columns)
+            rows += len(frame)
+            if frame.empty or not len(frame.columns):
+                continue
+            fields = [f"{name}: " + frame[name] for name in frame.columns]
+            records = fields[0].str.cat(fields[1:], sep="; ") if len(fields) > 1 else fields[0]
+            yield records.tolist()
+    metadata["filetype"] = "text/csv"
+    metadata["rows"] = str(rows)
+
+
+# Function to pack whole records into chunks of up to `chunk_tokens` tokens
+def pack_records(record_groups: Iterable[List[str]], chunk_tokens: int = CHUNK_TOKENS) -> Iterator[str]:
+    chunk: List[str] = []
+    tokens = 0
+    for records in record_groups:
+        for record in records:
+            record_tokens = record.count(" ") + 1
+            if chunk and tokens + record_tokens > chunk_tokens:
+                yield "\n".join(chunk)
+                chunk, tokens = [], 0
+            # A record longer than a whole chunk is split like free text
+            if record_tokens > chunk_tokens:
+                yield from (text for text, _ in iter_chunks([(record, {})], chunk_tokens))
+                continue
+            chunk.append(record)
+            tokens += record_tokens
+    if chunk:
+        yield "\n".join(chunk)
+
+
+# Function to stream the text of every element with its own metadata (e.g. its
+# page_number), collecting the document's metadata on the way
+def iter_element_texts(file_path: str, file_type: str,
+                       metadata: Dict[str, str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    try:
+        if file_type == "text/csv":
+            for records in iter_csv_records(file_path, metadata):
+                yield "\n".join(records), {}
+            return
+        if file_type == "application/pdf" and PDF_PARSER == "pymupdf":
+            for page in iter_pdf_pages(file_path, metadata):
+                yield page.text, {"page_number": page.page_number, "ocr": page.ocr}
+            return
+        for element in iter_elements(file_path, file_type):
+            collect_metadata(element, metadata)
+            page_number = getattr(getattr(element, 'metadata', None), 'page_number', None)
+            yield str(element), {"page_number": page_number} if page_number is not None else {}
+    except ValueError:
+        raise
     except Exception as e:
         raise ValueError(f"Error parsing document: {e}")
 
 
+# Function to parse documents based on their file type
+def parse_document(file_path: str, file_type: str) -> Dict[str, str]:
+    metadata: Dict[str, str] = {}
+    text = "\n".join(text for text, _ in iter_element_texts(file_path, file_type, metadata))
+    return {"text": text, "metadata": metadata}
+
+
+# Function to group a stream of (text, metadata) pairs into overlapping, token sized
+# chunks; every chunk comes with the page number of the text it starts in, if known
+def iter_chunks(texts: Iterable[Tuple[str, Dict[str, Any]]], chunk_tokens: int = CHUNK_TOKENS,
+                overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Tuple[str, Optional[int]]]:
+    overlap_tokens = min(overlap_tokens, chunk_tokens - 1)
+    window: List[str] = []
+    pages: List[Optional[int]] = []  # page number of every token in the window
+    fresh = 0  # tokens in the window not yet emitted in a chunk
+    for text, text_metadata in texts:
+        page_number = text_metadata.get("page_number")
+        for token in text.split():
+            window.append(token)
+            pages.append(page_number)
+            fresh += 1
+            if len(window) == chunk_tokens:
+                yield " ".join(window), pages[0]
+                # Carry the tail over so consecutive chunks share some context
+                window = window[len(window) - overlap_tokens:] if overlap_tokens else []
+                pages = pages[len(pages) - overlap_tokens:] if overlap_tokens else []
+                fresh = 0
+    if fresh:
+        yield " ".join(window), pages[0]
+
+
+# Function to stream the chunks of a document with their page numbers, collecting metadata on the way
+def iter_document_chunks(file_path: str, file_type: str,
+                         metadata: Dict[str, str]) -> Iterator[Tuple[str, Optional[int]]]:
+    if file_type == "text/csv":
+        # Rows are independent records, so they are packed without overlap
+        try:
+            yield from ((chunk, None) for chunk in pack_records(iter_csv_records(file_path, metadata)))
+        except Exception as e:
+            raise ValueError(f"Error parsing document: {e}")
+        return
+    yield from iter_chunks(iter_element_texts(file_path, file_type, metadata))
+
+
+# Function to split the parsed text into embedding sized chunks
+def split_into_chunks(doc_text: str) -> List[str]:
+    return [chunk for chunk, _ in iter_chunks([(doc_text, {})])]
+
+
+# Function to embed a stream of chunks in fixed-size batches
+def iter_embedding_batches(chunks: Iterable[str], batch_size: int = EMBEDDING_BATCH_SIZE
+                           ) -> Iterator[Tuple[List[str], np.ndarray]]:
+    chunks = iter(chunks)
+    while True:
+        batch = list(islice(chunks, batch_size))
+        if not batch:
+            return
+        yield batch, embed_texts(batch)
+
+
+# Function to count the terms of every chunk for the user's BM25 index
+def chunk_term_counts(chunks: Iterable[str]) -> List[Dict[str, int]]:
+    return [count_terms(chunk) for chunk in chunks]
+
+
+# Function to create embeddings for the parsed text
+def create_embeddings(doc_text: str) -> np.ndarray:
+    # Embed all chunks in batches with the shared, already loaded model
+    return embed_texts(split_into_chunks(doc_text))
+
+
+# Function to chunk the parsed text and embed every chunk
+def create_chunk_embeddings(doc_text: str) -> Tuple[List[str], np.ndarray]:
+    doc_chunks = split_into_chunks(doc_text)
+    return doc_chunks, embed_texts(doc_chunks)
+
+
+# Function to add embeddings to a new FAISS index of the configured type (INDEX_TYPE)
+def build_index(embeddings: np.ndarray, index_type: str = INDEX_TYPE) -> faiss.Index:
+    # Vector ids are the chunk positions; L2 distance metric for FAISS
+    return build_ann_index(embeddings, index_type=index_type)
+
+
 # Function to create embeddings and add them to a FAISS index
-def create_embeddings_and_index(doc_text: str, openai_api_key: str) -> faiss.Index:
-    # Use spaCy with transformers for faster, lightweight embeddings
-    nlp = spacy.load('en_core_web_md')  # A smaller spaCy model
-    chunk_size = 2048  # Define based on the max token limit
-    doc_chunks = [doc_text[i:i + chunk_size]
-                  for i in range(0, len(doc_text), chunk_size)]
-
-    # Generate embeddings for each chunk using spaCy's transformer
-    embeddings = []
-    for chunk in doc_chunks:
-        doc = nlp(chunk)
-        embedding = doc.vector  # Get the vector for the chunk
-        embeddings.append(embedding)
-
-    # Convert embeddings to a numpy array
-    embeddings = np.array(embeddings)
-
-    # Create FAISS index
-    dimension = embeddings.shape[1]
-    faiss_index = faiss.IndexFlatL2(dimension)  # L2 distance metric for FAISS
-
-    # Add the embeddings to the FAISS index
-    faiss_index.add(embeddings)
-
-    return faiss_index
+def create_embeddings_and_index(doc_text: str, index_type: str = INDEX_TYPE) -> faiss.Index:
+    return build_index(create_embeddings(doc_text), index_type)
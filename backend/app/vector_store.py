@@ -0,0 +1,479 @@
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+from itertools import repeat
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from . import ann_index
+from .metrics import INDEX_LATENCY
+
+logger = logging.getLogger(__name__)
+
+VECTOR_STORE_ROOT = os.getenv("VECTOR_STORE_ROOT", "data")
+# Merge the per-upload segments into the base index once there are this many
+COMPACT_AFTER_SEGMENTS = int(os.getenv("VECTOR_STORE_COMPACT_AFTER", "32"))
+# Vectors copied out of (possibly memory-mapped) embeddings per add call
+ADD_BATCH_SIZE = 4096
+
+# Vector ids are (document id << CHUNK_ID_BITS) | chunk number, so all vectors of
+# a document can be found from the document id alone.
+CHUNK_ID_BITS = 20
+# Larger documents would take ids of the next document
+MAX_CHUNKS_PER_DOCUMENT = 1 << CHUNK_ID_BITS
+
+BASE_INDEX = "base.faiss"
+MANIFEST = "manifest.json"
+CHUNK_STORE = "chunks.sqlite"
+
+
+def check_chunk_count(count: int):
+    if count > MAX_CHUNKS_PER_DOCUMENT:
+        raise ValueError(f"Documents can have at most {MAX_CHUNKS_PER_DOCUMENT} chunks, got {count}")
+
+
+def vector_ids(document_id: int, count: int) -> np.ndarray:
+    check_chunk_count(count)
+    return (np.int64(document_id) << CHUNK_ID_BITS) + np.arange(count, dtype="int64")
+
+
+def document_ids_of(ids: np.ndarray) -> np.ndarray:
+    return ids >> CHUNK_ID_BITS
+
+
+def user_index_dir(user_id: int) -> str:
+    return os.path.join(VECTOR_STORE_ROOT, str(user_id), "vector_store")
+
+
+def _new_index(dimension: int) -> faiss.Index:
+    # Segments are always flat; only the compacted base uses an ANN index
+    return faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+
+
+def _read_index(path: str) -> faiss.Index:
+    # Memory-map where the index type supports it instead of copying it into RAM
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+
+
+def _write_index(index: faiss.Index, path: str):
+    tmp_path = f"{path}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _index_ids(index: faiss.Index) -> np.ndarray:
+    return faiss.vector_to_array(index.id_map).astype("int64")
+
+
+def _deleted_positions(ids: np.ndarray, document_ids: Iterable[int]) -> np.ndarray:
+    """Positions in an index's id map of the vectors of the given documents."""
+    document_ids = np.fromiter(document_ids, dtype="int64")
+    if ids.size == 0 or document_ids.size == 0:
+        return np.empty(0, dtype="int64")
+    return np.flatnonzero(np.isin(document_ids_of(ids), document_ids))
+
+
+def _remove_documents(index: faiss.Index, document_ids: Iterable[int]) -> int:
+    ids = _index_ids(index)
+    doomed = ids[_deleted_positions(ids, document_ids)]
+    if doomed.size == 0:
+        return 0
+    return ann_index.remove_ids(index, doomed)
+
+
+@contextmanager
+def _locked(directory: str):
+    """Exclusive lock on a user's index directory, shared by every process that writes to it."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _part_names(directory: str, manifest: dict) -> List[str]:
+    names = list(manifest["segments"])
+    if os.path.exists(os.path.join(directory, BASE_INDEX)):
+        names.insert(0, BASE_INDEX)
+    return names
+
+
+def manifest_version(user_id: int) -> Optional[int]:
+    """Cheap change marker for a user's index: the manifest's mtime, or None without an index."""
+    try:
+        return os.stat(os.path.join(user_index_dir(user_id), MANIFEST)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _connect_chunk_store(directory: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(os.path.join(directory, CHUNK_STORE))
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, text TEXT NOT NULL, page_number INTEGER)")
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(chunks)")]
+    if "page_number" not in columns:
+        # Chunk stores created before page numbers were kept
+        connection.execute("ALTER TABLE chunks ADD COLUMN page_number INTEGER")
+    return connection
+
+
+def load_chunk_texts(user_id: int) -> Dict[int, str]:
+    directory = user_index_dir(user_id)
+    if not os.path.exists(os.path.join(directory, CHUNK_STORE)):
+        return {}
+    with closing(_connect_chunk_store(directory)) as connection:
+        return dict(connection.execute("SELECT id, text FROM chunks"))
+
+
+def load_chunk_pages(user_id: int) -> Dict[int, int]:
+    """Page number each chunk starts on, for the chunks that have one."""
+    directory = user_index_dir(user_id)
+    if not os.path.exists(os.path.join(directory, CHUNK_STORE)):
+        return {}
+    with closing(_connect_chunk_store(directory)) as connection:
+        return dict(connection.execute("SELECT id, page_number FROM chunks WHERE page_number IS NOT NULL"))
+
+
+def _read_manifest(directory: str) -> dict:
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {"generation": 0, "dimension": None, "next_segment": 0,
+                "segments": [], "deleted": [], "index_type": "flat", "trained_size": 0,
+                "ntotal": 0, "base_version": 0, "deleted_vectors": 0}
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    # Manifests written before the base could be an ANN index
+    manifest.setdefault("index_type", "flat")
+    manifest.setdefault("trained_size", 0)
+    manifest.setdefault("ntotal", 0)
+    manifest.setdefault("base_version", 0)
+    manifest.setdefault("deleted_vectors", 0)
+    return manifest
+
+
+def _needs_rebuild(manifest: dict) -> bool:
+    return ann_index.needs_rebuild(manifest["index_type"], manifest["trained_size"], manifest["ntotal"],
+                                   deleted=manifest["deleted_vectors"])
+
+
+def _write_manifest(directory: str, manifest: dict):
+    manifest["generation"] += 1
+    path = os.path.join(directory, MANIFEST)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+class UserVectorIndex:
+    """
+    A user's persistent FAISS index. On disk it is a compacted base index plus
+    one small segment per added document and a list of deleted document ids,
+    so adding or deleting a document never rewrites the whole index. Segments
+    and deletions are folded into the base every COMPACT_AFTER_SEGMENTS adds.
+    The base is a flat or ANN index (see ann_index), chosen by corpus size and
+    rebuilt in the background; deleted vectors are skipped at search time.
+    """
+
+    def __init__(self, user_id: int, generation: int, indexes: List[faiss.Index],
+                 deleted: Iterable[int] = ()):
+        self.user_id = user_id
+        self.generation = generation
+        self.indexes = indexes
+        deleted = list(deleted)
+        self.id_maps = [_index_ids(index) for index in indexes]
+        self.excluded = [_deleted_positions(ids, deleted) for ids in self.id_maps]
+        # Id maps sorted once, to find the positions of candidate ids
+        self._sorted_ids: List[Optional[Tuple[np.ndarray, np.ndarray]]] = [None] * len(indexes)
+        # Taken by searches that change an HNSW base's efSearch (see ann_index.search)
+        self._hnsw_lock = threading.Lock()
+
+    @property
+    def ntotal(self) -> int:
+        return sum(index.ntotal - excluded.size for index, excluded in zip(self.indexes, self.excluded))
+
+    @classmethod
+    def load(cls, user_id: int) -> Optional["UserVectorIndex"]:
+        directory = user_index_dir(user_id)
+        for attempt in range(3):
+            manifest = _read_manifest(directory)
+            if manifest["dimension"] is None:
+                return None
+            try:
+                indexes = [_read_index(os.path.join(directory, name))
+                           for name in _part_names(directory, manifest)]
+                return cls(user_id, manifest["generation"], indexes, manifest["deleted"])
+            except FileNotFoundError:
+                # A concurrent compaction removed a segment, re-read the manifest
+                if attempt == 2:
+                    raise
+
+    def _positions(self, part: int, vector_ids: np.ndarray) -> np.ndarray:
+        """Positions in part `part` of the given vector ids, leaving out missing and deleted ones."""
+        if self._sorted_ids[part] is None:
+            order = np.argsort(self.id_maps[part], kind="stable")
+            self._sorted_ids[part] = (self.id_maps[part][order], order)
+        sorted_ids, order = self._sorted_ids[part]
+        found = np.clip(np.searchsorted(sorted_ids, vector_ids), 0, max(len(sorted_ids) - 1, 0))
+        positions = order[found[sorted_ids[found] == vector_ids]] if len(sorted_ids) else found[:0]
+        return np.setdiff1d(positions, self.excluded[part])
+
+    def search(self, query_vectors: np.ndarray, k: int, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None,
+               candidate_ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search every part of the index and merge the results. Returns (distances, ids)
+        shaped (len(query_vectors), k); missing results have id -1. `nprobe` and
+        `ef_search` override the ANN_NPROBE / ANN_EF_SEARCH defaults for an IVF
+        or HNSW base. With `candidate_ids` only those vectors are searched, exactly.
+        """
+        query_vectors = np.ascontiguousarray(query_vectors, dtype="float32").reshape(len(query_vectors), -1)
+        with INDEX_LATENCY.labels("search").time():
+            if candidate_ids is not None:
+                candidate_ids = np.asarray(candidate_ids, dtype="int64")
+                results = [ann_index.search_subset(index, ids, self._positions(part, candidate_ids),
+                                                   query_vectors, k)
+                           for part, (index, ids) in enumerate(zip(self.indexes, self.id_maps))]
+            else:
+                results = [ann_index.search(index, ids, query_vectors, k, nprobe, ef_search, excluded,
+                                            self._hnsw_lock)
+                           for index, ids, excluded in zip(self.indexes, self.id_maps, self.excluded)
+                           if index.ntotal > excluded.size]
+        if not results:
+            return (np.full((len(query_vectors), k), np.inf, dtype="float32"),
+                    np.full((len(query_vectors), k), -1, dtype="int64"))
+
+        distances = np.hstack([d for d, _ in results])
+        ids = np.hstack([i for _, i in results])
+        distances[ids < 0] = np.inf
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return (np.take_along_axis(distances, order, axis=1),
+                np.take_along_axis(ids, order, axis=1))
+
+
+def add_document_vectors(user_id: int, document_id: int, embeddings: np.ndarray, chunks: Iterable[str],
+                         page_numbers: Optional[Iterable[Optional[int]]] = None):
+    """
+    Append a document's chunk embeddings to the user's index as a new segment,
+    and store the chunk texts they were computed from with the page each one
+    starts on. `embeddings` may be a memory-mapped array and `chunks` and
+    `page_numbers` any iterables; they are read in batches.
+    """
+    if len(embeddings) == 0:
+        return
+    ids = vector_ids(document_id, len(embeddings))
+    directory = user_index_dir(user_id)
+    with INDEX_LATENCY.labels("add").time(), _locked(directory):
+        with closing(_connect_chunk_store(directory)) as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO chunks (id, text, page_number) VALUES (?, ?, ?)",
+                zip(ids.tolist(), chunks, page_numbers if page_numbers is not None else repeat(None)))
+
+        manifest = _read_manifest(directory)
+        if manifest["dimension"] is None:
+            manifest["dimension"] = int(embeddings.shape[1])
+
+        segment = _new_index(manifest["dimension"])
+        for start in range(0, len(embeddings), ADD_BATCH_SIZE):
+            segment.add_with_ids(
+                np.ascontiguousarray(embeddings[start:start + ADD_BATCH_SIZE], dtype="float32"),
+                ids[start:start + ADD_BATCH_SIZE])
+        name = f"segment-{manifest['next_segment']:08d}.faiss"
+        _write_index(segment, os.path.join(directory, name))
+        manifest["next_segment"] += 1
+        manifest["segments"].append(name)
+        manifest["ntotal"] += len(embeddings)
+        if document_id in manifest["deleted"]:
+            manifest["deleted"].remove(document_id)
+
+        compacted = []
+        if len(manifest["segments"]) >= COMPACT_AFTER_SEGMENTS:
+            compacted = _compact(directory, manifest)
+        _write_manifest(directory, manifest)
+        # Only remove merged segments once the manifest no longer references them
+        for name in compacted:
+            os.remove(os.path.join(directory, name))
+    logger.info(
+        f"Indexed {len(embeddings)} vectors for document {document_id} of user {user_id}")
+    if _needs_rebuild(manifest):
+        schedule_rebuild(user_id)
+
+
+def delete_document_vectors(user_id: int, document_ids: Iterable[int]):
+    """
+    Mark documents as deleted; their vectors are skipped by searches and
+    dropped by the next compaction or rebuild. Indexes that can't remove
+    vectors (HNSW) are rebuilt once enough of them is deleted.
+    """
+    document_ids = [int(document_id) for document_id in document_ids]
+    directory = user_index_dir(user_id)
+    if not document_ids or not os.path.exists(os.path.join(directory, MANIFEST)):
+        return
+    with _locked(directory):
+        manifest = _read_manifest(directory)
+        manifest["deleted"] = sorted(set(manifest["deleted"]) | set(document_ids))
+        with closing(_connect_chunk_store(directory)) as connection, connection:
+            # Every vector has one chunk row, so this counts the vectors just deleted
+            manifest["deleted_vectors"] += connection.executemany(
+                "DELETE FROM chunks WHERE id >= ? AND id < ?",
+                [(document_id << CHUNK_ID_BITS, (document_id + 1) << CHUNK_ID_BITS)
+                 for document_id in document_ids]).rowcount
+        _write_manifest(directory, manifest)
+    if _needs_rebuild(manifest):
+        schedule_rebuild(user_id)
+
+
+def _compact(directory: str, manifest: dict) -> List[str]:
+    """Merge all segments into the base, returning the merged segment names."""
+    base_path = os.path.join(directory, BASE_INDEX)
+    if os.path.exists(base_path):
+        # Added to without retraining; an ANN base is retrained by rebuild_user_index
+        merged = faiss.read_index(base_path)
+    else:
+        merged = _new_index(manifest["dimension"])
+    for name in manifest["segments"]:
+        index = faiss.read_index(os.path.join(directory, name))
+        if index.ntotal:
+            merged.add_with_ids(index.index.reconstruct_n(0, index.ntotal), _index_ids(index))
+    if ann_index.supports_removal(manifest["index_type"]):
+        _remove_documents(merged, manifest["deleted"])
+        manifest["deleted"] = []
+        manifest["deleted_vectors"] = 0
+        manifest["ntotal"] = merged.ntotal
+
+    _write_index(merged, base_path)
+    logger.info(
+        f"Compacted {len(manifest['segments'])} segments into {base_path} ({merged.ntotal} vectors)")
+    segments = manifest["segments"]
+    manifest["segments"] = []
+    manifest["base_version"] += 1
+    return segments
+
+
+_rebuilding = set()
+_rebuilding_lock = threading.Lock()
+
+
+def schedule_rebuild(user_id: int):
+    """
+    Queue a background rebuild of the user's base index, unless one is
+    already queued. It runs in a separate process, since this is called
+    wherever vectors are added, which may be the API process.
+    """
+    with _rebuilding_lock:
+        if user_id in _rebuilding:
+            return
+        _rebuilding.add(user_id)
+    future = ann_index.submit_rebuild(rebuild_user_index, user_id, in_process=True)
+    future.add_done_callback(lambda future: _rebuild_done(user_id, future))
+
+
+def _rebuild_done(user_id: int, future):
+    with _rebuilding_lock:
+        _rebuilding.discard(user_id)
+    # Uploads and deletes during the rebuild may have crossed the next threshold;
+    # they couldn't schedule a rebuild while this one was running
+    if not future.cancelled() and future.exception() is None and future.result():
+        schedule_rebuild(user_id)
+
+
+def _count_deleted(index: faiss.Index, deleted: Iterable[int]) -> int:
+    return int(np.isin(document_ids_of(_index_ids(index)), list(deleted)).sum())
+
+
+def rebuild_user_index(user_id: int) -> bool:
+    """
+    Rebuild the user's base from the base and segments, with the index type
+    chosen for the corpus size, and drop deleted vectors. Training runs
+    without the directory lock so uploads and deletes carry on meanwhile; if
+    the base was compacted in between, the vectors it gained are added to the
+    rebuilt index before it replaces the base. Returns whether the index
+    needs another rebuild already.
+    """
+    directory = user_index_dir(user_id)
+    with _locked(directory):
+        manifest = _read_manifest(directory)
+        if manifest["dimension"] is None:
+            return False
+        parts, vectors, ids = list(manifest["segments"]), [], []
+        for name in _part_names(directory, manifest):
+            index = faiss.read_index(os.path.join(directory, name))
+            keep = np.ones(index.ntotal, dtype=bool)
+            keep[_deleted_positions(_index_ids(index), manifest["deleted"])] = False
+            if keep.any():
+                # PQ bases only hold approximations; retraining on them is good enough
+                vectors.append(ann_index.reconstruct_all(index)[keep])
+                ids.append(_index_ids(index)[keep])
+        snapshot_deleted = set(manifest["deleted"])
+        base_version = manifest["base_version"]
+    if not vectors:
+        return False
+
+    vectors, ids = np.vstack(vectors), np.concatenate(ids)
+    with INDEX_LATENCY.labels("rebuild").time():
+        rebuilt = ann_index.build_ann_index(vectors, ids)
+    index_type = ann_index.index_type_of(rebuilt)
+
+    with _locked(directory):
+        manifest = _read_manifest(directory)
+        # Documents deleted before the snapshot are gone, also from indexes
+        # that can't remove vectors (HNSW); later deletions stay tombstoned
+        deleted = set(manifest["deleted"]) - snapshot_deleted
+        if manifest["base_version"] == base_version:
+            # Segments added since the snapshot stay segments
+            added = manifest["segments"][len(parts):]
+        else:
+            # The snapshot's segments were compacted into the current base
+            # (all segments are merged at once), so only later ones remain
+            added = manifest["segments"]
+            parts = []
+            deleted |= _catch_up(rebuilt, faiss.read_index(os.path.join(directory, BASE_INDEX)),
+                                 index_type, snapshot_deleted)
+        added_indexes = [faiss.read_index(os.path.join(directory, name)) for name in added]
+        _write_index(rebuilt, os.path.join(directory, BASE_INDEX))
+        manifest["segments"] = added
+        manifest["deleted"] = sorted(deleted)
+        manifest["deleted_vectors"] = sum(_count_deleted(index, deleted) for index in [rebuilt] + added_indexes)
+        manifest["index_type"] = index_type
+        manifest["trained_size"] = len(ids)
+        manifest["ntotal"] = sum(index.ntotal for index in [rebuilt] + added_indexes)
+        manifest["base_version"] += 1
+        _write_manifest(directory, manifest)
+        for name in parts:
+            os.remove(os.path.join(directory, name))
+    logger.info(f"Rebuilt the base index of user {user_id} as {index_type} ({rebuilt.ntotal} vectors)")
+    return _needs_rebuild(manifest)
+
+
+def _catch_up(rebuilt: faiss.Index, base: faiss.Index, index_type: str, deleted: set) -> set:
+    """
+    Bring an index rebuilt from a snapshot up to date with the current base:
+    add the vectors compacted into the base since, except those of `deleted`
+    documents, and drop those compaction removed as deleted. Returns the
+    documents whose vectors couldn't be removed from `rebuilt` and must stay
+    tombstoned.
+    """
+    base_ids, rebuilt_ids = _index_ids(base), _index_ids(rebuilt)
+    new = np.flatnonzero(~np.isin(base_ids, rebuilt_ids) & ~np.isin(document_ids_of(base_ids), list(deleted)))
+    if new.size:
+        ivf = faiss.try_extract_index_ivf(base.index)
+        if ivf is not None:
+            ivf.make_direct_map()
+        for start in range(0, new.size, ADD_BATCH_SIZE):
+            batch = new[start:start + ADD_BATCH_SIZE]
+            rebuilt.add_with_ids(base.index.reconstruct_batch(batch), base_ids[batch])
+    removed = rebuilt_ids[~np.isin(rebuilt_ids, base_ids)]
+    if removed.size == 0:
+        return set()
+    if ann_index.supports_removal(index_type):
+        ann_index.remove_ids(rebuilt, removed)
+        return set()
+    return set(np.unique(document_ids_of(removed)).tolist())
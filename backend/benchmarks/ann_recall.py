@@ -0,0 +1,132 @@
+"""
+ANN index recall@k vs latency report.
+
+Builds every index type of app.ann_index on a seeded synthetic corpus of
+clustered vectors (shaped like chunk embeddings), then measures recall@k
+against exact search and single-query latency over a sweep of nprobe /
+efSearch values, to pick INDEX_TYPE, ANN_NPROBE and ANN_EF_SEARCH for large
+users. Run from the backend folder:
+
+    python -m benchmarks.ann_recall --vectors 100000 1000000 --output ann.json
+"""
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from app import ann_index
+
+from .stats import summarize
+
+NPROBES = [1, 4, 16, 64, 256]
+EF_SEARCHES = [16, 32, 64, 128, 256]
+
+
+def synthetic_corpus(count: int, dimension: int, clusters: int, seed: int) -> np.ndarray:
+    """Gaussian clusters around random centroids, generated in blocks to bound memory."""
+    rng = np.random.default_rng(seed)
+    centroids = rng.normal(size=(clusters, dimension)).astype("float32")
+    vectors = np.empty((count, dimension), dtype="float32")
+    for start in range(0, count, 100000):
+        end = min(start + 100000, count)
+        assignments = rng.integers(0, clusters, end - start)
+        vectors[start:end] = centroids[assignments] + 0.5 * rng.normal(
+            size=(end - start, dimension)).astype("float32")
+    return vectors
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(np.intersect1d(row, expected)) for row, expected in zip(found, truth))
+    return hits / truth.size
+
+
+def sweep(index, queries: np.ndarray, truth: np.ndarray, k: int, settings) -> list:
+    id_map = faiss.vector_to_array(index.id_map).astype("int64")
+    rows = []
+    for nprobe, ef_search in settings:
+        found, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            _, ids = ann_index.search(index, id_map, query.reshape(1, -1), k, nprobe, ef_search)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append(ids[0])
+        row = {"recall_at_k": round(recall_at_k(np.array(found), truth), 4), **summarize(latencies)}
+        if nprobe is not None:
+            row["nprobe"] = nprobe
+        if ef_search is not None:
+            row["ef_search"] = ef_search
+        rows.append(row)
+    return rows
+
+
+def run(args) -> dict:
+    faiss.omp_set_num_threads(args.threads)
+    report = {"dimension": args.dimension, "k": args.k, "queries": args.queries,
+              "clusters": args.clusters, "threads": args.threads, "sizes": {}}
+    for count in args.vectors:
+        vectors = synthetic_corpus(count, args.dimension, args.clusters, seed=0)
+        # Queries come from the same distribution but are not in the corpus
+        queries = synthetic_corpus(args.queries, args.dimension, args.clusters, seed=1)
+        exact = faiss.IndexFlatL2(args.dimension)
+        exact.add(vectors)
+        _, truth = exact.search(queries, args.k)
+        del exact
+
+        results = {}
+        for index_type in args.index_types:
+            start = time.perf_counter()
+            index = ann_index.build_ann_index(vectors, index_type=index_type)
+            build_seconds = time.perf_counter() - start
+            built_type = ann_index.index_type_of(index)
+            if built_type != index_type:
+                results[index_type] = {"skipped": f"too few vectors to train, would build {built_type}"}
+                continue
+            settings = ([(nprobe, None) for nprobe in NPROBES] if index_type.startswith("ivf") else
+                        [(None, ef_search) for ef_search in EF_SEARCHES] if index_type == "hnsw" else
+                        [(None, None)])
+            results[index_type] = {
+                "factory": ann_index.factory_string(index_type, args.dimension, count),
+                "build_seconds": round(build_seconds, 2),
+                "bytes_per_vector": ann_index.code_size(index),
+                "runs": sweep(index, queries, truth, args.k, settings),
+            }
+            del index
+        report["sizes"][str(count)] = results
+    return report
+
+
+def print_table(report: dict):
+    print(f"{'vectors':>10} {'index':10} {'setting':>14} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8}")
+    for count, results in report["sizes"].items():
+        for index_type, result in results.items():
+            for row in result.get("runs", []):
+                setting = (f"nprobe={row['nprobe']}" if "nprobe" in row else
+                           f"ef={row['ef_search']}" if "ef_search" in row else "exact")
+                print(f"{count:>10} {index_type:10} {setting:>14} {row['recall_at_k']:>9.4f} "
+                      f"{row['p50_ms']:>8.3f} {row['p95_ms']:>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vectors", type=int, nargs="+", default=[100000])
+    parser.add_argument("--dimension", type=int, default=300, help="300 for the spaCy md/lg models")
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=1, help="faiss threads, 1 to mimic a busy worker")
+    parser.add_argument("--index-types", nargs="+", default=list(ann_index.INDEX_TYPES),
+                        choices=list(ann_index.INDEX_TYPES))
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_table(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
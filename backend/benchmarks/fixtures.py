@@ -0,0 +1,112 @@
+"""
+Deterministic benchmark corpus.
+
+Every fixture is generated from a seeded random generator, so the same kind,
+seed and size always yield the same text and runs on different machines
+measure the same documents (office formats embed zip timestamps, so only
+their content is identical, not their bytes).
+"""
+import csv
+import os
+import random
+from typing import Dict, List, NamedTuple
+
+CONTENT_TYPES = {
+    "pdf": "application/pdf",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "csv": "text/csv",
+    "txt": "text/plain",
+}
+
+_WORDS = (
+    "retrieval augmented generation index vector embedding document chunk query "
+    "latency throughput storage bucket upload session history token model search "
+    "answer context page table column record value metric benchmark cache batch "
+    "pipeline worker process memory disk network request response user file"
+).split()
+
+
+class Fixture(NamedTuple):
+    kind: str
+    path: str
+    content_type: str
+    seed: int
+    pages: int
+    size: int
+
+
+def _sentences(rng: random.Random, count: int) -> List[str]:
+    return [" ".join(rng.choice(_WORDS) for _ in range(rng.randint(8, 20))).capitalize() + "."
+            for _ in range(count)]
+
+
+def _paragraphs(rng: random.Random, count: int) -> List[str]:
+    return [" ".join(_sentences(rng, rng.randint(3, 7))) for _ in range(count)]
+
+
+def _write_pdf(path: str, rng: random.Random, pages: int):
+    import fitz
+
+    document = fitz.open()
+    for _ in range(pages):
+        page = document.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), "\n\n".join(_paragraphs(rng, 4)), fontsize=9)
+    document.set_metadata({"title": "benchmark", "creationDate": "D:20240101000000",
+                           "modDate": "D:20240101000000"})
+    document.save(path, no_new_id=True)
+    document.close()
+
+
+def _write_docx(path: str, rng: random.Random, pages: int):
+    import docx
+
+    document = docx.Document()
+    document.core_properties.title = "benchmark"
+    for section in range(pages):
+        document.add_heading(f"Section {section + 1}", level=1)
+        for paragraph in _paragraphs(rng, 4):
+            document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def _write_pptx(path: str, rng: random.Random, pages: int):
+    import pptx
+
+    presentation = pptx.Presentation()
+    layout = presentation.slide_layouts[1]
+    for number in range(pages):
+        slide = presentation.slides.add_slide(layout)
+        slide.shapes.title.text = f"Slide {number + 1}"
+        slide.placeholders[1].text = "\n".join(_sentences(rng, 5))
+    presentation.save(path)
+
+
+def _write_csv(path: str, rng: random.Random, pages: int):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "category", "amount", "description"])
+        for row in range(pages * 200):
+            writer.writerow([row, rng.choice(_WORDS), rng.choice(_WORDS),
+                             f"{rng.uniform(0, 1000):.2f}", _sentences(rng, 1)[0]])
+
+
+def _write_txt(path: str, rng: random.Random, pages: int):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(_paragraphs(rng, pages * 4)))
+
+
+_WRITERS = {"pdf": _write_pdf, "docx": _write_docx, "pptx": _write_pptx,
+            "csv": _write_csv, "txt": _write_txt}
+
+
+def write_fixture(directory: str, kind: str, seed: int = 0, pages: int = 20) -> Fixture:
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{kind}-{seed}-{pages}.{kind}")
+    if not os.path.exists(path):
+        _WRITERS[kind](path, random.Random(f"{kind}-{seed}"), pages)
+    return Fixture(kind, path, CONTENT_TYPES[kind], seed, pages, os.path.getsize(path))
+
+
+def build_corpus(directory: str, kinds=tuple(_WRITERS), seed: int = 0, pages: int = 20) -> Dict[str, Fixture]:
+    return {kind: write_fixture(directory, kind, seed, pages) for kind in kinds}
@@ -0,0 +1,94 @@
+"""
+Login throughput benchmark.
+
+Runs a storm of concurrent logins against a running server while probing an
+unrelated authenticated endpoint, and reports login req/s together with the
+latency percentiles of the probe. Run from the backend folder:
+
+    python -m benchmarks.login_load --base-url http://localhost:8000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from .stats import summarize
+
+
+async def login_worker(client, args, deadline, latencies, statuses):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.post("/auth/login", data={
+            "username": args.username, "password": args.password})
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+
+async def probe_worker(client, args, deadline, latencies):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        await client.get(args.probe_path)
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(args.probe_interval)
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency + 2)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60) as client:
+        await client.post("/auth/register", json={
+            "username": args.username, "password": args.password})
+        response = await client.post("/auth/login", data={
+            "username": args.username, "password": args.password})
+        response.raise_for_status()
+        probe_client = httpx.AsyncClient(
+            base_url=args.base_url, cookies={"access_token": response.json()["access_token"]}, timeout=60)
+
+        baseline = []
+        await probe_worker(probe_client, args, time.perf_counter() + args.warmup, baseline)
+
+        login_latencies, probe_latencies, statuses = [], [], {}
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(
+            probe_worker(probe_client, args, deadline, probe_latencies),
+            *[login_worker(client, args, deadline, login_latencies, statuses)
+              for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+        await probe_client.aclose()
+
+    return {
+        "concurrency": args.concurrency,
+        "duration_s": round(elapsed, 2),
+        "login_rps": round(statuses.get(200, 0) / elapsed, 2),
+        "login_statuses": statuses,
+        "login_latency": summarize(login_latencies),
+        "probe_path": args.probe_path,
+        "probe_latency_idle": summarize(baseline),
+        "probe_latency_under_load": summarize(probe_latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--username", default="bench-login-user")
+    parser.add_argument("--password", default="bench-login-password")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--probe-path", default="/")
+    parser.add_argument("--probe-interval", type=float, default=0.05)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
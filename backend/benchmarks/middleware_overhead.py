@@ -0,0 +1,127 @@
+"""
+Auth middleware overhead micro-benchmark.
+
+Calls a minimal app in-process through the ASGI interface, bare and wrapped
+in the previous BaseHTTPMiddleware-based auth middleware and in the current
+raw ASGI one, and reports the added latency per request for a plain and a
+streaming response. Run from the backend folder:
+
+    python -m benchmarks.middleware_overhead --requests 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from .stats import summarize
+
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+
+from fastapi import FastAPI, HTTPException, Request  # noqa: E402
+from fastapi.responses import PlainTextResponse, StreamingResponse  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware  # noqa: E402
+
+from app.auth import create_access_token, decode_access_token  # noqa: E402
+from app.middleware import TokenAuthMiddleware  # noqa: E402
+
+
+class LegacyTokenAuthMiddleware(BaseHTTPMiddleware):
+    """The middleware as it was before it was rewritten as raw ASGI, kept for comparison."""
+
+    async def dispatch(self, request: Request, call_next):
+        public_routes = ["/auth/login", "/auth/register", "/auth", "/metrics"]
+        if any(request.url.path.startswith(route) for route in public_routes):
+            return await call_next(request)
+
+        token = request.cookies.get("access_token")
+        if not token:
+            raise HTTPException(status_code=401, detail="Authorization token is missing")
+        claims = decode_access_token(token)
+        if claims is None:
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
+        request.state.user = claims
+        return await call_next(request)
+
+
+def build_app(middleware=None) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/plain")
+    async def plain():
+        return PlainTextResponse("ok")
+
+    @app.get("/stream")
+    async def stream():
+        async def body():
+            for _ in range(16):
+                yield b"x" * 1024
+        return StreamingResponse(body())
+
+    if middleware is not None:
+        app.add_middleware(middleware)
+    return app
+
+
+async def call(app, path: str, cookie: bytes) -> int:
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+             "query_string": b"", "headers": [(b"host", b"bench"), (b"cookie", cookie)],
+             "client": ("127.0.0.1", 1234), "server": ("bench", 80)}
+    status = 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def measure(app, path: str, cookie: bytes, requests: int):
+    for _ in range(min(requests, 500)):
+        await call(app, path, cookie)
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        status = await call(app, path, cookie)
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert status == 200, status
+    return summarize(latencies)
+
+
+async def run(args) -> dict:
+    cookie = f"access_token={create_access_token('benchmark', 1)}".encode()
+    apps = {"none": build_app(), "base_http_middleware": build_app(LegacyTokenAuthMiddleware),
+            "asgi_middleware": build_app(TokenAuthMiddleware)}
+
+    results = {}
+    for path in ("/plain", "/stream"):
+        baseline = await measure(apps["none"], path, cookie, args.requests)
+        results[path] = {"none": baseline}
+        for name in ("base_http_middleware", "asgi_middleware"):
+            summary = await measure(apps[name], path, cookie, args.requests)
+            summary["overhead_us"] = round((summary["mean_ms"] - baseline["mean_ms"]) * 1000, 2)
+            results[path][name] = summary
+    return {"requests": args.requests, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
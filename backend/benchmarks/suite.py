@@ -0,0 +1,303 @@
+"""
+Offline ingestion and API benchmark suite.
+
+Measures document parsing, chunking, embedding + indexing, DocumentSearch and
+the end-to-end /files/upload, /rag/chat and /rag/search latency on a fixed, generated
+corpus of PDF/DOCX/PPTX/CSV/TXT documents. Everything runs locally: SQLite
+for the database, the local filesystem storage backend and a stub LLM, so no network
+access is needed (the spaCy embedding model must be installed). Run from the
+backend folder:
+
+    python -m benchmarks.suite run --output results.json
+    python -m benchmarks.suite compare baseline.json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from .fixtures import CONTENT_TYPES, build_corpus, write_fixture
+from .stats import summarize
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERIES = [
+    "How does the retrieval pipeline handle document chunks?",
+    "What is the latency of the upload request?",
+    "Which metric describes the cache throughput?",
+    "Summarize the storage and bucket records.",
+]
+
+
+def configure_environment(workdir: str, embedding_cache: bool):
+    """Point every store of the app at `workdir`; must run before any app module is imported."""
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.sqlite')}",
+        "VECTOR_STORE_ROOT": os.path.join(workdir, "data"),
+        "CONTENT_STORE_ROOT": os.path.join(workdir, "data", "content"),
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "data", "embedding_cache.sqlite"),
+        "EMBEDDING_CACHE_ENABLED": "true" if embedding_cache else "false",
+        "INGESTION_BACKEND": "process",
+        "STORAGE_BACKEND": "local",
+        "LOCAL_STORAGE_ROOT": os.path.join(workdir, "objects"),
+        "SECRET_KEY": "benchmark-secret-key",
+        "OPENAI_API_KEY": "",
+    })
+    # The app uses paths relative to the working directory (the upload spool);
+    # keep the backend importable for the spawned ingestion workers
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    os.chdir(workdir)
+
+
+def measure(func, repeats: int, *args):
+    """Call func(*args) `repeats` times and return the latencies in ms and the last result."""
+    latencies, result = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, result
+
+
+def with_throughput(latencies, units: float, unit: str) -> dict:
+    summary = summarize(latencies)
+    total_seconds = sum(latencies) / 1000
+    summary["throughput"] = round(units * len(latencies) / total_seconds, 2) if total_seconds else None
+    summary["throughput_unit"] = unit
+    return summary
+
+
+def bench_pipeline(corpus, repeats: int, results: dict):
+    from app.unstructured_parser import create_embeddings_and_index, parse_document, split_into_chunks
+
+    texts = {}
+    for kind, fixture in corpus.items():
+        latencies, parsed = measure(parse_document, repeats, fixture.path, fixture.content_type)
+        results[f"parse.{kind}"] = with_throughput(latencies, fixture.size / 1e6, "MB/s")
+        text = texts[kind] = parsed["text"]
+
+        latencies, chunks = measure(split_into_chunks, repeats, text)
+        results[f"chunk.{kind}"] = with_throughput(latencies, len(chunks), "chunks/s")
+
+        latencies, index = measure(create_embeddings_and_index, repeats, text)
+        results[f"embed_index.{kind}"] = with_throughput(latencies, index.ntotal, "chunks/s")
+    return texts
+
+
+def bench_search(texts: dict, repeats: int, results: dict):
+    try:
+        from app.search import DocumentSearch
+        from app.unstructured_parser import split_into_chunks
+
+        search = DocumentSearch()
+        search.add_documents([{"content": chunk} for text in texts.values()
+                              for chunk in split_into_chunks(text)])
+    except Exception as e:
+        results["search.document_search"] = {"skipped": f"{type(e).__name__}: {e}"}
+        return
+
+    latencies = []
+    for _ in range(repeats):
+        for query in QUERIES:
+            start = time.perf_counter()
+            search.search(query, top_k=5)
+            latencies.append((time.perf_counter() - start) * 1000)
+    results["search.document_search"] = with_throughput(latencies, 1, "queries/s")
+
+    # All queries embedded and searched in one batch
+    latencies, _ = measure(search.search_many, repeats, QUERIES, 5)
+    results["search.document_search_many"] = with_throughput(latencies, len(QUERIES), "queries/s")
+
+    latencies, _ = measure(search.search_many, repeats, QUERIES, 5, None, None, "hybrid")
+    results["search.document_search_hybrid"] = with_throughput(latencies, len(QUERIES), "queries/s")
+
+
+async def _stub_chat_engine(user_id: int):
+    def chat_engine(input_data: str):
+        return f"Stub answer for a prompt of {len(input_data)} characters."
+    return chat_engine
+
+
+def _wait_for_job(client, job_id: str, timeout: float) -> dict:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        job = client.get(f"/files/jobs/{job_id}").json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.01)
+    raise TimeoutError(f"Ingestion job {job_id} did not finish within {timeout}s")
+
+
+def bench_api(workdir: str, kinds, args, results: dict):
+    from fastapi.testclient import TestClient
+
+    from app import rag_integration
+    from app.main import app
+
+    # Stand-in for the LLM; storage is the local filesystem backend
+    rag_integration.create_chat_engine = _stub_chat_engine
+
+    corpus_dir = os.path.join(workdir, "uploads")
+    # https, since the login cookie is Secure and would not be sent back over http
+    with TestClient(app, base_url="https://testserver") as client:
+        credentials = {"username": "benchmark", "password": "benchmark-password"}
+        client.post("/auth/register", json=credentials)
+        client.post("/auth/login", data=credentials).raise_for_status()
+
+        for kind in kinds:
+            accepted, ingested, failures = [], [], 0
+            fixture = None
+            # Distinct seeds so every upload is new content and runs the full pipeline
+            for seed in range(1, args.repeats + 1):
+                fixture = write_fixture(corpus_dir, kind, seed, args.pages)
+                start = time.perf_counter()
+                with open(fixture.path, "rb") as f:
+                    response = client.post("/files/upload", files={
+                        "file": (os.path.basename(fixture.path), f, fixture.content_type)})
+                response.raise_for_status()
+                accepted.append((time.perf_counter() - start) * 1000)
+                job = _wait_for_job(client, response.json()["job_id"], args.job_timeout)
+                ingested.append((time.perf_counter() - start) * 1000)
+                failures += job["status"] == "failed"
+            results[f"upload.{kind}.accepted"] = summarize(accepted)
+            results[f"upload.{kind}.ingested"] = with_throughput(ingested, fixture.size / 1e6, "MB/s")
+            results[f"upload.{kind}.ingested"]["failures"] = failures
+
+        # Same content under a new name takes the deduplicated path
+        latencies = []
+        for repeat in range(args.repeats):
+            with open(fixture.path, "rb") as f:
+                start = time.perf_counter()
+                response = client.post("/files/upload", files={
+                    "file": (f"copy-{repeat}-{os.path.basename(fixture.path)}", f, fixture.content_type)})
+                latencies.append((time.perf_counter() - start) * 1000)
+            response.raise_for_status()
+        results["upload.deduplicated"] = summarize(latencies)
+
+        latencies = []
+        for repeat in range(args.repeats):
+            for query in QUERIES:
+                start = time.perf_counter()
+                response = client.post("/rag/chat", json={
+                    "input_data": query, "session_id": f"benchmark-{repeat}"})
+                latencies.append((time.perf_counter() - start) * 1000)
+                response.raise_for_status()
+        results["chat"] = with_throughput(latencies, 1, "requests/s")
+
+        latencies = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            response = client.post("/rag/search", json={"queries": QUERIES, "top_k": 5})
+            latencies.append((time.perf_counter() - start) * 1000)
+            response.raise_for_status()
+        results["rag_search"] = with_throughput(latencies, len(QUERIES), "queries/s")
+
+
+def run(args) -> dict:
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="ai-planet-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    configure_environment(workdir, args.embedding_cache)
+
+    kinds = args.kinds or list(CONTENT_TYPES)
+    corpus = build_corpus(os.path.join(workdir, "corpus"), kinds, seed=0, pages=args.pages)
+    results = {}
+    texts = bench_pipeline(corpus, args.repeats, results)
+    bench_search(texts, args.repeats, results)
+    if not args.skip_api:
+        bench_api(workdir, kinds, args, results)
+
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeats": args.repeats,
+            "embedding_cache": args.embedding_cache,
+            "corpus": {kind: {"seed": fixture.seed, "pages": fixture.pages, "bytes": fixture.size}
+                       for kind, fixture in corpus.items()},
+            "workdir": workdir,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline: dict, current: dict, metric: str, threshold: float):
+    """Return one row per benchmark present in both runs and the names of the regressions."""
+    rows, regressions = [], []
+    for name in sorted(set(baseline["results"]) | set(current["results"])):
+        before = baseline["results"].get(name, {}).get(metric)
+        after = current["results"].get(name, {}).get(metric)
+        if before is None or after is None:
+            verdict = "skipped" if before is None and after is None else "missing" if after is None else "new"
+            rows.append((name, before, after, None, verdict))
+            continue
+        change = (after - before) / before if before else 0.0
+        verdict = "ok"
+        if change > threshold:
+            verdict = "REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            verdict = "improved"
+        rows.append((name, before, after, change, verdict))
+    return rows, regressions
+
+
+def _load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--output", help="Write the results as JSON to this file")
+    run_parser.add_argument("--repeats", type=int, default=3)
+    run_parser.add_argument("--pages", type=int, default=20, help="Size of every fixture")
+    run_parser.add_argument("--kinds", nargs="*", choices=list(CONTENT_TYPES))
+    run_parser.add_argument("--workdir", help="Directory for the database, stores and corpus")
+    run_parser.add_argument("--embedding-cache", action="store_true",
+                            help="Keep the embedding cache on (off by default so repeats re-embed)")
+    run_parser.add_argument("--skip-api", action="store_true", help="Only run the in-process benchmarks")
+    run_parser.add_argument("--job-timeout", type=float, default=600)
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--metric", default="p50_ms")
+    compare_parser.add_argument("--threshold", type=float, default=0.15,
+                                help="Relative slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        output = os.path.abspath(args.output) if args.output else None
+        results = run(args)
+        print(json.dumps(results, indent=2))
+        if output:
+            with open(output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    baseline, current = _load(args.baseline), _load(args.current)
+    if baseline["meta"].get("corpus") != current["meta"].get("corpus"):
+        print("warning: the runs used different corpora, timings are not comparable")
+    rows, regressions = compare(baseline, current, args.metric, args.threshold)
+    def number(value):
+        return f"{value:.2f}" if value is not None else "-"
+
+    for name, before, after, change, verdict in rows:
+        change_text = f"{change:+.1%}" if change is not None else "-"
+        print(f"{name:40} {number(before):>12} {number(after):>12} {change_text:>8}  {verdict}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+from app import models  # noqa: F401, registers the tables on Base.metadata
+from app.database import Base, _sync_url, SQLALCHEMY_DATABASE_URL, engine
+
+config = context.config
+# The app passes its own connection and has configured logging already
+if config.attributes.get("connection") is None and config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+
+def run_migrations(connection):
+    context.configure(connection=connection, target_metadata=Base.metadata,
+                      render_as_batch=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+connection = config.attributes.get("connection")
+if context.is_offline_mode():
+    # alembic upgrade head --sql: print the statements instead of running them
+    context.configure(url=_sync_url(SQLALCHEMY_DATABASE_URL), target_metadata=Base.metadata,
+                      literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+elif connection is not None:
+    run_migrations(connection)
+else:
+    with engine.connect() as connection:
+        run_migrations(connection)
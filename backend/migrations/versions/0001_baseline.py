@@ -0,0 +1,64 @@
+"""Baseline: the schema before migrations were introduced
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('username', sa.String(), unique=True),
+        sa.Column('hashed_password', sa.String()),
+    )
+    op.create_index('ix_users_id', 'users', ['id'])
+
+    op.create_table(
+        'files',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('file_name', sa.String()),
+        sa.Column('file_url', sa.String(), unique=True),
+        sa.Column('upload_date', sa.DateTime()),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id')),
+    )
+    op.create_index('ix_files_id', 'files', ['id'])
+
+    op.create_table(
+        'documents',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('owner_id', sa.Integer(), sa.ForeignKey('users.id')),
+        sa.Column('document_name', sa.String()),
+        sa.Column('document_type', sa.String()),
+        sa.Column('upload_date', sa.DateTime()),
+        sa.Column('s3_url', sa.String()),
+    )
+    op.create_index('ix_documents_id', 'documents', ['id'])
+    op.create_index('ix_documents_document_name', 'documents', ['document_name'])
+
+    op.create_table(
+        'document_metadata',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('document_id', sa.Integer(), sa.ForeignKey('documents.id')),
+        sa.Column('metadata_key', sa.String()),
+        sa.Column('metadata_value', sa.String()),
+    )
+    op.create_index('ix_document_metadata_id', 'document_metadata', ['id'])
+
+
+def downgrade():
+    op.drop_table('document_metadata')
+    op.drop_table('documents')
+    op.drop_table('files')
+    op.drop_table('users')
@@ -0,0 +1,58 @@
+"""Deduplicated contents shared by uploads
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+# Names SQLite's unnamed constraints, so batch mode can drop them
+NAMING_CONVENTION = {"uq": "uq_%(table_name)s_%(column_0_name)s"}
+
+
+def _file_url_constraint() -> str:
+    if op.get_context().dialect.name == 'postgresql':
+        return 'files_file_url_key'
+    return 'uq_files_file_url'
+
+
+def upgrade():
+    op.create_table(
+        'contents',
+        sa.Column('sha256', sa.String(64), primary_key=True),
+        sa.Column('s3_key', sa.String()),
+        sa.Column('size', sa.BigInteger()),
+        sa.Column('content_type', sa.String()),
+        sa.Column('created_at', sa.DateTime()),
+        # Uploads of this content still being ingested, -1 while it is being deleted
+        sa.Column('pending', sa.Integer(), nullable=False, server_default='0'),
+    )
+
+    with op.batch_alter_table('files', naming_convention=NAMING_CONVENTION) as batch_op:
+        # files.file_url is shared by deduplicated uploads
+        batch_op.drop_constraint(_file_url_constraint(), type_='unique')
+        batch_op.add_column(sa.Column('s3_key', sa.String()))
+        batch_op.add_column(sa.Column('content_hash', sa.String(64)))
+        batch_op.create_foreign_key('fk_files_content_hash', 'contents', ['content_hash'], ['sha256'])
+        batch_op.create_index('ix_files_content_hash', ['content_hash'])
+        batch_op.create_index('ix_files_user_id_file_name', ['user_id', 'file_name', 'id'])
+
+
+def downgrade():
+    with op.batch_alter_table('files', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_index('ix_files_user_id_file_name')
+        batch_op.drop_index('ix_files_content_hash')
+        batch_op.drop_constraint('fk_files_content_hash', type_='foreignkey')
+        batch_op.drop_column('content_hash')
+        batch_op.drop_column('s3_key')
+        batch_op.create_unique_constraint(_file_url_constraint(), ['file_url'])
+    op.drop_table('contents')
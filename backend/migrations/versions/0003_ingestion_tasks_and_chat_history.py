@@ -0,0 +1,58 @@
+"""Celery task owners, per-session chat history and the document lookup index
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_documents_owner_id_document_name', 'documents', ['owner_id', 'document_name'])
+
+    op.create_table(
+        'ingestion_tasks',
+        sa.Column('id', sa.String(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id')),
+        sa.Column('file_name', sa.String()),
+        sa.Column('created_at', sa.DateTime()),
+    )
+
+    op.create_table(
+        'chat_sessions',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id')),
+        sa.Column('session_id', sa.String()),
+        sa.Column('summary', sa.Text()),
+        sa.Column('turn_count', sa.Integer()),
+        sa.UniqueConstraint('user_id', 'session_id'),
+    )
+    op.create_index('ix_chat_sessions_id', 'chat_sessions', ['id'])
+
+    op.create_table(
+        'chat_turns',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id')),
+        sa.Column('session_id', sa.String()),
+        sa.Column('query', sa.Text()),
+        sa.Column('response', sa.Text()),
+        sa.Column('token_count', sa.Integer()),
+        sa.Column('created_at', sa.DateTime()),
+    )
+    op.create_index('ix_chat_turns_user_session_id', 'chat_turns', ['user_id', 'session_id', 'id'])
+
+
+def downgrade():
+    op.drop_table('chat_turns')
+    op.drop_table('chat_sessions')
+    op.drop_table('ingestion_tasks')
+    op.drop_index('ix_documents_owner_id_document_name', 'documents')
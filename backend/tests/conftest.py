@@ -0,0 +1,87 @@
+"""
+Shared fixtures. Like benchmarks/suite.py, every store of the app is pointed
+at a temporary directory before any app module is imported: SQLite for the
+database, local storage for objects and a small spaCy pipeline with made-up
+word vectors as the embedding model, which the ingestion workers load too.
+"""
+import os
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pytest
+import spacy
+
+WORKDIR = tempfile.mkdtemp(prefix="ai-planet-tests-")
+EMBEDDING_MODEL_PATH = os.path.join(WORKDIR, "embedding-model")
+WORDS = ("retrieval augmented generation index vector embedding document chunk query latency "
+         "storage bucket upload session history token model search answer context page").split()
+
+
+def _save_embedding_model(path: str):
+    nlp = spacy.blank("en")
+    rng = np.random.default_rng(0)
+    for word in WORDS:
+        nlp.vocab.set_vector(word, rng.standard_normal(16).astype("float32"))
+    nlp.to_disk(path)
+
+
+_save_embedding_model(EMBEDDING_MODEL_PATH)
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(WORKDIR, 'test.sqlite')}",
+    "VECTOR_STORE_ROOT": os.path.join(WORKDIR, "data"),
+    "CONTENT_STORE_ROOT": os.path.join(WORKDIR, "data", "content"),
+    "EMBEDDING_CACHE_PATH": os.path.join(WORKDIR, "data", "embedding_cache.sqlite"),
+    "EMBEDDING_MODEL": EMBEDDING_MODEL_PATH,
+    "INGESTION_BACKEND": "process",
+    "INGEST_WORKERS": "1",
+    "STORAGE_BACKEND": "local",
+    "LOCAL_STORAGE_ROOT": os.path.join(WORKDIR, "objects"),
+    "SECRET_KEY": "test-secret-key",
+    "OPENAI_API_KEY": "",
+})
+
+
+@pytest.fixture(scope="session")
+def app_client():
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    # The upload spool is relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(WORKDIR)
+    try:
+        # https, since the login cookie is Secure and would not be sent back over http
+        with TestClient(app, base_url="https://testserver") as client:
+            yield client
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def login(app_client):
+    """Register and log in a new user; returns the client, now sending that user's cookie."""
+    def login():
+        app_client.cookies.clear()
+        credentials = {"username": f"user-{uuid.uuid4().hex}", "password": "test-password"}
+        app_client.post("/auth/register", json=credentials).raise_for_status()
+        app_client.post("/auth/login", data=credentials).raise_for_status()
+        return app_client
+    return login
+
+
+@pytest.fixture
+def client(login):
+    return login()
+
+
+def wait_for_job(client, job_id: str, timeout: float = 60) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f"/files/jobs/{job_id}").json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(f"Ingestion job {job_id} did not finish within {timeout}s")
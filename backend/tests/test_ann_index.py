@@ -0,0 +1,37 @@
+import threading
+
+import faiss
+import numpy as np
+
+from app import ann_index
+
+
+def test_remove_ids_keeps_ivf_ids_aligned():
+    vectors = np.random.default_rng(0).normal(size=(2000, 16)).astype("float32")
+    index = ann_index.build_ann_index(vectors, np.arange(2000) + 1000, index_type="ivf_flat")
+    assert ann_index.index_type_of(index) == "ivf_flat"
+
+    assert ann_index.remove_ids(index, np.arange(1000, 1500)) == 500
+    id_map = faiss.vector_to_array(index.id_map).astype("int64")
+    _, ids = ann_index.search(index, id_map, vectors[1500:1510], 1, nprobe=64)
+    assert (ids[:, 0] == np.arange(2500, 2510)).all()
+    assert index.ntotal == 1500
+
+
+def test_hnsw_search_sets_ef_search_on_the_index():
+    vectors = np.random.default_rng(0).normal(size=(500, 16)).astype("float32")
+    index = ann_index.build_ann_index(vectors, index_type="hnsw")
+    id_map = faiss.vector_to_array(index.id_map).astype("int64")
+    lock = threading.Lock()
+
+    _, ids = ann_index.search(index, id_map, vectors[:10], 1, ef_search=128, hnsw_lock=lock)
+    assert (ids[:, 0] == np.arange(10)).all()
+    assert faiss.downcast_index(index.index).hnsw.efSearch == 128
+    assert not lock.locked()
+
+
+def test_hnsw_is_rebuilt_once_enough_is_deleted():
+    assert not ann_index.needs_rebuild("hnsw", 1000, 1000, "hnsw", deleted=100)
+    assert ann_index.needs_rebuild("hnsw", 1000, 1000, "hnsw", deleted=200)
+    # Other index types drop deleted vectors when compacted
+    assert not ann_index.needs_rebuild("flat", 1000, 1000, "flat", deleted=900)
@@ -0,0 +1,75 @@
+import asyncio
+import uuid
+
+import pytest
+
+from app import chat_history
+from app.chat_history import append_turn, format_history, get_history
+from app.database import AsyncSessionLocal
+
+
+@pytest.fixture
+def user_id(client):
+    return client.get("/auth/me").json()["user"]["id"]
+
+
+def run(func, *args, **kwargs):
+    async def call():
+        async with AsyncSessionLocal() as db:
+            return await func(db, *args, **kwargs)
+    return asyncio.run(call())
+
+
+def add_turns(user_id: int, session_id: str, count: int, start: int = 0):
+    for number in range(start, start + count):
+        run(append_turn, user_id, session_id, f"question {number}", f"answer {number}")
+
+
+def test_history_is_bounded_by_turns_and_tokens(user_id):
+    session_id = uuid.uuid4().hex
+    assert run(get_history, user_id, session_id) == ("", [])
+    add_turns(user_id, session_id, 5)
+
+    summary, turns = run(get_history, user_id, session_id, max_turns=3)
+    assert summary == ""
+    assert [turn.query for turn in turns] == ["question 2", "question 3", "question 4"]
+
+    # The newest turn is always kept, older ones only while within the token budget
+    one_turn = turns[-1].token_count
+    _, turns = run(get_history, user_id, session_id, max_tokens=2 * one_turn)
+    assert [turn.query for turn in turns] == ["question 3", "question 4"]
+    _, turns = run(get_history, user_id, session_id, max_tokens=1)
+    assert [turn.query for turn in turns] == ["question 4"]
+
+    # Sessions and users are separate
+    assert run(get_history, user_id, uuid.uuid4().hex) == ("", [])
+    assert run(get_history, user_id + 1000, session_id) == ("", [])
+
+
+def test_long_sessions_are_folded_into_the_summary(user_id, monkeypatch):
+    monkeypatch.setattr(chat_history, "CHAT_HISTORY_COMPACT_AFTER", 6)
+    monkeypatch.setattr(chat_history, "CHAT_HISTORY_KEEP_TURNS", 2)
+    session_id = uuid.uuid4().hex
+    add_turns(user_id, session_id, 6)
+
+    summary, turns = run(get_history, user_id, session_id)
+    assert [turn.query for turn in turns] == ["question 4", "question 5"]
+    assert summary.splitlines() == [f"Q: question {n} A: answer {n}" for n in range(4)]
+
+    text = format_history(summary, turns)
+    assert text.startswith("Summary of earlier conversation:\nQ: question 0 A: answer 0")
+    assert text.endswith("UserQuery\nquestion 5\nResponse\nanswer 5")
+
+
+def test_concurrent_first_turns_share_the_session(user_id):
+    session_id = uuid.uuid4().hex
+
+    async def first_turns():
+        async def turn(number: int):
+            async with AsyncSessionLocal() as db:
+                await append_turn(db, user_id, session_id, f"question {number}", f"answer {number}")
+        await asyncio.gather(turn(0), turn(1))
+
+    asyncio.run(first_turns())
+    _, turns = run(get_history, user_id, session_id)
+    assert sorted(turn.query for turn in turns) == ["question 0", "question 1"]
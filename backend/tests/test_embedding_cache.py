@@ -0,0 +1,28 @@
+import numpy as np
+from prometheus_client import REGISTRY
+
+from app import embedding_cache
+from app.embedding_cache import EmbeddingCache, embed_with_cache
+
+
+def _lookups(result: str) -> float:
+    return REGISTRY.get_sample_value("embedding_cache_lookups_total", {"result": result}) or 0
+
+
+def test_hits_and_misses_are_exported(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, "embedding_cache", EmbeddingCache(str(tmp_path / "cache.sqlite")))
+    embedded = []
+
+    def embed(texts):
+        embedded.extend(texts)
+        return np.ones((len(texts), 4), dtype="float32")
+
+    hits, misses = _lookups("hit"), _lookups("miss")
+    embed_with_cache(["a", "b"], "model", "1", embed)
+    vectors = embed_with_cache(["a", "b", "c"], "model", "1", embed)
+
+    assert vectors.shape == (3, 4)
+    assert embedded == ["a", "b", "c"]
+    assert _lookups("hit") == hits + 2
+    assert _lookups("miss") == misses + 3
+    assert embedding_cache.embedding_cache.stats()["hits"] == 2
@@ -0,0 +1,79 @@
+import uuid
+
+import pytest
+
+from app.storage import content_disposition
+
+from .conftest import wait_for_job
+
+BODY = ("id,text\n" + "".join(f"{row},stream range {row}\n" for row in range(100))).encode()
+
+
+@pytest.fixture
+def stored(client):
+    """A user with one uploaded file; returns the client and the file's bytes."""
+    body = BODY + f"100,{uuid.uuid4().hex}\n".encode()
+    response = client.post("/files/upload", files={"file": ("résumé final.csv", body, "text/csv")})
+    assert wait_for_job(client, response.json()["job_id"])["status"] == "completed"
+    return client, body
+
+
+def stream(client, **headers):
+    return client.get("/files/stream/résumé final.csv", headers=headers)
+
+
+def test_stream_whole_file_with_encoded_name(stored):
+    client, body = stored
+    response = stream(client)
+    assert response.status_code == 200
+    assert response.content == body
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["content-disposition"] == (
+        "attachment; filename=\"r_sum_ final.csv\"; filename*=UTF-8''r%C3%A9sum%C3%A9%20final.csv")
+
+
+def test_content_disposition_escapes_the_fallback():
+    assert content_disposition('a "b"\\c\r\n.csv') == (
+        "attachment; filename=\"a _b__c__.csv\"; filename*=UTF-8''a%20%22b%22%5Cc%0D%0A.csv")
+
+
+def test_stream_ranges(stored):
+    client, body = stored
+    response = stream(client, range="bytes=10-19")
+    assert response.status_code == 206
+    assert response.content == body[10:20]
+    assert response.headers["content-range"] == f"bytes 10-19/{len(body)}"
+
+    assert stream(client, range="bytes=-5").content == body[-5:]
+    assert stream(client, range=f"bytes=20-{len(body) + 100}").content == body[20:]
+    # Multi-part and malformed ranges get the whole file
+    assert stream(client, range="bytes=0-1,5-6").status_code == 200
+    assert stream(client, range="bytes=x-y").status_code == 200
+
+    response = stream(client, range=f"bytes={len(body)}-")
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(body)}"
+
+
+def test_stream_conditional_requests(stored):
+    client, body = stored
+    etag = stream(client).headers["etag"]
+
+    assert stream(client, **{"if-none-match": etag}).status_code == 304
+    assert stream(client, **{"if-none-match": f'"other", W/{etag}'}).status_code == 304
+    assert stream(client, **{"if-none-match": '"other"'}).status_code == 200
+
+    # A range is only honoured while the client's copy is current
+    assert stream(client, range="bytes=0-9", **{"if-range": etag}).status_code == 206
+    response = stream(client, range="bytes=0-9", **{"if-range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == body
+
+
+def test_list_etag(stored):
+    client, _ = stored
+    response = client.get("/files/list")
+    etag = response.headers["etag"]
+    assert client.get("/files/list", headers={"if-none-match": etag}).status_code == 304
+    assert client.get("/files/list", headers={"if-none-match": f"W/{etag}"}).status_code == 304
+    assert client.get("/files/list", headers={"if-none-match": '"other"'}).status_code == 200
@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import os
+import uuid
+
+from sqlalchemy import select
+
+from app import ingestion
+from app.content_refs import claim_content, release_content, remove_unused_contents
+from app.content_store import artifact_dir, content_s3_key
+from app.database import AsyncSessionLocal, SessionLocal
+from app.models import Contents
+from app.storage import get_storage
+
+from .conftest import wait_for_job
+
+# CSV, since it is parsed without unstructured's NLTK data
+ROWS = "id,text\n" + "".join(f"{row},retrieval index of document chunk {row}\n" for row in range(200))
+
+
+def upload(client, name: str, body: bytes, content_type: str = "text/csv"):
+    return client.post("/files/upload", files={"file": (name, body, content_type)})
+
+
+def new_content() -> bytes:
+    # Unique bytes, so every test starts from content nobody uploaded
+    return (ROWS + f"200,{uuid.uuid4().hex}\n").encode()
+
+
+def content(body: bytes):
+    content_hash = hashlib.sha256(body).hexdigest()
+    with SessionLocal() as db:
+        return content_hash, db.get(Contents, content_hash)
+
+
+def object_exists(content_hash: str) -> bool:
+    return os.path.exists(get_storage()._path(content_s3_key(content_hash)))
+
+
+def file_names(client):
+    return [f["file_name"] for f in client.get("/files/list").json()["files"]]
+
+
+def test_upload_is_ingested_and_listed(client):
+    body = new_content()
+    response = upload(client, "notes.csv", body)
+    assert response.status_code == 202
+    assert wait_for_job(client, response.json()["job_id"])["status"] == "completed"
+
+    content_hash, row = content(body)
+    assert row is not None and row.pending == 0
+    assert object_exists(content_hash)
+    assert os.path.isdir(artifact_dir(content_hash))
+    assert file_names(client) == ["notes.csv"]
+
+
+def test_duplicates_reuse_the_content_and_only_disclose_own_uploads(client, login):
+    body = new_content()
+    response = upload(client, "first.csv", body)
+    wait_for_job(client, response.json()["job_id"])
+
+    response = upload(client, "second.csv", body)
+    assert response.status_code == 200
+    assert response.json()["job_id"] is None
+    assert response.json()["deduplicated"] is True
+
+    # Another user's copy is reused too, without telling them
+    other = login()
+    response = upload(other, "copy.csv", body)
+    assert response.status_code == 200
+    assert response.json()["deduplicated"] is False
+    assert file_names(other) == ["copy.csv"]
+
+
+def test_content_is_deleted_with_its_last_file(client, login):
+    body = new_content()
+    wait_for_job(client, upload(client, "a.csv", body).json()["job_id"])
+    upload(client, "b.csv", body).raise_for_status()
+    content_hash, _ = content(body)
+
+    assert client.delete("/files/delete/a.csv").status_code == 200
+    assert object_exists(content_hash)
+    assert content(body)[1] is not None
+
+    response = client.post("/files/bulk-delete", json={"file_names": ["b.csv", "missing.csv"]})
+    assert [r["status"] for r in response.json()["results"]] == ["deleted", "not_found"]
+    assert not object_exists(content_hash)
+    assert content(body)[1] is None
+    assert not os.path.exists(artifact_dir(content_hash))
+    assert file_names(client) == []
+
+
+def test_failed_job_removes_the_content(client):
+    # Not a PDF, so parsing fails
+    body = b"%PDF-1.4 broken " + uuid.uuid4().hex.encode()
+    response = upload(client, "broken.pdf", body, "application/pdf")
+    job = wait_for_job(client, response.json()["job_id"])
+    assert job["status"] == "failed"
+
+    content_hash, row = content(body)
+    assert row is None
+    assert not object_exists(content_hash)
+    assert file_names(client) == []
+
+
+def test_rejected_job_removes_the_content(client, monkeypatch):
+    monkeypatch.setattr(ingestion, "MAX_QUEUED_INGEST_JOBS", 0)
+    body = new_content()
+    assert upload(client, "busy.csv", body).status_code == 503
+
+    content_hash, row = content(body)
+    assert row is None
+    assert not object_exists(content_hash)
+
+
+async def _remove_unused(content_hashes):
+    async with AsyncSessionLocal() as db:
+        return await remove_unused_contents(db, content_hashes)
+
+
+def test_pending_uploads_keep_their_content(app_client):
+    content_hash = uuid.uuid4().hex * 2
+    with SessionLocal() as db:
+        assert claim_content(db, content_hash, content_s3_key(content_hash), 1, "text/csv")
+        assert not claim_content(db, content_hash, content_s3_key(content_hash), 1, "text/csv")
+        db.commit()
+
+    # Still referenced by both uploads, then by one
+    assert asyncio.run(_remove_unused([content_hash])) == {}
+    with SessionLocal() as db:
+        release_content(db, content_hash)
+        db.commit()
+        asyncio.run(_remove_unused([content_hash]))
+        assert db.execute(select(Contents.pending).where(Contents.sha256 == content_hash)).scalar() == 1
+
+        release_content(db, content_hash)
+        db.commit()
+    asyncio.run(_remove_unused([content_hash]))
+    with SessionLocal() as db:
+        assert db.get(Contents, content_hash) is None
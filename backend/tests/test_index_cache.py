@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from app import vector_store
+from app.index_cache import UserIndexCache
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "VECTOR_STORE_ROOT", str(tmp_path))
+
+
+def add(user_id: int, document_id: int, pages):
+    embeddings = np.random.default_rng(document_id).normal(size=(len(pages), 8)).astype("float32")
+    vector_store.add_document_vectors(user_id, document_id, embeddings,
+                                      [f"chunk {i}" for i in range(len(pages))], pages)
+
+
+def test_cold_cache_loads_index_texts_and_pages():
+    add(1, 3, [1, 1, 2])
+    ids = vector_store.vector_ids(3, 3)
+
+    entry = UserIndexCache().get(1)
+
+    assert entry.index.ntotal == 3
+    assert entry.chunks == {ids[0]: "chunk 0", ids[1]: "chunk 1", ids[2]: "chunk 2"}
+    assert entry.pages == {ids[0]: 1, ids[1]: 1, ids[2]: 2}
+    assert entry.lexical is not None
+
+
+def test_entries_are_reused_until_the_index_changes():
+    cache = UserIndexCache()
+    add(1, 3, [None])
+    entry = cache.get(1)
+    assert cache.get(1) is entry
+    assert entry.pages == {}
+
+    add(1, 4, [5])
+    reloaded = cache.get(1)
+    assert reloaded is not entry
+    assert reloaded.pages == {vector_store.vector_ids(4, 1)[0]: 5}
+
+
+def test_missing_index_and_budget():
+    cache = UserIndexCache(max_bytes=1)
+    assert cache.get(2) is None
+    add(1, 3, [1])
+    # Too large to keep, but still returned
+    assert cache.get(1) is not None
+    assert cache.nbytes == 0
@@ -0,0 +1,46 @@
+import os
+import uuid
+
+from .conftest import WORKDIR, wait_for_job
+
+
+def upload_rows(client, name: str = "rows.csv", rows: int = 50):
+    body = "id,text\n" + "".join(f"{row},ingestion job row {row}\n" for row in range(rows))
+    body += f"{rows},{uuid.uuid4().hex}\n"
+    response = client.post("/files/upload", files={"file": (name, body.encode(), "text/csv")})
+    assert response.status_code == 202
+    return response.json()["job_id"]
+
+
+def spooled_files(client):
+    user_id = client.get("/auth/me").json()["user"]["id"]
+    spool = os.path.join(WORKDIR, "app", "tmp", str(user_id))
+    return os.listdir(spool) if os.path.isdir(spool) else []
+
+
+def test_completed_job_reports_every_stage(client):
+    job = wait_for_job(client, upload_rows(client))
+    assert job["status"] == "completed"
+    assert job["file_name"] == "rows.csv"
+    assert job["progress"] == 1.0
+    assert set(job["timings"]) == {"parse", "embed", "index"}
+    assert job["stage"] is None and job["error"] is None
+    assert spooled_files(client) == []
+
+
+def test_failed_job_reports_the_error(client):
+    body = b"not a pdf " + uuid.uuid4().hex.encode()
+    response = client.post("/files/upload", files={"file": ("broken.pdf", body, "application/pdf")})
+    job = wait_for_job(client, response.json()["job_id"])
+    assert job["status"] == "failed"
+    assert job["error"]
+    assert spooled_files(client) == []
+
+
+def test_jobs_are_only_visible_to_their_owner(client, login):
+    job_id = upload_rows(client)
+    wait_for_job(client, job_id)
+
+    other = login()
+    assert other.get(f"/files/jobs/{job_id}").status_code == 404
+    assert other.get(f"/files/jobs/{uuid.uuid4()}").status_code == 404
@@ -0,0 +1,122 @@
+import math
+
+import numpy as np
+import pytest
+
+from app import lexical_index, vector_store
+from app.lexical_index import (BM25_B, BM25_K1, LexicalIndex, MemoryLexicalIndex, UserLexicalIndex,
+                               add_document_terms, count_terms, decode_postings, delete_document_terms,
+                               encode_postings, reciprocal_rank_fusion)
+
+TEXTS = [
+    "invoice INV-2041 was paid in March",
+    "the quarterly report covers revenue and costs",
+    "revenue grew while costs fell, revenue is up",
+    "meeting notes about the report",
+]
+
+
+def bm25(term_count: int, length: int, average_length: float, frequency: int, chunk_count: int) -> float:
+    idf = math.log(1 + (chunk_count - frequency + 0.5) / (frequency + 0.5))
+    return idf * term_count * (BM25_K1 + 1) / (
+        term_count + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+
+
+def test_bm25_scores():
+    index = MemoryLexicalIndex()
+    index.add(TEXTS)
+    lengths = [sum(count_terms(text).values()) for text in TEXTS]
+    average_length = sum(lengths) / len(lengths)
+
+    scores, ids = index.search("revenue report", 10)
+
+    expected = {
+        1: bm25(1, lengths[1], average_length, 2, 4) + bm25(1, lengths[1], average_length, 2, 4),
+        2: bm25(2, lengths[2], average_length, 2, 4),
+        3: bm25(1, lengths[3], average_length, 2, 4),
+    }
+    assert ids.tolist() == sorted(expected, key=expected.get, reverse=True)
+    assert scores == pytest.approx([expected[i] for i in ids.tolist()], rel=1e-5)
+
+
+def test_bm25_keeps_identifiers_whole():
+    index = MemoryLexicalIndex()
+    index.add(TEXTS)
+    assert index.search("INV-2041", 10)[1].tolist() == [0]
+    assert index.search("the is", 10)[1].size == 0
+
+
+def test_reciprocal_rank_fusion():
+    ids, scores = reciprocal_rank_fusion([np.array([1, 2, 3]), np.array([3, 1, -1])], 3, rrf_k=60)
+    assert ids.tolist() == [1, 3, 2]
+    assert scores == pytest.approx([1 / 61 + 1 / 62, 1 / 63 + 1 / 61, 1 / 62])
+
+
+def test_reciprocal_rank_fusion_truncates_and_skips_missing():
+    ids, scores = reciprocal_rank_fusion([np.array([-1, -1]), np.array([7, 8, 9])], 2)
+    assert ids.tolist() == [7, 8]
+    assert scores.dtype == np.float32
+
+
+def test_postings_round_trip():
+    chunk_numbers, counts = decode_postings(encode_postings([0, 3, 200, 70000], [1, 5, 130, 2]))
+    assert chunk_numbers.tolist() == [0, 3, 200, 70000]
+    assert counts.tolist() == [1, 5, 130, 2]
+
+
+def test_user_index_matches_memory_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "VECTOR_STORE_ROOT", str(tmp_path))
+    add_document_terms(1, 5, [count_terms(text) for text in TEXTS[:2]])
+    add_document_terms(1, 6, [count_terms(text) for text in TEXTS[2:]])
+    memory = MemoryLexicalIndex()
+    memory.add(TEXTS)
+    ids_of = {0: 5 << vector_store.CHUNK_ID_BITS, 1: (5 << vector_store.CHUNK_ID_BITS) + 1,
+              2: 6 << vector_store.CHUNK_ID_BITS, 3: (6 << vector_store.CHUNK_ID_BITS) + 1}
+
+    index = UserLexicalIndex(1)
+    query = "revenue report"
+    postings = index.query_postings(query)
+    scores, ids = index.search(query, 10, postings)
+    expected_scores, expected_ids = memory.search(query, 10)
+    assert ids.tolist() == [ids_of[i] for i in expected_ids.tolist()]
+    assert scores == pytest.approx(expected_scores)
+    assert index.search(query, 10)[1].tolist() == ids.tolist()
+
+    # The kept connection sees later writes
+    delete_document_terms(1, [6])
+    lengths = [sum(count_terms(text).values()) for text in TEXTS[:2]]
+    assert index.stats() == (2, pytest.approx(sum(lengths) / 2))
+    assert index.search("revenue", 10)[1].tolist() == [ids_of[1]]
+
+
+def test_candidates_from_postings(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "VECTOR_STORE_ROOT", str(tmp_path))
+    monkeypatch.setattr(lexical_index, "LEXICAL_PREFILTER_MAX_FRACTION", 0.3)
+    add_document_terms(1, 5, [count_terms(text) for text in TEXTS])
+    index = UserLexicalIndex(1)
+
+    query = "invoice INV-2041 revenue"
+    expected = [5 << vector_store.CHUNK_ID_BITS]
+    assert index.candidates(query).tolist() == expected
+    assert index.candidates(query, index.query_postings(query)).tolist() == expected
+
+
+def test_documents_with_too_many_chunks_are_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "VECTOR_STORE_ROOT", str(tmp_path))
+    monkeypatch.setattr(vector_store, "MAX_CHUNKS_PER_DOCUMENT", len(TEXTS) - 1)
+    add_document_terms(1, 5, [count_terms(text) for text in TEXTS[:2]])
+    with pytest.raises(ValueError):
+        add_document_terms(1, 6, [count_terms(text) for text in TEXTS])
+    assert UserLexicalIndex(1).stats()[0] == 2
+
+
+def test_lexical_index_is_abstract():
+    with pytest.raises(TypeError):
+        LexicalIndex()
+
+    class PostingsOnly(LexicalIndex):
+        def postings(self, term):
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    with pytest.raises(TypeError):
+        PostingsOnly()
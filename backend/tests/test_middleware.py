@@ -0,0 +1,84 @@
+from app import metrics
+from app.metrics import REQUEST_LATENCY
+from app.middleware import PublicRouteMatcher
+
+
+def test_public_route_matcher():
+    is_public = PublicRouteMatcher(["/auth/login", "/"], ["/docs", "/static/"])
+    assert is_public("/auth/login")
+    assert is_public("/auth/login/")
+    assert is_public("/")
+    assert not is_public("/auth/login/extra")
+    assert is_public("/docs")
+    assert is_public("/docs/oauth2-redirect")
+    assert is_public("/static/app.js")
+    assert not is_public("/docsecret")
+    assert not is_public("/files/list")
+    assert not PublicRouteMatcher([])("/docs")
+
+
+def test_requests_need_a_valid_token(app_client, login):
+    app_client.cookies.clear()
+    response = app_client.get("/files/list")
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Authorization token is missing"}
+
+    app_client.cookies.set("access_token", "not-a-token")
+    response = app_client.get("/files/list")
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Invalid or expired token"}
+
+    client = login()
+    assert client.get("/files/list").status_code == 200
+    assert client.get("/auth/me").json()["user"]["username"].startswith("user-")
+
+
+def test_public_paths_skip_authentication(app_client):
+    app_client.cookies.clear()
+    assert app_client.post("/auth/logout").status_code == 200
+    # Reaches the route, which rejects the empty form instead of the middleware
+    assert app_client.post("/auth/login").status_code == 422
+
+
+def _observations(route: str, status: str) -> float:
+    for metric in REQUEST_LATENCY.collect():
+        for sample in metric.samples:
+            if (sample.name.endswith("_count") and sample.labels["route"] == route
+                    and sample.labels["status"] == status):
+                return sample.value
+    return 0
+
+
+def test_requests_are_timed_by_route_and_traced(client):
+    before = _observations("/files/jobs/{job_id}", "404")
+    response = client.get("/files/jobs/some-job")
+    assert response.status_code == 404
+    assert _observations("/files/jobs/{job_id}", "404") == before + 1
+
+    # A generated trace id, or the caller's request id, comes back with the response
+    assert len(response.headers["x-trace-id"]) == 16
+    response = client.get("/files/list", headers={"x-request-id": "req-123"})
+    assert response.headers["x-trace-id"] == "req-123"
+
+
+def test_request_ids_must_be_short_tokens(client):
+    for request_id in ("x" * 129, "bad id", "<script>", ""):
+        response = client.get("/files/list", headers={"x-request-id": request_id})
+        assert response.headers["x-trace-id"] != request_id
+        assert len(response.headers["x-trace-id"]) == 16
+    request_id = "a" * 128
+    assert client.get("/files/list", headers={"x-request-id": request_id}).headers["x-trace-id"] == request_id
+
+
+def test_metrics_need_a_login_or_the_metrics_token(app_client, login, monkeypatch):
+    app_client.cookies.clear()
+    assert app_client.get("/metrics").status_code == 401
+    client = login()
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "http_request_duration_seconds" in response.text
+
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "scrape-token")
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers={"authorization": "Bearer scrape-token"})
+    assert response.status_code == 200
@@ -0,0 +1,44 @@
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine, inspect, text
+
+from app import models  # noqa: F401
+from app.database import Base, _run_migrations
+
+
+def _engine(tmp_path):
+    return create_engine(f"sqlite:///{tmp_path / 'migrations.sqlite'}")
+
+
+def test_migrations_build_the_current_schema(tmp_path):
+    engine = _engine(tmp_path)
+    with engine.begin() as connection:
+        _run_migrations(connection)
+    with engine.connect() as connection:
+        differences = compare_metadata(MigrationContext.configure(connection), Base.metadata)
+    assert differences == []
+
+
+def test_databases_from_before_migrations_are_upgraded(tmp_path):
+    engine = _engine(tmp_path)
+    with engine.begin() as connection:
+        # The tables the first version created with create_all()
+        _run_migrations(connection)
+        for table in ("chat_turns", "chat_sessions", "ingestion_tasks", "contents"):
+            connection.execute(text(f"DROP TABLE {table}"))
+        connection.execute(text("DROP TABLE alembic_version"))
+        connection.execute(text("DROP TABLE files"))
+        connection.execute(text(
+            "CREATE TABLE files (id INTEGER PRIMARY KEY, file_name VARCHAR, file_url VARCHAR UNIQUE, "
+            "upload_date DATETIME, user_id INTEGER REFERENCES users (id))"))
+        connection.execute(text("CREATE INDEX ix_files_id ON files (id)"))
+        connection.execute(text("DROP INDEX ix_documents_owner_id_document_name"))
+        connection.execute(text("INSERT INTO files (file_name, file_url) VALUES ('a.pdf', 'url')"))
+
+    with engine.begin() as connection:
+        _run_migrations(connection)
+        assert connection.execute(text("SELECT version_num FROM alembic_version")).scalar() == "0003"
+        # Existing rows are kept, and deduplicated uploads may share a URL now
+        connection.execute(text("INSERT INTO files (file_name, file_url) VALUES ('b.pdf', 'url')"))
+        assert connection.execute(text("SELECT count(*) FROM files")).scalar() == 2
+        assert "pending" in {column["name"] for column in inspect(connection).get_columns("contents")}
@@ -0,0 +1,63 @@
+import uuid
+
+import pytest
+
+from app import rag_integration
+
+from .conftest import wait_for_job
+
+
+@pytest.fixture
+def prompts(monkeypatch):
+    """Stand-in for the LLM; returns the prompts it was given."""
+    prompts = []
+
+    async def create_chat_engine(user_id: int):
+        def chat_engine(input_data: str):
+            prompts.append(input_data)
+            return f"answer {len(prompts)}"
+        return chat_engine
+
+    monkeypatch.setattr(rag_integration, "create_chat_engine", create_chat_engine)
+    return prompts
+
+
+@pytest.fixture
+def indexed(client):
+    body = "id,text\n1,retrieval index of the storage bucket\n2,upload session history\n"
+    body += f"3,{uuid.uuid4().hex}\n"
+    response = client.post("/files/upload", files={"file": ("notes.csv", body.encode(), "text/csv")})
+    assert wait_for_job(client, response.json()["job_id"])["status"] == "completed"
+    return client
+
+
+def test_chat_is_grounded_in_the_users_chunks(indexed, prompts):
+    session_id = uuid.uuid4().hex
+    response = indexed.post("/rag/chat", json={"input_data": "storage bucket", "session_id": session_id})
+    assert response.json() == {"message": "answer 1"}
+    assert "text: retrieval index of the storage bucket" in prompts[0]
+
+    # The next turn of the session sees the previous one
+    indexed.post("/rag/chat", json={"input_data": "and the upload?", "session_id": session_id})
+    assert "UserQuery\nstorage bucket\nResponse\nanswer 1" in prompts[1]
+    indexed.post("/rag/chat", json={"input_data": "new topic", "session_id": uuid.uuid4().hex})
+    assert "UserQuery" not in prompts[2]
+
+
+def test_chat_without_documents(client, prompts):
+    response = client.post("/rag/chat", json={"input_data": "anything"})
+    assert response.status_code == 404
+    assert prompts == []
+
+
+def test_search_returns_matches_per_query(indexed):
+    response = indexed.post("/rag/search", json={"queries": ["storage bucket", "session"], "top_k": 1})
+    results = response.json()["results"]
+    assert [result["query"] for result in results] == ["storage bucket", "session"]
+    match = results[0]["matches"][0]
+    assert "retrieval index of the storage bucket" in match["text"]
+    assert match["page_number"] is None
+
+    assert indexed.post("/rag/search", json={"queries": [], "top_k": 1}).status_code == 422
+    assert indexed.post("/rag/search", json={"queries": ["x"], "top_k": 0}).status_code == 422
+    assert indexed.post("/rag/search", json={"queries": ["x"], "mode": "other"}).status_code == 400
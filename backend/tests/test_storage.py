@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import io
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+from fastapi import UploadFile
+
+from app import storage
+from app.storage import (LocalStorage, MultipartUploader, ObjectNotFound, S3Storage, UploadTooLarge,
+                         spool_upload)
+
+
+class FakeS3:
+    """In-memory stand-in for the boto3 calls the storage backends make."""
+
+    def __init__(self, fail_keys=()):
+        self.objects = {}
+        self.uploads = {}
+        self.fail_keys = set(fail_keys)
+        self.delete_calls = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = bytes(Body)
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.uploads["upload-1"] = {}
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def delete_objects(self, Bucket, Delete):
+        self.delete_calls += 1
+        errors = []
+        for item in Delete["Objects"]:
+            if item["Key"] in self.fail_keys:
+                errors.append({"Key": item["Key"], "Code": "AccessDenied", "Message": "denied"})
+            else:
+                self.objects.pop(item["Key"], None)
+        return {"Errors": errors}
+
+    def head_object(self, Bucket, Key):
+        raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+
+
+def test_local_storage_round_trip(tmp_path):
+    source = tmp_path / "upload.bin"
+    source.write_bytes(bytes(range(256)) * 10)
+    backend = LocalStorage(str(tmp_path / "objects"))
+
+    async def scenario():
+        await backend.put_file(str(source), "content/abc")
+        info = await backend.stat("content/abc")
+        assert info.size == 2560
+        assert info.etag.startswith('"') and info.etag.endswith('"')
+        assert b"".join([chunk async for chunk in backend.iter_range("content/abc", 10, 19)]) == bytes(range(10, 20))
+
+        assert await backend.delete_many(["content/abc", "content/missing"]) == {}
+        with pytest.raises(ObjectNotFound):
+            await backend.stat("content/abc")
+
+    asyncio.run(scenario())
+
+
+def test_local_storage_rejects_keys_outside_its_root(tmp_path):
+    backend = LocalStorage(str(tmp_path / "objects"))
+    with pytest.raises(ValueError):
+        backend.object_url("../secret")
+    errors = asyncio.run(backend.delete_many(["../secret"]))
+    assert list(errors) == ["../secret"]
+
+
+def test_multipart_upload_reassembles_the_parts():
+    s3 = FakeS3()
+    data = bytes(range(256)) * 100
+
+    async def upload():
+        uploader = MultipartUploader(s3, "bucket", "key", part_size=1000, concurrency=2)
+        for start in range(0, len(data), 777):
+            await uploader.write(data[start:start + 777])
+        await uploader.complete()
+
+    asyncio.run(upload())
+    assert s3.objects["key"] == data
+    assert s3.uploads == {}
+
+
+def test_small_uploads_use_a_single_put():
+    s3 = FakeS3()
+
+    async def upload():
+        uploader = MultipartUploader(s3, "bucket", "key", part_size=1000)
+        await uploader.write(b"small")
+        await uploader.complete()
+
+    asyncio.run(upload())
+    assert s3.objects == {"key": b"small"}
+
+
+def test_s3_delete_many_batches_and_reports_failures(monkeypatch):
+    monkeypatch.setattr(storage, "S3_DELETE_BATCH_SIZE", 2)
+    s3 = FakeS3(fail_keys={"b"})
+    s3.objects = {key: b"x" for key in "abcde"}
+    backend = S3Storage(bucket="bucket", region="eu-west-1", s3_client=s3)
+
+    errors = asyncio.run(backend.delete_many(list("abcde")))
+    assert errors == {"b": "AccessDenied: denied"}
+    assert s3.objects == {"b": b"x"}
+    assert s3.delete_calls == 3
+
+    with pytest.raises(ObjectNotFound):
+        asyncio.run(backend.stat("a"))
+
+
+def test_spool_upload_hashes_and_limits_the_size(tmp_path):
+    data = b"spooled bytes " * 1000
+    path = tmp_path / "spool"
+    size, digest = asyncio.run(spool_upload(UploadFile(filename="f", file=io.BytesIO(data)), str(path)))
+    assert (size, digest) == (len(data), hashlib.sha256(data).hexdigest())
+    assert path.read_bytes() == data
+
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(spool_upload(UploadFile(filename="f", file=io.BytesIO(data)), str(path), max_size=100))
+    assert not path.exists()
+
+
+def test_object_storage_is_abstract():
+    with pytest.raises(TypeError):
+        storage.ObjectStorage()
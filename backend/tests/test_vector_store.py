@@ -0,0 +1,132 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from app import ann_index, vector_store
+
+DIMENSION = 16
+CHUNKS = 400
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "VECTOR_STORE_ROOT", str(tmp_path))
+    monkeypatch.setattr(vector_store, "COMPACT_AFTER_SEGMENTS", 2)
+    monkeypatch.setattr(ann_index, "ANN_IVF_THRESHOLD", 1000)
+    scheduled = []
+    monkeypatch.setattr(vector_store, "schedule_rebuild", scheduled.append)
+    return scheduled
+
+
+def embeddings(document_id: int) -> np.ndarray:
+    return np.random.default_rng(document_id).normal(size=(CHUNKS, DIMENSION)).astype("float32")
+
+
+def add(document_id: int):
+    vector_store.add_document_vectors(1, document_id, embeddings(document_id), ["text"] * CHUNKS)
+
+
+def read_manifest() -> dict:
+    with open(os.path.join(vector_store.user_index_dir(1), vector_store.MANIFEST), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_rebuild_keeps_vectors_compacted_while_training(store, monkeypatch):
+    for document_id in (1, 2, 3):
+        add(document_id)
+    assert store == [1]
+
+    build = ann_index.build_ann_index
+
+    def build_while_compacting(vectors, ids):
+        index = build(vectors, ids)
+        # Document 1 is dropped and document 4 merged into the base by a compaction
+        vector_store.delete_document_vectors(1, [1])
+        add(4)
+        add(5)
+        return index
+
+    monkeypatch.setattr(ann_index, "build_ann_index", build_while_compacting)
+    vector_store.rebuild_user_index(1)
+
+    manifest = read_manifest()
+    assert manifest["index_type"] == "ivf_flat"
+    assert manifest["segments"] == ["segment-00000004.faiss"]
+    assert manifest["deleted"] == []
+    assert manifest["ntotal"] == 4 * CHUNKS
+
+    index = vector_store.UserVectorIndex.load(1)
+    assert index.ntotal == 4 * CHUNKS
+    for document_id in (2, 3, 4, 5):
+        _, ids = index.search(embeddings(document_id)[:5], 1, nprobe=64)
+        assert (ids[:, 0] == vector_store.vector_ids(document_id, CHUNKS)[:5]).all()
+    _, ids = index.search(embeddings(1)[:5], 10, nprobe=64)
+    assert not np.isin(vector_store.document_ids_of(ids), [1]).any()
+
+
+def test_rebuild_without_concurrent_changes(store):
+    for document_id in (1, 2, 3):
+        add(document_id)
+    vector_store.delete_document_vectors(1, [2])
+
+    # No further rebuild is needed afterwards
+    assert not vector_store.rebuild_user_index(1)
+
+    manifest = read_manifest()
+    assert manifest["segments"] == []
+    assert manifest["deleted"] == []
+    assert manifest["ntotal"] == 2 * CHUNKS
+    # Too few vectors left for IVF
+    assert manifest["index_type"] == "flat"
+
+
+def test_documents_with_too_many_chunks_are_rejected(store, monkeypatch):
+    add(1)
+    monkeypatch.setattr(vector_store, "MAX_CHUNKS_PER_DOCUMENT", CHUNKS - 1)
+    with pytest.raises(ValueError):
+        add(2)
+
+    # Nothing of the rejected document was written
+    assert read_manifest()["ntotal"] == CHUNKS
+    assert len(vector_store.load_chunk_texts(1)) == CHUNKS
+
+
+def test_rebuild_clears_hnsw_tombstones(store, monkeypatch):
+    build = ann_index.build_ann_index
+    monkeypatch.setattr(ann_index, "build_ann_index", lambda vectors, ids: build(vectors, ids, "hnsw"))
+    for document_id in (1, 2, 3):
+        add(document_id)
+    vector_store.rebuild_user_index(1)
+    assert read_manifest()["index_type"] == "hnsw"
+
+    # HNSW can't remove vectors, so deleted ones stay in the base until the next rebuild
+    vector_store.delete_document_vectors(1, [2])
+    add(4)
+    add(5)
+    manifest = read_manifest()
+    assert manifest["deleted"] == [2]
+    assert manifest["deleted_vectors"] == CHUNKS
+    assert manifest["ntotal"] == 5 * CHUNKS
+
+    def build_while_compacting(vectors, ids):
+        index = build(vectors, ids, "hnsw")
+        vector_store.delete_document_vectors(1, [3])
+        add(6)
+        add(7)
+        return index
+
+    monkeypatch.setattr(ann_index, "build_ann_index", build_while_compacting)
+    vector_store.rebuild_user_index(1)
+
+    # Document 2 is gone from the graph; document 3 was deleted while training
+    manifest = read_manifest()
+    assert manifest["deleted"] == [3]
+    assert manifest["deleted_vectors"] == CHUNKS
+    assert manifest["ntotal"] == 6 * CHUNKS
+    index = vector_store.UserVectorIndex.load(1)
+    _, ids = index.search(embeddings(2)[:5], 10)
+    assert not np.isin(vector_store.document_ids_of(ids), [2, 3]).any()
+    _, ids = index.search(embeddings(6)[:5], 1)
+    assert (ids[:, 0] == vector_store.vector_ids(6, CHUNKS)[:5]).all()